@@ -127,10 +127,30 @@ st.markdown(r'''
 </style>
 ''', unsafe_allow_html=True)
 
+# =========================
+# IMPOSTAZIONI (secrets / variabili d'ambiente)
+# =========================
+def _setting(name: str, default: str = "") -> str:
+    """Impostazione da st.secrets (se presente) oppure variabile d'ambiente."""
+    try:
+        v = st.secrets.get(name, None)
+        if v is not None:
+            return str(v)
+    except Exception:
+        pass
+    return os.getenv(name, default)
+
+def _int_setting(name: str, default: int) -> int:
+    try:
+        return int(_setting(name, default))
+    except (TypeError, ValueError):
+        return default
+
 # =========================
 # TOKEN QR / LINK SQUADRA
 # =========================
 TOKEN_TTL_HOURS = 24
+TOKEN_ACCESS_LOG_MIN = 10  # "ultimo accesso" dal link QR: al massimo una scrittura ogni N minuti per squadra
 
 # =========================
 # SEMAFORO MESSAGGI (SIDEBAR)
@@ -232,6 +252,11 @@ def render_semaforo_debug():
 
 def render_semaforo_sidebar():
     inbox_count, outbox_count = _count_inbox_outbox_pending()
+    # backlog reale del writer su disco (mutazioni accodate non ancora scritte)
+    wstats = storage_writer_stats()
+    outbox_count += int(wstats["backlog"])
+    lat = wstats["latency_ms"]
+    disk_title = f"Attesa (OUTBOX) · ultima scrittura {lat:.0f} ms" if lat is not None else "Attesa (OUTBOX)"
 
     red_cls = "red on" if inbox_count > 0 else "off"
     yel_cls = "yellow on" if outbox_count > 0 else "off"
@@ -243,7 +268,7 @@ def render_semaforo_sidebar():
   <div class='sem-pill {red_cls}' title='Arrivo (INBOX)'>
     ARRIVO <span class='sem-count'>{inbox_count}</span>
   </div>
-  <div class='sem-pill {yel_cls}' title='Attesa (OUTBOX)'>
+  <div class='sem-pill {yel_cls}' title='{disk_title}'>
     ATTESA <span class='sem-count'>{outbox_count}</span>
   </div>
 </div>
@@ -382,6 +407,16 @@ from io import BytesIO
 from typing import Optional, Tuple, Dict, Any, List
 import hashlib
 import io
+import threading
+import contextlib
+import hmac
+import logging
+import math
+import bisect
+import itertools
+import heapq
+from array import array
+import sqlite3
 
 # =========================
 # REPORT CACHE (GLOBAL, SAFE)
@@ -412,6 +447,7 @@ def _cached_report_bytes(payload_json: str, meta_json: str) -> bytes:
         brogliaccio=payload.get("brogliaccio", []),
         center=payload.get("center", []),
         meta=meta,
+        tracks=payload.get("tracks"),
     )
 
 def team_style(team: str) -> dict:
@@ -654,22 +690,155 @@ def render_clock_in_sidebar(show_stopwatch: bool = True) -> None:
 def _b64_decode_bytes(s: str) -> bytes:
     return base64.b64decode(s.encode("ascii"))
 
+# =========================
+# PHOTO STORE (content-addressed)
+# =========================
+# Le foto vengono salvate una sola volta in PHOTO_DIR/<aa>/<sha256> (foto identiche = un file);
+# eventi e inbox portano solo il riferimento {"name", "type", "ref", "size", "thumb", "w", "h"}.
+# All'ingresso (Pillow, se installato) la foto viene raddrizzata secondo l'EXIF, ripulita dai
+# metadati (GPS del telefono compreso), ridotta al lato massimo e ricompressa; accanto si salva
+# una miniatura per le liste della Sala.
+PHOTO_DIR = "photos"
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except Exception:
+    Image = None
+    ImageOps = None
+
+PHOTO_MAX_PX = _int_setting("RM_PHOTO_MAX_PX", 1600)
+PHOTO_QUALITY = _int_setting("RM_PHOTO_QUALITY", 80)
+PHOTO_FORMAT = str(_setting("RM_PHOTO_FORMAT", "JPEG") or "JPEG").upper()  # JPEG | WEBP
+PHOTO_THUMB_PX = 320
+
+PHOTO_REF_RE = re.compile(r"[0-9a-f]{64}")  # sha256 esadecimale: l'unico nome valido nello store
+
+def _photo_ref_ok(ref) -> bool:
+    return isinstance(ref, str) and PHOTO_REF_RE.fullmatch(ref) is not None
+
+def _photo_path(ref: str) -> str:
+    # un ref arriva anche da dati esterni (backup, invii): niente percorsi fuori da PHOTO_DIR
+    if not _photo_ref_ok(ref):
+        raise ValueError(f"ref foto non valido: {ref!r}")
+    return os.path.join(PHOTO_DIR, ref[:2], ref)
+
+def _photo_store_put(b: bytes) -> str:
+    """Scrive i byte nello store (se non già presenti) e ritorna l'hash."""
+    ref = hashlib.sha256(b).hexdigest()
+    path = _photo_path(ref)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(b)
+        os.replace(tmp, path)
+    return ref
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _photo_store_get(ref: str) -> Optional[bytes]:
+    # contenuto indirizzato per hash: la cache non diventa mai obsoleta
+    try:
+        with open(_photo_path(ref), "rb") as f:
+            return f.read()
+    except Exception:
+        return None
+
+def _photo_encode(img, max_px: int, quality: int, fmt: str) -> bytes:
+    im = img.copy()
+    im.thumbnail((max_px, max_px))
+    buf = BytesIO()
+    if fmt == "WEBP":
+        im.save(buf, format="WEBP", quality=quality, method=4)
+    else:
+        im.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+def _photo_process(b: bytes) -> Optional[tuple]:
+    """(foto, miniatura, mime, w, h) ridotte e senza EXIF; None se Pillow manca o il file non è un'immagine."""
+    if Image is None:
+        return None
+    try:
+        img = Image.open(BytesIO(b))
+        src_fmt = img.format
+        had_exif = bool(img.info.get("exif"))
+        img = ImageOps.exif_transpose(img)  # orientamento applicato ai pixel, poi l'EXIF non serve più
+        if img.mode not in ("RGB", "L"):
+            bg = Image.new("RGB", img.size, (255, 255, 255))
+            bg.paste(img, mask=img.convert("RGBA").split()[-1])
+            img = bg
+        fmt = "WEBP" if PHOTO_FORMAT == "WEBP" else "JPEG"
+        main = _photo_encode(img, PHOTO_MAX_PX, PHOTO_QUALITY, fmt)
+        if len(main) >= len(b) and not had_exif and max(img.size) <= PHOTO_MAX_PX and src_fmt in ("JPEG", "WEBP"):
+            main, fmt = b, src_fmt  # già piccola e pulita: si tiene l'originale (nel suo formato)
+        thumb = _photo_encode(img, PHOTO_THUMB_PX, 70, "JPEG")
+        w, h = img.size
+        k = min(1.0, PHOTO_MAX_PX / float(max(w, h)))
+        return main, thumb, ("image/webp" if fmt == "WEBP" else "image/jpeg"), round(w * k), round(h * k)
+    except Exception:
+        return None
+
+def _photo_ref(b: bytes, name: str = "foto", mime: str = "image/jpeg") -> dict:
+    ref = {"name": name or "foto", "type": mime or "image/jpeg"}
+    done = _photo_process(b)
+    if done is not None:
+        b, thumb, ref["type"], ref["w"], ref["h"] = done
+        ref["thumb"] = _photo_store_put(thumb)
+    ref.update(ref=_photo_store_put(b), size=len(b))
+    return ref
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _photo_thumb_cached(ref: str, thumb_ref: str = "") -> Optional[bytes]:
+    """Miniatura (LRU per hash della foto): quella salvata all'arrivo, oppure generata una volta
+    per le foto più vecchie che non la hanno."""
+    if thumb_ref:
+        b = _photo_store_get(thumb_ref)
+        if b:
+            return b
+    b = _photo_store_get(ref)
+    if not b or Image is None:
+        return b
+    try:
+        img = ImageOps.exif_transpose(Image.open(BytesIO(b))).convert("RGB")
+        return _photo_encode(img, PHOTO_THUMB_PX, 70, "JPEG")
+    except Exception:
+        return None
+
+def _photo_thumb_bytes(photo) -> Optional[bytes]:
+    p = _normalize_photo_obj(photo)
+    if not p:
+        return None
+    return _photo_thumb_cached(p["ref"], p.get("thumb") or "")
+
 def _normalize_photo_obj(photo):
-    """Ensure JSON-serializable photo object. Accepts None/bytes/dict."""
+    """Ensure JSON-serializable photo reference. Accepts None/bytes/dict (legacy b64 is moved to the store)."""
     if not photo:
         return None
     if isinstance(photo, (bytes, bytearray)):
-        return {"name": "foto", "type": "image/jpeg", "b64": _b64_encode_bytes(bytes(photo))}
+        return _photo_ref(bytes(photo))
+    if isinstance(photo, dict) and photo.get("ref"):
+        if not _photo_ref_ok(photo.get("ref")):
+            return None
+        out = {"name": photo.get("name") or "foto", "type": photo.get("type") or "image/jpeg",
+               "ref": photo["ref"], "size": photo.get("size")}
+        out.update({k: photo[k] for k in ("w", "h") if photo.get(k)})
+        if _photo_ref_ok(photo.get("thumb")):
+            out["thumb"] = photo["thumb"]
+        return out
     if isinstance(photo, dict) and photo.get("b64"):
-        return {"name": photo.get("name") or "foto", "type": photo.get("type") or "image/jpeg", "b64": str(photo.get("b64"))}
+        try:
+            return _photo_ref(_b64_decode_bytes(str(photo["b64"])), photo.get("name"), photo.get("type"))
+        except Exception:
+            return None
     return None
 
 def _photo_to_bytes(photo) -> Optional[bytes]:
-    """Accepts None, raw bytes, or dict {'b64':..., ...}. Returns bytes or None."""
+    """Accepts None, raw bytes, or dict {'ref':...} / legacy {'b64':...}. Returns bytes or None."""
     if not photo:
         return None
     if isinstance(photo, (bytes, bytearray)):
         return bytes(photo)
+    if isinstance(photo, dict) and photo.get("ref"):
+        return _photo_store_get(str(photo["ref"]))
     if isinstance(photo, dict) and photo.get("b64"):
         try:
             return _b64_decode_bytes(photo["b64"])
@@ -677,6 +846,23 @@ def _photo_to_bytes(photo) -> Optional[bytes]:
             return None
     return None
 
+def _photo_inline(photo):
+    """Foto con byte incorporati (b64): per backup JSON autosufficienti."""
+    b = _photo_to_bytes(photo)
+    if not b:
+        return None
+    return {"name": photo.get("name") or "foto", "type": photo.get("type") or "image/jpeg", "b64": _b64_encode_bytes(b)}
+
+def _externalize_photos(payload: dict) -> bool:
+    """Sposta nello store le foto b64 incorporate (dati legacy / backup). True se qualcosa è cambiato."""
+    changed = False
+    for key in ("brogliaccio", "inbox", "reply_queue"):
+        for r in payload.get(key) or []:
+            if isinstance(r, dict) and isinstance(r.get("foto"), dict) and r["foto"].get("b64"):
+                r["foto"] = _normalize_photo_obj(r["foto"])
+                changed = True
+    return changed
+
 # =========================
 # CONFIG
 # =========================
@@ -1065,18 +1251,22 @@ def _pick_next_team_color(used_hex: set) -> str:
     return COLORI_SQUADRE[len(used_hex) % len(COLORI_SQUADRE)]
 
 def ensure_team_colors() -> None:
-    """Assicura che ogni squadra abbia un colore fisso ('mhex')."""
+    """Assicura che ogni squadra abbia un colore fisso ('mhex'), salvato come team_set nel journal."""
+    squadre = dict(st.session_state.squadre)
     used = set()
-    for _name, info in st.session_state.squadre.items():
+    for _name, info in squadre.items():
         hx = (info.get("mhex") or "").strip()
         if hx.startswith("#") and len(hx) == 7:
             used.add(hx)
-    for name in sorted(st.session_state.squadre.keys()):
-        info = st.session_state.squadre[name]
-        hx = (info.get("mhex") or "").strip()
+    ops = []
+    for name in sorted(squadre.keys()):
+        hx = (squadre[name].get("mhex") or "").strip()
         if not (hx.startswith("#") and len(hx) == 7):
-            info["mhex"] = _pick_next_team_color(used)
-            used.add(info["mhex"])
+            hx = _pick_next_team_color(used)
+            used.add(hx)
+            ops.append({"op": "team_set", "name": name, "fields": {"mhex": hx}})
+    if ops:
+        _commit_ops(ops)
 
 def team_hex(team: str) -> str:
     info = st.session_state.squadre.get(team, {}) if hasattr(st.session_state, "squadre") else {}
@@ -1253,8 +1443,9 @@ def _get_last_team_status(team: str) -> str:
         pass
     # fallback: cerca nel brogliaccio l'ultimo evento con st valorizzato
     try:
-        for ev in st.session_state.get("brogliaccio", []):
-            if ev.get("sq") == team and ev.get("st"):
+        tid = (st.session_state.squadre.get(team) or {}).get("tid")
+        for ev in (st.session_state.brogliaccio.by(tid) if tid else ()):  # solo gli eventi della squadra
+            if ev.get("st"):
                 return ev.get("st")
     except Exception:
         pass
@@ -1294,6 +1485,36 @@ def chip_call_flow(row: dict) -> str:
     a, b = call_flow_from_row(row)
     return f"<div class='pc-flow'>📞 <b>{a}</b> <span class='pc-arrow'>➜</span> 🎧 <b>{b}</b></div>"
 
+REP_EDIT_MAX = 200  # eventi recenti proposti in "Modifica evento"
+
+# finestre temporali dei filtri (minuti indietro da adesso; -1 = intervallo scelto)
+TIME_WINDOWS = {"Tutto": None, "Ultimi 30 min": 30, "Ultima ora": 60, "Ultime 6 ore": 360, "Intervallo…": -1}
+
+def _time_window_ui(prefix: str, label: str) -> Tuple[Optional[int], Optional[int]]:
+    """Selettore di periodo -> (t0, t1) in epoch ms (None = estremo aperto)."""
+    sel = st.selectbox(label, list(TIME_WINDOWS), index=0, key=f"{prefix}_period")
+    mins = TIME_WINDOWS.get(sel)
+    if mins is None:
+        return None, None
+    if mins > 0:
+        return _now_ms() - mins * 60_000, None
+    day = st.session_state.get("ev_data") or datetime.now().date()
+    c1, c2, c3, c4 = st.columns(4)
+    d0 = c1.date_input("Dal giorno", value=day, key=f"{prefix}_d0")
+    h0 = c2.time_input("dalle", value=datetime.min.time(), key=f"{prefix}_h0")
+    d1 = c3.date_input("al giorno", value=d0, key=f"{prefix}_d1")
+    h1 = c4.time_input("alle", value=datetime.max.time().replace(second=0, microsecond=0), key=f"{prefix}_h1")
+    t0 = int(datetime.combine(d0, h0).timestamp() * 1000)
+    t1 = int(datetime.combine(d1, h1).timestamp() * 1000) + 59_999  # minuto finale incluso
+    return t0, t1
+
+def _event_label(ev: Optional[dict]) -> str:
+    """Etichetta breve di un evento del registro (selettori per id)."""
+    if not ev:
+        return "—"
+    msg = str(ev.get("mit") or "").strip()
+    return f"{ev.get('ora', '')} · {ev.get('sq') or '—'} · {msg[:40] + ('…' if len(msg) > 40 else '')}"
+
 def _folium_tiles_spec(choice: str | None = None) -> dict:
     """Restituisce specifiche tiles per Folium.
 
@@ -1443,10 +1664,13 @@ def build_folium_map_from_latest_positions(
     ultime_pos: Dict[str, Dict[str, Any]],
     center: list,
     zoom: int = 13,
+    tracks: Optional[Dict[str, List[List[float]]]] = None,
 ) -> folium.Map:
-    """Costruisce una mappa Folium partendo già da posizioni 'deduplicate'."""
+    """Costruisce una mappa Folium partendo già da posizioni 'deduplicate' (+ tracce GPS opzionali)."""
     m = folium.Map(location=center, zoom_start=zoom, tiles=None, prefer_canvas=True)
     _folium_apply_base_layer(m)
+    for sq, line in (tracks or {}).items():
+        folium.PolyLine(line, color=team_hex(sq), weight=3, opacity=0.7, tooltip=f"{sq} · traccia").add_to(m)
     for sq, info in (ultime_pos or {}).items():
         pos = info.get("pos")
         if not (isinstance(pos, list) and len(pos) == 2):
@@ -1697,6 +1921,7 @@ def make_html_report_bytes(
     brogliaccio: list,
     center: list,
     meta: dict,
+    tracks: Optional[Dict[str, List[List[float]]]] = None,
 ) -> bytes:
     """
     Report HTML stampabile con:
@@ -1705,6 +1930,7 @@ def make_html_report_bytes(
     - Mappa Folium integrata (iframe srcdoc) -> niente Pillow/staticmap.
     - Mappa "bloccata" (niente pan/zoom) per stampa pulita.
     - Legenda + scala.
+    - Percorso della squadra dal tracciamento GPS (tracks), se presente; altrimenti dai messaggi.
     """
     import html as _html
 
@@ -1900,7 +2126,7 @@ def make_html_report_bytes(
         return buf.getvalue().decode("utf-8", errors="ignore")
 
     # helper: produce 3 map srcdocs for a df
-    def _maps_for_df(df_x: pd.DataFrame) -> Dict[str, str]:
+    def _maps_for_df(df_x: pd.DataFrame, track_line: Optional[List[List[float]]] = None) -> Dict[str, str]:
         # LATEST
         pts_latest = _extract_points_latest_by_team(df_x) if ("sq" in df_x.columns or "squadra" in df_x.columns) else _extract_points_all_events(df_x)
         src_latest = _folium_srcdoc(pts_latest, None, zoom=14)
@@ -1910,7 +2136,7 @@ def make_html_report_bytes(
         src_all = _folium_srcdoc(pts_all, None, zoom=14)
 
         # TRACK
-        line = _extract_polyline_all_events(df_x)
+        line = track_line if track_line and len(track_line) >= 2 else _extract_polyline_all_events(df_x)
         src_track = _folium_srcdoc(pts_all, line if line else None, zoom=14)
 
         return {"LATEST": src_latest, "ALL": src_all, "TRACK": src_track}
@@ -1922,21 +2148,14 @@ def make_html_report_bytes(
     # compute maps for totals
     maps_tot = _maps_for_df(df_all) if (include_map and df_all is not None and not df_all.empty) else {"LATEST": "", "ALL": "", "TRACK": ""}
 
-    # per squadra
+    # per squadra: UN raggruppamento (colonne possibili: sq / squadra), non un filtro per squadra
+    _sq_col = next((c for c in ("sq", "squadra") if df_all is not None and c in df_all.columns), None)
+    by_sq = {k: g for k, g in df_all.groupby(_sq_col, sort=False)} if _sq_col and not df_all.empty else {}
     for sq_name in sorted(list(squads.keys())):
         options_html.append(f"<option value='{_safe(sq_name)}'>{_safe(sq_name)}</option>")
-        if df_all is None or df_all.empty:
-            df_sq = pd.DataFrame()
-        else:
-            # colonne possibili: sq / squadra
-            if "sq" in df_all.columns:
-                df_sq = df_all[df_all["sq"] == sq_name].copy()
-            elif "squadra" in df_all.columns:
-                df_sq = df_all[df_all["squadra"] == sq_name].copy()
-            else:
-                df_sq = pd.DataFrame()
+        df_sq = by_sq[sq_name].copy() if sq_name in by_sq else pd.DataFrame()
 
-        maps_sq = _maps_for_df(df_sq) if (df_sq is not None and not df_sq.empty) else {"LATEST": "", "ALL": "", "TRACK": ""}
+        maps_sq = _maps_for_df(df_sq, (tracks or {}).get(sq_name)) if (df_sq is not None and not df_sq.empty) else {"LATEST": "", "ALL": "", "TRACK": ""}
         tbl = _df_to_html_table(df_sq)
 
         map_html = ""
@@ -2235,7 +2454,6 @@ def default_state_payload():
         "ev_tipo": "Emergenza",
         "ev_nome": "",
         "ev_desc": "",
-        "BASE_URL": "",
         "cnt_conclusi": 0,
     }
 
@@ -2277,121 +2495,2658 @@ def _outbox_clear():
 
 def _outbox_retry_save() -> bool:
     try:
-        ok = save_data_to_disk(force=True)
+        ok = _storage_flush() and save_data_to_disk(force=True)
         if ok:
             _outbox_clear()
         return bool(ok)
     except Exception:
         return False
 
-def _photo_sig(photo_obj: dict) -> dict:
-    """Firma leggera foto: evita confronto base64 completo."""
-    if not photo_obj or not isinstance(photo_obj, dict):
-        return {}
-    b64 = photo_obj.get("b64") or ""
-    return {"name": photo_obj.get("name",""), "type": photo_obj.get("type",""), "len": len(b64)}
-
-def _entry_sig(e: dict) -> dict:
-    if not isinstance(e, dict):
-        return {}
-    d = dict(e)
-    if "foto" in d:
-        d["foto"] = _photo_sig(d.get("foto"))
-    return d
-
-def save_data_to_disk(force: bool = False) -> bool:
-    """Salvataggio veloce + atomico."""
-    payload = {
-        "brogliaccio": [dict(x, foto=_normalize_photo_obj(x.get("foto"))) for x in st.session_state.brogliaccio],
-        "inbox": [dict(x, foto=_normalize_photo_obj(x.get("foto"))) for x in st.session_state.inbox],
-        "squadre": st.session_state.squadre,
-        "pos_mappa": st.session_state.pos_mappa,
-        "op_name": st.session_state.op_name,
-        "ev_data": str(st.session_state.ev_data),
-        "ev_tipo": st.session_state.ev_tipo,
-        "ev_nome": st.session_state.ev_nome,
-        "ev_desc": st.session_state.ev_desc,
-        "BASE_URL": st.session_state.get("BASE_URL", ""),
-        "cnt_conclusi": st.session_state.get("cnt_conclusi", 0),
-    }
+# =========================
+# JOURNAL (append-only) + CHECKPOINT
+# =========================
+# data.json è il CHECKPOINT. Ogni modifica successiva (nuovo evento, approvazione inbox,
+# cambio stato, modifica squadra...) è UNA riga in JOURNAL_PATH: un invio costa un piccolo
+# append invece della riscrittura di tutto il file. All'avvio: checkpoint + replay del journal.
+JOURNAL_PATH = DATA_PATH + ".journal"
+JOURNAL_CHECKPOINT_BYTES = 2 * 1024 * 1024  # oltre questa soglia il journal viene compattato in data.json
+
+LOCK_PATH = DATA_PATH + ".lock"
+
+try:
+    import fcntl  # type: ignore
+except Exception:
+    fcntl = None
+try:
+    import msvcrt  # type: ignore
+except Exception:
+    msvcrt = None
+
+class StorageLock:
+    """Lock del processo (sessioni/thread) + lock su file tra processi (fcntl su Linux/macOS, msvcrt su Windows).
+    Rientrante: il lock su file si prende solo al primo livello. Se il file non è bloccabile si procede
+    con il solo lock di processo.
+    """
+    def __init__(self, path: str):
+        self._rlock = threading.RLock()
+        self._path = path
+        self._depth = 0
+        self._fh = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            try:
+                self._fh = open(self._path, "a+b")
+                if fcntl is not None:
+                    fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+                elif msvcrt is not None:
+                    self._fh.seek(0)
+                    while True:
+                        try:
+                            msvcrt.locking(self._fh.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            continue  # LK_LOCK rinuncia dopo ~10 s: si riprova
+            except Exception:
+                self._fh = None
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self._depth == 1 and self._fh is not None:
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+                    elif msvcrt is not None:
+                        self._fh.seek(0)
+                        msvcrt.locking(self._fh.fileno(), msvcrt.LK_UNLCK, 1)
+                finally:
+                    self._fh.close()
+                    self._fh = None
+        finally:
+            self._depth -= 1
+            self._rlock.release()
+        return False
+
+@st.cache_resource(show_spinner=False)
+def _storage_lock() -> StorageLock:
+    """Lock di scritture, compattazione e letture: tra sessioni, thread E processi (più istanze sullo stesso disco).
+    Ordine dei lock: prima _storage_lock(), poi SharedStore.lock (mai il contrario).
+    """
+    return StorageLock(LOCK_PATH)
+
+# Collezioni con versione propria (dirty tracking): solo quelle cambiate vengono riserializzate.
+COLLECTIONS = ("events", "inbox", "teams", "queue", "meta")
+# BASE_URL non è qui: dipende dall'host da cui è aperta la console, resta nella sessione
+META_KEYS = ("pos_mappa", "op_name", "ev_data", "ev_tipo", "ev_nome", "ev_desc", "cnt_conclusi")
+META_DEFAULTS = {"pos_mappa": [45.7075, 11.4772], "op_name": "", "ev_tipo": "Emergenza", "ev_nome": "",
+                 "ev_desc": "", "cnt_conclusi": 0}
+
+# =========================
+# SHARED STORE (dati canonici, uno per processo)
+# =========================
+# Console e telefoni dei caposquadra non tengono più una copia a testa di eventi/inbox/squadre:
+# i dati stanno UNA volta nello store del processo (st.cache_resource) e la sessione ne tiene
+# solo i riferimenti (st.session_state.brogliaccio is store.data["brogliaccio"]) + lo stato UI.
+class RecordLog:
+    """Collezione di record indicizzata per id (brogliaccio, inbox, coda risposte).
+
+    Un dict id -> record in ordine di arrivo fa da log e da indice insieme: inserimento,
+    lookup, sostituzione e rimozione per id sono O(1) qualunque sia la lunghezza del registro.
+    Verso l'esterno si comporta come la lista di prima (iterazione, len, indice, slice):
+    newest_first=True espone il più recente per primo (brogliaccio, coda), altrimenti
+    l'ordine di arrivo (inbox). Le slice in testa ([:2000]) costano O(k), non O(n).
+
+    index_field: indice secondario (es. "tid" del brogliaccio) valore -> {id: posizione},
+    aggiornato a ogni add/discard: le viste per squadra costano quanto gli eventi della squadra.
+    time_field: indice ordinato [(t epoch ms, posizione, id)]; le finestre temporali sono
+    due bisect + la slice, a parità di t vale l'ordine di arrivo (posizione monotona).
+
+    Thread di ingest, writer e watcher lo modificano mentre le sessioni lo leggono: ogni lettura
+    che scorre i record (iterazione, slice, by/select/window) lavora su una copia presa sotto
+    `lock` (quello dello store, assegnato da SharedStore.replace), mai sul dict vivo.
+    """
+
+    def __init__(self, rows=(), newest_first: bool = False, index_field: Optional[str] = None,
+                 time_field: Optional[str] = None, lock=None):
+        self.lock = lock or threading.RLock()
+        self.newest_first = newest_first
+        self.index_field = index_field
+        self.time_field = time_field
+        self._recs: Dict[str, dict] = {}
+        self._pos: Dict[str, int] = {}             # id -> posizione di arrivo (solo con indici)
+        self._times: List[tuple] = []              # [(t, posizione, id)] ordinata
+        self._by: Dict[Any, Dict[str, int]] = {}   # valore -> {id: posizione}
+        self._unsorted: set = set()                # bucket da riordinare (record spostato di valore)
+        self._n = 0
+        # le liste del payload sono già nell'ordine di vista: si caricano dal più vecchio
+        for rec in (reversed(list(rows)) if newest_first else rows):
+            if isinstance(rec, dict):
+                self.add(rec)
+
+    @staticmethod
+    def _key(rec: dict) -> str:
+        if not rec.get("id"):
+            rec["id"] = uuid.uuid4().hex  # come ensure_inbox_ids: senza id il record non è indirizzabile
+        return rec["id"]
+
+    def add(self, rec: dict) -> None:
+        """Nuovo record in coda al log; con un id già presente lo sostituisce al suo posto."""
+        with self.lock:
+            self._add(rec)
+
+    def _add(self, rec: dict) -> None:
+        key = self._key(rec)
+        old = self._recs.get(key)
+        self._recs[key] = rec
+        if self.index_field is None and self.time_field is None:
+            return
+        pos = self._pos.get(key)
+        if pos is None:
+            pos = self._pos[key] = self._n
+            self._n += 1
+        if self.time_field is not None:
+            t_old = old.get(self.time_field) if old is not None else None
+            t_new = rec.get(self.time_field)
+            if old is None or t_old != t_new:
+                if isinstance(t_old, (int, float)):
+                    self._untime(key, t_old, pos)
+                if isinstance(t_new, (int, float)):
+                    bisect.insort(self._times, (t_new, pos, key))
+        if self.index_field is None:
+            return
+        val = rec.get(self.index_field)
+        if old is not None:
+            if old.get(self.index_field) == val:
+                return
+            self._unindex(key, old)
+        bucket = self._by.setdefault(val, {})
+        if bucket and pos < next(reversed(bucket.values())):
+            self._unsorted.add(val)
+        bucket[key] = pos
+
+    def _untime(self, key: str, t, pos: int) -> None:
+        i = bisect.bisect_left(self._times, (t, pos, key))
+        if i < len(self._times) and self._times[i][2] == key:
+            del self._times[i]
+
+    def window(self, t0: Optional[int] = None, t1: Optional[int] = None, limit: Optional[int] = None) -> List[dict]:
+        """Record con t0 <= t <= t1 (estremi facoltativi), nell'ordine di vista: O(log n + k)."""
+        with self.lock:
+            lo = 0 if t0 is None else bisect.bisect_left(self._times, (t0,))
+            hi = len(self._times) if t1 is None else bisect.bisect_left(self._times, (t1 + 1,))
+            sl = self._times[lo:hi]
+            if self.newest_first:
+                sl.reverse()
+            return [self._recs[k] for _, _, k in itertools.islice(sl, limit)]
+
+    def _unindex(self, key: str, rec: dict) -> None:
+        val = rec.get(self.index_field)
+        bucket = self._by.get(val)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del self._by[val]
+                self._unsorted.discard(val)
+
+    def _bucket(self, val) -> Dict[str, int]:
+        bucket = self._by.get(val) or {}
+        if val in self._unsorted:
+            bucket = self._by[val] = dict(sorted(bucket.items(), key=lambda kv: kv[1]))
+            self._unsorted.discard(val)
+        return bucket
+
+    def by(self, val) -> List[dict]:
+        """Record con index_field == val, nell'ordine di vista: O(record del valore)."""
+        with self.lock:
+            bucket = self._bucket(val)
+            keys = reversed(bucket) if self.newest_first else iter(bucket)
+            return [self._recs[k] for k in keys]
+
+    def count_by(self, val) -> int:
+        return len(self._by.get(val) or ())
+
+    def select(self, vals, limit: Optional[int] = None) -> List[dict]:
+        """Record di più valori dell'indice, fusi nell'ordine di vista (merge per posizione)."""
+        with self.lock:
+            its = []
+            for v in set(vals):
+                bucket = self._bucket(v)
+                its.append(reversed(bucket.items()) if self.newest_first else iter(bucket.items()))
+            merged = heapq.merge(*its, key=lambda kv: kv[1], reverse=self.newest_first)
+            return [self._recs[k] for k, _ in itertools.islice(merged, limit)]
+
+    def get(self, rec_id, default=None):
+        return self._recs.get(rec_id, default)
+
+    def has(self, rec_id) -> bool:
+        return rec_id in self._recs
+
+    def discard(self, rec_id) -> Optional[dict]:
+        with self.lock:
+            rec = self._recs.pop(rec_id, None)
+            if rec is not None and rec_id in self._pos:
+                pos = self._pos.pop(rec_id)
+                if self.index_field is not None:
+                    self._unindex(rec_id, rec)
+                if self.time_field is not None and isinstance(rec.get(self.time_field), (int, float)):
+                    self._untime(rec_id, rec.get(self.time_field), pos)
+            return rec
+
+    def remove_where(self, pred) -> None:
+        """Rimozione per condizione (es. squadra eliminata): O(n), per le operazioni rare."""
+        with self.lock:
+            for k in [k for k, r in self._recs.items() if pred(r)]:
+                self.discard(k)
+
+    def _view(self, rev: bool = False):
+        """Iteratore sul dict vivo, nell'ordine di vista (rev: al contrario). Solo sotto lock."""
+        vals = self._recs.values()
+        return reversed(vals) if self.newest_first != rev else iter(vals)
+
+    def snapshot(self) -> List[dict]:
+        """Copia dei record nell'ordine di vista: si scorre senza tenere il lock."""
+        with self.lock:
+            return list(self._view())
+
+    def __len__(self) -> int:
+        return len(self._recs)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __reversed__(self):
+        with self.lock:
+            return iter(list(self._view(rev=True)))
+
+    def __getitem__(self, i):
+        with self.lock:
+            n = len(self._recs)
+            if isinstance(i, slice):
+                start, stop, step = i.indices(n)
+                if step != 1:
+                    return list(self._view())[i]
+                return list(itertools.islice(self._view(), start, max(start, stop)))
+            if i < 0:
+                i += n
+            if not 0 <= i < n:
+                raise IndexError("RecordLog index out of range")
+            # dal lato più vicino: gli indici usati dalla UI sono quasi sempre in testa
+            if i < n // 2:
+                return next(itertools.islice(self._view(), i, None))
+            return next(itertools.islice(self._view(rev=True), n - 1 - i, None))
+
+    def __reduce__(self):
+        # pickle/hash di st.cache_data: contenuto nell'ordine di vista
+        return (RecordLog, (self.snapshot(), self.newest_first, self.index_field, self.time_field))
+
+    def __repr__(self) -> str:
+        return f"RecordLog({len(self)} record, newest_first={self.newest_first})"
+
+# collezioni del payload tenute come RecordLog: chiave -> (più recente per primo?, indice secondario, campo tempo).
+# Niente isinstance(x, RecordLog): a ogni rerun Streamlit ridefinisce la classe, mentre lo
+# store (cache_resource) tiene istanze create da un run precedente. Si distingue dalle liste.
+RECORD_LOGS = {"brogliaccio": (True, "tid", "t"), "inbox": (False, None, None), "reply_queue": (True, None, None)}
+# id dei messaggi già usciti dall'inbox (approvati/scartati), i più recenti INBOX_EVASI_MAX:
+# un ritentativo del telefono con lo stesso id non li fa ricomparire. Nel payload è una lista
+# (dal più vecchio), nello store un dict id -> None (appartenenza O(1), ordine di inserimento).
+INBOX_EVASI_MAX = 2000
+
+def _as_record_logs(payload: dict) -> dict:
+    """Liste del payload (formato data.json) -> RecordLog indicizzati, sul posto.
+    Gli eventi storici senza id lo ricevono qui (deterministico), a ogni caricamento.
+    """
+    _backfill_ids(payload)
+    for k, (newest_first, index_field, time_field) in RECORD_LOGS.items():
+        v = payload.get(k)
+        if v is None or isinstance(v, (list, tuple)):
+            payload[k] = RecordLog(v or [], newest_first=newest_first, index_field=index_field, time_field=time_field)
+    if not isinstance(payload.get("inbox_evasi"), dict):
+        payload["inbox_evasi"] = dict.fromkeys(payload.get("inbox_evasi") or [])
+    return payload
+
+def _as_record_lists(payload: dict) -> dict:
+    """Inverso di _as_record_logs: liste semplici, serializzabili così come sono."""
+    for k in RECORD_LOGS:
+        if payload.get(k) is not None and not isinstance(payload[k], list):
+            payload[k] = list(payload[k])
+    if isinstance(payload.get("inbox_evasi"), dict):
+        payload["inbox_evasi"] = list(payload["inbox_evasi"])
+    return payload
+
+class SharedStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data: dict = {}
+        self.loaded = False
+        self.rev = 0        # ogni mutazione/ricarica: le sessioni ricollegano i riferimenti
+        self.meta_rev = 0   # cambia solo con i dati evento/operatore (copiati nei widget di sessione)
+        self.ver = {c: 0 for c in COLLECTIONS}
+        self.saved = dict(self.ver)
+        self.frag: Dict[str, tuple] = {}
+        self.disk_stamp: Optional[tuple] = None  # ultimo stato su disco noto (scritto o letto da noi)
+        self.journal_pos: Optional[tuple] = None  # (stamp checkpoint, byte del journal già nello store)
+        self.feed = TeamFeed()  # novità per squadra (telefoni da campo)
+        self._team_idx: Optional[tuple] = None  # (versione teams, tid -> nome, vecchio nome -> nome)
+
+    def team_index(self) -> tuple:
+        """(tid -> nome attuale, nome storico -> nome attuale), ricalcolato solo se cambiano le squadre."""
+        with self.lock:
+            ver = self.ver["teams"]
+            if self._team_idx is None or self._team_idx[0] != ver:
+                teams = self.data.get("squadre") or {}
+                by_tid = {inf.get("tid"): name for name, inf in teams.items() if inf.get("tid")}
+                alias = {old: name for name, inf in teams.items() for old in (inf.get("nomi") or []) if old not in teams}
+                self._team_idx = (ver, by_tid, alias)
+            return self._team_idx[1], self._team_idx[2]
+
+    def replace(self, payload: dict) -> None:
+        """Nuovo contenuto completo (disco, backup, reset). Lo stato risulta già salvato."""
+        with self.lock:
+            _as_record_logs(payload)
+            for k in RECORD_LOGS:
+                payload[k].lock = self.lock  # letture delle sessioni e mutazioni di apply sullo stesso lock
+            payload.setdefault("squadre", {})
+            self.data = payload
+            self.feed.reset()
+            for c in COLLECTIONS:
+                self.ver[c] += 1
+            self.saved = dict(self.ver)
+            self.rev += 1
+            self.meta_rev += 1
+
+    def apply(self, ops: List[dict]) -> None:
+        with self.lock:
+            for op in ops:
+                _apply_op(self.data, op)
+                self.feed.record(self.data, op)
+                for c in _op_collections(op):
+                    self.ver[c] += 1
+                if op.get("op") == "meta_set":
+                    self.meta_rev += 1
+            self.rev += 1
+
+@st.cache_resource(show_spinner=False)
+def _shared_store(backend: str) -> SharedStore:
+    return SharedStore()
+
+def _store() -> SharedStore:
+    """Store del processo; al primo accesso carica i dati dal disco (una volta sola)."""
+    s = _shared_store(STORAGE_BACKEND)
+    if not s.loaded:
+        with _storage_lock():
+            if not s.loaded:
+                payload = _storage_read_locked()
+                if payload is not None:
+                    s.replace(payload)
+                s.disk_stamp, s.journal_pos = _storage_stamp(), _journal_pos()
+                s.loaded = True
+    return s
+
+# =========================
+# IDENTITÀ SQUADRA (tid)
+# =========================
+# Ogni squadra ha un id interno immutabile ("tid") e i nomi precedenti ("nomi") nell'anagrafica.
+# Gli eventi registrano tid + il nome in uso al momento: rinominare cambia UNA chiave
+# dell'anagrafica, il registro non si riscrive e il nome storico resta interrogabile.
+def _team_tid(name: str) -> str:
+    """tid deterministico per squadre storiche senza tid (ogni processo calcola lo stesso)."""
+    return "t-" + hashlib.sha1(str(name).encode("utf-8")).hexdigest()[:10]
+
+def _team_tids(squadre: dict) -> Dict[str, str]:
+    """nome (attuale o precedente) -> tid; il nome attuale vince su un nome storico uguale."""
+    out = {old: inf.get("tid") for inf in squadre.values() for old in (inf.get("nomi") or [])}
+    out.update({name: inf.get("tid") for name, inf in squadre.items()})
+    return out
+
+def _event_tid(ev: dict, tids: Dict[str, str]) -> Optional[str]:
+    """tid per un evento che non lo ha (storico o da op vecchie): squadra col nome registrato,
+    altrimenti il tid deterministico di quel nome (squadra eliminata). Senza squadra: None."""
+    sq = ev.get("sq")
+    if not sq:
+        return None
+    return tids.get(sq) or _team_tid(sq)
+
+def event_team(ev: dict, idx: Optional[tuple] = None) -> str:
+    """Nome ATTUALE della squadra di un evento (idx = _store().team_index() nei cicli)."""
+    by_tid, alias = idx or _store().team_index()
+    sq = ev.get("sq") or ""
+    return by_tid.get(ev.get("tid")) or alias.get(sq, sq)
+
+def _event_view(ev: dict, idx: Optional[tuple] = None) -> dict:
+    """Evento come lo vedono registro/mappa/report: squadra col nome attuale.
+    Copia solo se la squadra è stata rinominata dopo la registrazione."""
+    if not isinstance(ev, dict):
+        return ev
+    sq = ev.get("sq") or ""
+    cur = event_team(ev, idx)
+    if cur == sq:
+        return ev
+    out = dict(ev, sq=cur)
+    if str(ev.get("chi") or "").strip().upper() == sq:
+        out["chi"] = cur
+    return out
+
+def _event_views(events, idx: Optional[tuple] = None) -> List[dict]:
+    idx = idx or _store().team_index()
+    return [_event_view(e, idx) for e in events]
+
+# =========================
+# FEED SQUADRA (novità per i telefoni da campo)
+# =========================
+# Per ogni squadra solo ciò che la riguarda: chiamate/risposte della Sala, rapporti validati,
+# cambi di stato. Il telefono tiene un cursore "epoca:seq" e riceve solo le voci successive
+# (poche centinaia di byte) invece dell'intero stato. L'epoca cambia a ogni ricarica completa
+# dello store: un cursore di un'altra epoca riparte da un'istantanea ridotta della squadra.
+FEED_MAX_ITEMS = 50   # voci tenute per squadra
+FEED_TEXT_MAX = 280   # testo troncato: al campo basta il messaggio, non l'intero record
+
+def _feed_text(v: Any) -> str:
+    v = str(v or "").strip()
+    return v if len(v) <= FEED_TEXT_MAX else v[:FEED_TEXT_MAX - 1] + "…"
+
+def _feed_items_for_event(ev: dict, fields: Optional[dict] = None) -> List[dict]:
+    """Voci di feed per un evento del registro (nuovo, oppure aggiornato con fields)."""
+    chi = str(ev.get("chi") or "").strip().upper()
+    out = []
+    if fields is None:
+        ris = str(ev.get("ris") or "").strip()
+        if chi.startswith("SALA"):
+            out.append({"k": "sala", "id": ev.get("id"), "ora": ev.get("ora"), "msg": _feed_text(ev.get("mit")), "st": ev.get("st")})
+        elif ris.upper() == "VALIDATO":
+            out.append({"k": "ok", "id": ev.get("id"), "ora": ev.get("ora"), "msg": _feed_text(ev.get("mit"))})
+        if ris and ris.upper() != "VALIDATO":
+            out.append({"k": "ris", "id": ev.get("id"), "ora": ev.get("ris_ora") or ev.get("ora"), "msg": _feed_text(ris)})
+    elif str(fields.get("ris") or "").strip():
+        out.append({"k": "ris", "id": ev.get("id"), "ora": fields.get("ris_ora") or ev.get("ora"), "msg": _feed_text(fields.get("ris"))})
+    return out
 
-    sig = None
+class TeamFeed:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self._items: Dict[str, List[tuple]] = {}  # squadra -> [(seq, voce)] in ordine
+        self._dropped: Dict[str, int] = {}         # squadra -> seq dell'ultima voce scartata
+
+    def reset(self) -> None:
+        with self._lock:
+            self.epoch = uuid.uuid4().hex[:8]
+            self.seq = 0
+            self._items = {}
+            self._dropped = {}
+
+    def _push(self, team: str, item: dict) -> None:
+        self.seq += 1
+        lst = self._items.setdefault(team, [])
+        lst.append((self.seq, item))
+        if len(lst) > FEED_MAX_ITEMS:
+            self._dropped[team] = lst[-FEED_MAX_ITEMS - 1][0]
+            del lst[: len(lst) - FEED_MAX_ITEMS]
+
+    def record(self, data: dict, op: dict) -> None:
+        """Chiamato da SharedStore.apply dopo ogni mutazione (stesso lock dello store)."""
+        kind = op.get("op")
+        with self._lock:
+            if kind == "ev_add":
+                rec = op.get("rec") or {}
+                team = str(event_team(rec) or "").strip().upper()
+                for it in _feed_items_for_event(rec):
+                    self._push(team, it)
+            elif kind == "ev_set" and "ris" in (op.get("fields") or {}):
+                ev = data["brogliaccio"].get(op.get("id"))
+                if ev:
+                    for it in _feed_items_for_event(ev, op.get("fields") or {}):
+                        self._push(str(event_team(ev) or "").strip().upper(), it)
+            elif kind == "team_set" and "stato" in (op.get("fields") or {}):
+                self._push(op.get("name"), {"k": "stato", "st": (op.get("fields") or {}).get("stato")})
+            elif kind == "team_rename":
+                if op.get("old") in self._items:
+                    self._items[op.get("new")] = self._items.pop(op.get("old"))
+                if op.get("old") in self._dropped:
+                    self._dropped[op.get("new")] = self._dropped.pop(op.get("old"))
+            elif kind == "team_del":
+                self._items.pop(op.get("name"), None)
+                self._dropped.pop(op.get("name"), None)
+
+    def since(self, team: str, cursor: Optional[str]) -> Optional[tuple]:
+        """(cursore nuovo, voci successive) oppure None se il cursore è di un'altra epoca/troppo vecchio."""
+        with self._lock:
+            epoch, _, seq = str(cursor or "").partition(":")
+            lst = self._items.get(team, [])
+            try:
+                seq = int(seq)
+            except ValueError:
+                return None
+            if epoch != self.epoch or seq > self.seq or seq < self._dropped.get(team, 0):
+                return None
+            i = len(lst)
+            while i and lst[i - 1][0] > seq:  # di norma 0-2 voci nuove: si scorre dalla fine
+                i -= 1
+            return f"{self.epoch}:{self.seq}", [it for _, it in lst[i:]]
+
+def team_delta(team: str, cursor: Optional[str] = None, snapshot_max: int = 10) -> dict:
+    """Delta per il telefono della squadra: {"cursor", "reset", "stato", "items"}.
+    Con un cursore valido solo le voci nuove; altrimenti (primo accesso, riavvio server)
+    un'istantanea: stato attuale + ultime voci della squadra dal registro.
+    """
+    s = _store()
+    team = str(team or "").strip().upper()
+    with s.lock:
+        got = s.feed.since(team, cursor)
+        if got is not None:
+            cur, items = got
+            return {"cursor": cur, "reset": False, "items": items}
+        items: List[dict] = []
+        tid = (s.data.get("squadre", {}).get(team) or {}).get("tid")
+        for ev in (s.data["brogliaccio"].by(tid) if tid else ()):  # newest -> oldest, solo la squadra
+            items[:0] = _feed_items_for_event(ev)
+            if len(items) >= snapshot_max:
+                break
+        stato = (s.data.get("squadre", {}).get(team) or {}).get("stato")
+        return {"cursor": f"{s.feed.epoch}:{s.feed.seq}", "reset": True, "stato": stato, "items": items[-snapshot_max:]}
+
+def _bind_session(force: bool = False) -> None:
+    """Collega la sessione allo store: collezioni per riferimento, meta copiati (sono valori dei widget)."""
+    s = _store()
+    if not s.data:
+        return
+    if force or st.session_state.get("_store_rev") != s.rev:
+        with s.lock:
+            st.session_state.brogliaccio = s.data["brogliaccio"]
+            st.session_state.inbox = s.data["inbox"]
+            st.session_state.squadre = s.data["squadre"]
+            st.session_state.reply_queue = s.data["reply_queue"]
+            st.session_state["_store_rev"] = s.rev
+    if force or st.session_state.get("_store_meta_rev") != s.meta_rev:
+        # si copiano solo i campi cambiati nello store: una modifica locale non ancora salvata resta
+        cur = {k: s.data.get(k, META_DEFAULTS.get(k)) for k in META_KEYS}
+        cur["ev_data"] = cur.get("ev_data") or datetime.now().date().isoformat()
+        seen = {} if force else (st.session_state.get("_store_meta_seen") or {})
+        journaled = {} if force else dict(st.session_state.get("_meta_journaled") or {})
+        for k, v in cur.items():
+            if force or k not in seen or seen[k] != v:
+                _set_meta(st.session_state, k, v)
+                journaled[k] = v
+        st.session_state["_store_meta_seen"] = cur
+        st.session_state["_store_meta_rev"] = s.meta_rev
+        st.session_state["_meta_journaled"] = {k: journaled.get(k) for k in _meta_snapshot()}
+
+def _state_payload(cols=COLLECTIONS) -> dict:
+    """Payload (formato data.json) dallo store condiviso, limitato alle collezioni richieste."""
+    d = _store().data
+    out = {}
+    if "events" in cols:
+        out["brogliaccio"] = [dict(x, foto=_normalize_photo_obj(x.get("foto"))) for x in d.get("brogliaccio", [])]
+    if "inbox" in cols:
+        out["inbox"] = [dict(x, foto=_normalize_photo_obj(x.get("foto"))) for x in d.get("inbox", [])]
+        out["inbox_evasi"] = list(d.get("inbox_evasi") or [])
+    if "teams" in cols:
+        out["squadre"] = d.get("squadre", {})
+    if "meta" in cols:
+        out.update({k: d.get(k) for k in META_KEYS if k in d})
+    if "queue" in cols:
+        out["reply_queue"] = list(d.get("reply_queue") or [])
+    return out
+
+def _mark_dirty(*cols: str) -> None:
+    """Incrementa la versione delle collezioni modificate (nessun argomento = tutte)."""
+    s = _store()
+    with s.lock:
+        for c in (cols or COLLECTIONS):
+            s.ver[c] += 1
+
+def _mark_saved(ver: Optional[dict] = None) -> None:
+    s = _store()
+    s.saved = dict(ver if ver is not None else s.ver)
+
+def _dirty_collections() -> List[str]:
+    """Collezioni cambiate dall'ultimo salvataggio completo: confronto di contatori, O(1)."""
+    s = _store()
+    return [c for c in COLLECTIONS if s.ver[c] != s.saved.get(c, -1)]
+
+def _collection_fragment(col: str) -> str:
+    """JSON della collezione (membri dell'oggetto data.json), ricalcolato solo se la versione è cambiata."""
+    s = _store()
+    ver = s.ver[col]
+    hit = s.frag.get(col)
+    # meta (pochi campi) si riserializza sempre
+    if col != "meta" and hit is not None and hit[0] == ver:
+        return hit[1]
+    frag = json.dumps(_state_payload((col,)), ensure_ascii=False, separators=(",", ":"))[1:-1]
+    s.frag[col] = (ver, frag)
+    return frag
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+def _ms_from_dt_text(v: Any) -> Optional[int]:
+    """"YYYY-MM-DD HH:MM" / ISO (campo ts storico del modulo di modifica) -> epoch ms."""
     try:
-        sig_obj = {
-            "brogliaccio": [_entry_sig(x) for x in (payload.get("brogliaccio") or [])],
-            "inbox": [_entry_sig(x) for x in (payload.get("inbox") or [])],
-            "squadre": payload.get("squadre") or {},
-            "pos_mappa": payload.get("pos_mappa") or [],
-            "op_name": payload.get("op_name") or "",
-            "ev_data": payload.get("ev_data") or "",
-            "ev_tipo": payload.get("ev_tipo") or "",
-            "ev_nome": payload.get("ev_nome") or "",
-            "ev_desc": payload.get("ev_desc") or "",
-            "BASE_URL": payload.get("BASE_URL") or "",
-            "cnt_conclusi": payload.get("cnt_conclusi") or 0,
-        }
-        sig = hashlib.sha1(json.dumps(sig_obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
-    except Exception:
-        sig = None
+        return int(datetime.fromisoformat(str(v).strip().replace("Z", "+00:00")).timestamp() * 1000)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+def _ms_fmt(t: Any, fmt: str = "%Y-%m-%d %H:%M") -> str:
+    try:
+        return datetime.fromtimestamp(int(t) / 1000.0).strftime(fmt)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return ""
+
+def _backfill_times(rows: List[dict], day_iso: Any, start: Optional[tuple] = None) -> tuple:
+    """Epoch ms per i record storici che hanno solo "ora" (HH:MM), dal più vecchio al più recente.
+    Giorno di partenza = data evento; un'ora che torna indietro di oltre 6 ore è il giorno dopo
+    (passaggio della mezzanotte), un piccolo salto indietro è un messaggio approvato in ritardo.
+    start/ritorno: cursore (giorno, minuti) per proseguire la stessa linea temporale su altre righe."""
+    if start is not None:
+        day, prev = start
+    else:
+        try:
+            day = datetime.fromisoformat(str(day_iso)[:10])
+        except (TypeError, ValueError):
+            day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        prev = None
+    for r in rows:
+        if not isinstance(r, dict):
+            continue
+        t = r.get("t")
+        if not isinstance(t, (int, float)):
+            t = _ms_from_dt_text(r.get("ts")) if r.get("ts") else None
+        if t is None:
+            m = re.match(r"^(\d{1,2}):(\d{2})", str(r.get("ora") or ""))
+            if not m:
+                continue
+            mins = int(m.group(1)) * 60 + int(m.group(2))
+            if prev is not None and mins < prev - 360:
+                day += timedelta(days=1)
+            prev = mins
+            t = int((day + timedelta(minutes=mins)).timestamp() * 1000)
+            r["t"] = t
+            continue
+        r["t"] = int(t)
+        d = datetime.fromtimestamp(t / 1000.0)
+        day, prev = d.replace(hour=0, minute=0, second=0, microsecond=0), d.hour * 60 + d.minute
+    return day, prev
+
+def _backfill_ids(payload: dict) -> None:
+    """Id deterministici per eventi/messaggi storici senza id (e tid per le squadre, t per gli eventi).
+    Posizione contata dal fondo (stabile con gli inserimenti in testa) + hash contenuto:
+    ogni sessione calcola lo stesso id, così le modifiche nel journal ritrovano il record.
+    """
+    for name, inf in (payload.get("squadre") or {}).items():
+        if isinstance(inf, dict) and not inf.get("tid"):
+            inf["tid"] = _team_tid(name)
+    brog = payload.get("brogliaccio") or []
+    inbox = payload.get("inbox") or []
+    need_inbox = any(isinstance(r, dict) and not isinstance(r.get("t"), (int, float)) for r in inbox)
+    if need_inbox or any(isinstance(r, dict) and not isinstance(r.get("t"), (int, float)) for r in brog):
+        # una sola linea temporale: i messaggi in attesa sono successivi all'ultimo evento,
+        # quindi ne ereditano il giorno (mezzanotte già passata nel registro compresa)
+        cur = _backfill_times(list(reversed(list(brog))), payload.get("ev_data"))  # lista newest-first
+        if need_inbox:
+            _backfill_times(list(inbox), payload.get("ev_data"), cur)
+    tids = None
+    for ev in payload.get("brogliaccio") or []:
+        if isinstance(ev, dict) and ev.get("sq") and not ev.get("tid"):
+            tids = tids if tids is not None else _team_tids(payload.get("squadre") or {})
+            ev["tid"] = _event_tid(ev, tids)
+    for key, pref in (("brogliaccio", "ev"), ("inbox", "in")):
+        rows = payload.get(key) or []
+        n = len(rows)
+        for i, r in enumerate(rows):
+            if isinstance(r, dict) and not r.get("id"):
+                h = _hash_obj({k: v for k, v in r.items() if k != "foto"})[:10]
+                r["id"] = f"{pref}{n - 1 - i}-{h}"
+
+def _set_meta(data, key: str, value) -> None:
+    # in sessione la data evento è un oggetto date (widget), nel payload una stringa ISO
+    if key == "ev_data" and not isinstance(data, dict):
+        try:
+            value = datetime.fromisoformat(str(value)).date()
+        except Exception:
+            return
+    data[key] = value
 
-    if not force and sig is not None and st.session_state.get("_last_saved_sig") == sig:
+def _apply_op(data, op: dict) -> None:
+    """Applica UNA mutazione del journal a un payload con le collezioni come RecordLog
+    (store condiviso, replay del journal): ogni op per id è O(1).
+    """
+    kind = op.get("op")
+    # le op sono idempotenti per id: rigiocarle (merge tra processi, retry del writer) non duplica record
+    if kind == "ev_add":
+        rec = op.get("rec") or {}
+        if rec.get("sq") and not rec.get("tid"):
+            rec["tid"] = _event_tid(rec, _team_tids(data["squadre"]))  # op di prima dei tid
+        if not isinstance(rec.get("t"), (int, float)):
+            _backfill_times([rec], data.get("ev_data"))  # op di prima dei timestamp
+        data["brogliaccio"].add(rec)
+    elif kind in ("ev_set", "ev_put"):
+        ev = data["brogliaccio"].get(op.get("id"))
+        if ev is not None:
+            if kind == "ev_put":
+                rec = dict(op.get("rec") or {}, id=op.get("id"))
+                if rec.get("sq") and not rec.get("tid"):
+                    rec["tid"] = _event_tid(rec, _team_tids(data["squadre"]))
+                data["brogliaccio"].add(rec)
+            elif {"sq", "tid", "t"} & set(op.get("fields") or {}):
+                # cambia una chiave degli indici (squadra/tempo): si reinserisce (stessa posizione)
+                rec = dict(ev, **(op.get("fields") or {}))
+                if "tid" not in (op.get("fields") or {}):
+                    rec["tid"] = _event_tid(rec, _team_tids(data["squadre"]))
+                data["brogliaccio"].add(rec)
+            else:
+                ev.update(op.get("fields") or {})
+    elif kind == "inbox_add":
+        rec = op.get("rec") or {}
+        if not data["inbox"].has(rec.get("id")) and rec.get("id") not in data.setdefault("inbox_evasi", {}):
+            data["inbox"].add(rec)
+    elif kind == "inbox_del":
+        evasi = data.setdefault("inbox_evasi", {})
+        for i in op.get("ids") or []:
+            data["inbox"].discard(i)
+            evasi.pop(i, None)
+            evasi[i] = None
+        while len(evasi) > INBOX_EVASI_MAX:
+            del evasi[next(iter(evasi))]
+    elif kind == "team_add":
+        team = data["squadre"].setdefault(op.get("name"), {})
+        team.update(op.get("fields") or {})
+        team.setdefault("tid", _team_tid(op.get("name")))
+    elif kind == "team_set":
+        # solo squadre esistenti: un aggiornamento arrivato dopo un'eliminazione non la ricrea
+        team = data["squadre"].get(op.get("name"))
+        if team is not None:
+            team.update(op.get("fields") or {})
+            team.setdefault("tid", _team_tid(op.get("name")))
+    elif kind == "team_rename":
+        # il registro NON si tocca (gli eventi puntano al tid): solo anagrafica + messaggi in attesa
+        old, new = op.get("old"), op.get("new")
+        if old in data["squadre"] and new not in data["squadre"]:
+            team = data["squadre"][new] = data["squadre"].pop(old)
+            team.setdefault("tid", _team_tid(old))
+            team["nomi"] = [n for n in (team.get("nomi") or []) if n != new] + [old]
+            for msg in data["inbox"]:
+                if (msg.get("sq") or "").strip().upper() == old:
+                    msg["sq"] = new
+            for q in data["reply_queue"]:
+                if (q.get("sq") or "").strip().upper() == old:
+                    q["sq"] = new
+    elif kind == "team_del":
+        name = op.get("name")
+        data["squadre"].pop(name, None)
+        data["inbox"].remove_where(lambda m: (m.get("sq") or "").strip().upper() == name)
+    elif kind == "queue_add":
+        rec = op.get("rec") or {}
+        if not data["reply_queue"].has(rec.get("id")):
+            data["reply_queue"].add(rec)
+    elif kind == "queue_del":
+        data["reply_queue"].discard(op.get("id"))
+    elif kind == "meta_set":
+        for k, v in (op.get("fields") or {}).items():
+            _set_meta(data, k, v)
+
+def _status_ops(team: str, new_st: str) -> List[dict]:
+    """Cambio stato squadra (+ contatore 'conclusi' se entra in Intervento concluso)."""
+    ops = [{"op": "team_set", "name": team, "fields": {"stato": new_st}}]
+    prev_st = st.session_state.squadre.get(team, {}).get("stato")
+    if new_st == "Intervento concluso" and prev_st != "Intervento concluso":
+        ops.append({"op": "meta_set", "fields": {"cnt_conclusi": int(st.session_state.get("cnt_conclusi", 0) or 0) + 1}})
+    return ops
+
+def _journal_append(ops: List[dict]) -> bool:
+    """Accoda le mutazioni al journal con UN solo append. Oltre soglia compatta in data.json."""
+    if not ops:
+        return True
+    lines = []
+    for op in ops:
+        rec = op.get("rec")
+        if isinstance(rec, dict) and "foto" in rec:
+            op = dict(op, rec=dict(rec, foto=_normalize_photo_obj(rec.get("foto"))))
+        lines.append(json.dumps(op, ensure_ascii=False, separators=(",", ":")))
+    try:
+        with _storage_lock():
+            with open(JOURNAL_PATH, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+                _fsync_if_due(f)
+            size = os.path.getsize(JOURNAL_PATH)
+        if size >= JOURNAL_CHECKPOINT_BYTES:
+            _journal_checkpoint()
+        return True
+    except Exception:
         return False
 
+def _op_collections(op: dict) -> tuple:
+    kind = op.get("op") or ""
+    if kind == "team_rename":
+        return ("teams", "inbox", "queue")
+    if kind == "team_del":
+        return ("teams", "inbox")
+    return {"ev": ("events",), "inbox": ("inbox",), "team": ("teams",), "queue": ("queue",), "meta": ("meta",)}.get(kind.split("_")[0], ())
+
+def _store_commit(ops: List[dict], exclude: Optional[str] = None) -> bool:
+    """Applica le mutazioni allo store condiviso e le consegna al writer (journal / SQLite).
+    Non usa la sessione: la chiamano anche i thread dell'endpoint HTTP.
+    Ritorna False se il disco non è scrivibile (lo store resta comunque aggiornato).
+    """
+    s = _store()
     try:
-        tmp_path = DATA_PATH + ".tmp"
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
-        os.replace(tmp_path, DATA_PATH)
-        if sig is not None:
-            st.session_state["_last_saved_sig"] = sig
+        writer = _storage_writer(STORAGE_BACKEND)
+    except Exception:
+        writer = None
+    # senza writer si scrive in modo sincrono: il lock del disco va preso PRIMA di s.lock
+    with (_storage_lock() if writer is None else contextlib.nullcontext()), s.lock:
+        # nuovi eventi: tid della squadra, così un rename successivo non richiede di riscriverli;
+        # nuovi record: istante in epoch ms (ordinamento e finestre temporali anche su più giorni)
+        for op in ops:
+            rec = op.get("rec") if op.get("op") in ("ev_add", "ev_put", "inbox_add", "queue_add") else None
+            if isinstance(rec, dict) and not isinstance(rec.get("t"), (int, float)):
+                rec["t"] = _now_ms()
+            if op.get("op") not in ("ev_add", "ev_put"):
+                continue
+            if isinstance(rec, dict) and not rec.get("tid"):
+                tid = ((s.data.get("squadre") or {}).get(rec.get("sq")) or {}).get("tid")
+                if tid:
+                    rec["tid"] = tid
+        # stesso ordine nello store e verso il disco anche con più sessioni che scrivono insieme
+        s.apply(ops)
+        ok = _storage_submit(ops, writer)
+    cols = {c for op in ops for c in _op_collections(op)}
+    _change_watcher(STORAGE_BACKEND).bump(cols)
+    if any(c in PUSH_COLLECTIONS for c in cols):
+        _sala_push().notify(exclude=exclude)
+    return ok
+
+def _commit_ops(ops: List[dict]) -> bool:
+    """_store_commit dalla sessione corrente (che poi si ricollega allo store)."""
+    ok = _store_commit(ops, exclude=_current_session_id())
+    _bind_session()
+    return ok
+
+def _write_checkpoint(payload: dict) -> None:
+    """Scrive data.json (atomico) e riparte con un journal vuoto. Chiamare sotto _storage_lock()."""
+    _write_checkpoint_parts([json.dumps({k: v}, ensure_ascii=False, separators=(",", ":"))[1:-1]
+                             for k, v in payload.items() if k != "journal_gen"])
+
+def _write_checkpoint_parts(parts: List[str]) -> None:
+    """Come _write_checkpoint, ma da frammenti JSON già serializzati ('"chiave":valore')."""
+    gen = uuid.uuid4().hex
+    parts = [p for p in parts if p] + [json.dumps({"journal_gen": gen})[1:-1]]
+    tmp_path = DATA_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("{" + ",".join(parts) + "}")
+        if STORAGE_DURABILITY != "off":
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, DATA_PATH)
+    # header con la generazione: se il processo cade prima di questa riga, il vecchio journal
+    # (generazione diversa) viene ignorato al replay perché già incluso nel checkpoint
+    with open(JOURNAL_PATH, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"op": "hdr", "gen": gen}) + "\n")
+
+def _journal_replay(payload: dict, lines: List[str]) -> None:
+    gen = payload.get("journal_gen")
+    _as_record_logs(payload)
+    for line in lines:
+        try:
+            op = json.loads(line)
+        except Exception:
+            continue  # riga troncata (crash durante un append): si ignora
+        if op.get("op") == "hdr":
+            if gen and op.get("gen") != gen:
+                break  # journal già incluso nel checkpoint
+            continue
+        _apply_op(payload, op)
+    _as_record_lists(payload)
+
+def _read_disk_payload() -> Optional[dict]:
+    """Stato su disco = checkpoint (data.json) + replay del journal. None se non c'è nulla."""
+    payload = None
+    if os.path.exists(DATA_PATH):
+        try:
+            with open(DATA_PATH, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except Exception:
+            return None
+    lines = []
+    try:
+        if os.path.exists(JOURNAL_PATH):
+            with open(JOURNAL_PATH, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+    except Exception:
+        lines = []
+    if payload is None:
+        if not lines:
+            return None
+        payload = default_state_payload()
+    for k in ("brogliaccio", "inbox"):
+        payload.setdefault(k, [])
+    payload.setdefault("squadre", {})
+    _journal_replay(payload, lines)
+    if _externalize_photos(payload):
+        # dati legacy con foto incorporate: si riscrive il checkpoint una volta sola
+        try:
+            with _storage_lock():
+                _write_checkpoint(payload)
+        except Exception:
+            pass
+    return payload
+
+def _journal_checkpoint() -> bool:
+    """Compattazione: checkpoint + journal su disco -> nuovo data.json, journal svuotato."""
+    try:
+        with _storage_lock():
+            payload = _read_disk_payload()
+            if payload is None:
+                return False
+            _write_checkpoint(payload)
         return True
     except Exception:
         return False
 
-def load_data_from_disk():
-    if not os.path.exists(DATA_PATH):
+def _meta_snapshot() -> dict:
+    return {k: (str(st.session_state.get(k)) if k == "ev_data" else st.session_state.get(k))
+            for k in ("op_name", "ev_data", "ev_tipo", "ev_nome", "ev_desc")}
+
+def _journal_meta_if_changed() -> None:
+    """Dati evento/operatore modificati dai widget: una riga meta_set solo se cambiano."""
+    cur = _meta_snapshot()
+    last = st.session_state.get("_meta_journaled")
+    if last is None:
+        st.session_state["_meta_journaled"] = cur
+        return
+    changed = {k: v for k, v in cur.items() if last.get(k) != v}
+    if changed and _commit_ops([{"op": "meta_set", "fields": changed}]):
+        st.session_state["_meta_journaled"] = cur
+
+# =========================
+# STORAGE BACKEND (json | sqlite)
+# =========================
+# json   -> data.json (checkpoint) + journal (default, compatibile con le versioni precedenti)
+# sqlite -> data.sqlite in WAL: eventi, inbox, squadre e coda risposte come righe per id,
+#           ogni mutazione è una scrittura di poche righe + una riga in oplog (da cui gli altri
+#           processi leggono solo le novità). Le letture della UI usano lo store in memoria, quindi
+#           niente indici secondari: costerebbero solo in scrittura. Al primo avvio migra da data.json.
+# Scelta: secrets/env RM_STORAGE = "json" | "sqlite"
+STORAGE_BACKEND = (_setting("RM_STORAGE", "json") or "json").strip().lower()
+SQLITE_PATH = "data.sqlite"
+# Durabilità (RM_DURABILITY): "full" = fsync a ogni scrittura | "normal" = fsync al massimo
+# ogni FSYNC_INTERVAL_S (default) | "off" = decide il sistema operativo
+STORAGE_DURABILITY = (_setting("RM_DURABILITY", "normal") or "normal").strip().lower()
+FSYNC_INTERVAL_S = 1.0
+
+@st.cache_resource(show_spinner=False)
+def _fsync_state() -> dict:
+    return {"last": 0.0, "pending": set(), "lock": threading.Lock()}
+
+def _fsync_if_due(f) -> None:
+    """fsync del file aperto secondo STORAGE_DURABILITY. In "normal" una scrittura che arriva meno
+    di FSYNC_INTERVAL_S dopo l'ultimo fsync resta in sospeso: la sincronizza il writer a intervallo scaduto."""
+    if STORAGE_DURABILITY == "off":
+        return
+    now = time.monotonic()
+    state = _fsync_state()
+    if STORAGE_DURABILITY == "normal" and now - state["last"] < FSYNC_INTERVAL_S:
+        with state["lock"]:
+            state["pending"].add(os.path.abspath(f.name))
+        try:
+            _storage_writer(STORAGE_BACKEND).wake()
+        except Exception:
+            pass
+        return
+    f.flush()
+    os.fsync(f.fileno())
+    state["last"] = now
+
+def _fsync_deferred() -> Optional[float]:
+    """Dal writer a riposo: fsync dei file rimasti in sospeso appena scade l'intervallo.
+    Ritorna fra quanti secondi richiamarla (None = nulla in sospeso)."""
+    state = _fsync_state()
+    with state["lock"]:
+        if not state["pending"]:
+            return None
+        left = state["last"] + FSYNC_INTERVAL_S - time.monotonic()
+        if left > 0:
+            return left
+        paths, state["pending"] = state["pending"], set()
+        state["last"] = time.monotonic()
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                os.fsync(f.fileno())
+        except OSError:
+            pass
+    return None
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events(
+    id TEXT PRIMARY KEY, seq INTEGER NOT NULL, sq TEXT, st TEXT, ora TEXT, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS ix_events_seq ON events(seq);
+CREATE TABLE IF NOT EXISTS inbox(
+    id TEXT PRIMARY KEY, seq INTEGER NOT NULL, sq TEXT, ora TEXT, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS ix_inbox_seq ON inbox(seq);
+CREATE TABLE IF NOT EXISTS inbox_evasi(id TEXT PRIMARY KEY, seq INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS teams(
+    name TEXT PRIMARY KEY, stato TEXT, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS reply_queue(
+    id TEXT PRIMARY KEY, seq INTEGER NOT NULL, sq TEXT, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS oplog(seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL);
+DROP INDEX IF EXISTS ix_events_sq;
+DROP INDEX IF EXISTS ix_events_st;
+DROP INDEX IF EXISTS ix_events_ora;
+DROP INDEX IF EXISTS ix_inbox_sq;
+DROP INDEX IF EXISTS ix_teams_stato;
+DROP INDEX IF EXISTS ix_queue_sq;
+CREATE TABLE IF NOT EXISTS tracks(sq TEXT NOT NULL, t INTEGER NOT NULL, lat REAL NOT NULL, lon REAL NOT NULL, acc REAL);
+CREATE INDEX IF NOT EXISTS ix_tracks_sq_t ON tracks(sq, t);
+"""
+
+@st.cache_resource(show_spinner=False)
+def _sqlite_conn(path: str) -> sqlite3.Connection:
+    """Connessione condivisa dal processo (accesso serializzato da _storage_lock)."""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=" + {"full": "FULL", "off": "OFF"}.get(STORAGE_DURABILITY, "NORMAL"))
+    conn.executescript(SQLITE_SCHEMA)
+    return conn
+
+def _jdump(o: Any) -> str:
+    return json.dumps(o, ensure_ascii=False, separators=(",", ":"))
+
+def _sqlite_next_seq(cur: sqlite3.Cursor, table: str) -> int:
+    return int(cur.execute(f"SELECT COALESCE(MAX(seq), 0) + 1 FROM {table}").fetchone()[0])
+
+def _sqlite_set_json(cur: sqlite3.Cursor, table: str, key_col: str, key: str, fields: dict) -> None:
+    row = cur.execute(f"SELECT data FROM {table} WHERE {key_col}=?", (key,)).fetchone()
+    if row is None:
+        return
+    d = json.loads(row[0])
+    d.update(fields)
+    if table == "events":
+        cur.execute("UPDATE events SET data=?, sq=?, st=? WHERE id=?", (_jdump(d), d.get("sq"), d.get("st"), key))
+    else:
+        cur.execute(f"UPDATE {table} SET data=? WHERE {key_col}=?", (_jdump(d), key))
+
+def _sqlite_apply_op(cur: sqlite3.Cursor, op: dict) -> None:
+    """Stesse mutazioni di _apply_op, tradotte in scritture puntuali per riga."""
+    kind = op.get("op")
+    rec = op.get("rec") or {}
+    if kind == "ev_add":
+        cur.execute(
+            "INSERT INTO events(id, seq, sq, st, ora, data) VALUES(?,?,?,?,?,?) "
+            "ON CONFLICT(id) DO UPDATE SET sq=excluded.sq, st=excluded.st, ora=excluded.ora, data=excluded.data",
+            (rec.get("id"), _sqlite_next_seq(cur, "events"), rec.get("sq"), rec.get("st"), rec.get("ora"), _jdump(rec)),
+        )
+    elif kind == "ev_set":
+        _sqlite_set_json(cur, "events", "id", op.get("id"), op.get("fields") or {})
+    elif kind == "ev_put":
+        d = dict(rec, id=op.get("id"))
+        cur.execute("UPDATE events SET sq=?, st=?, ora=?, data=? WHERE id=?",
+                    (d.get("sq"), d.get("st"), d.get("ora"), _jdump(d), op.get("id")))
+    elif kind == "inbox_add":
+        if cur.execute("SELECT 1 FROM inbox_evasi WHERE id=?", (rec.get("id"),)).fetchone():
+            return
+        cur.execute(
+            "INSERT OR IGNORE INTO inbox(id, seq, sq, ora, data) VALUES(?,?,?,?,?)",
+            (rec.get("id"), _sqlite_next_seq(cur, "inbox"), rec.get("sq"), rec.get("ora"), _jdump(rec)),
+        )
+    elif kind == "inbox_del":
+        ids = list(op.get("ids") or [])
+        if ids:
+            cur.execute(f"DELETE FROM inbox WHERE id IN ({','.join('?' * len(ids))})", ids)
+            seq = _sqlite_next_seq(cur, "inbox_evasi")
+            cur.executemany("INSERT OR REPLACE INTO inbox_evasi(id, seq) VALUES(?,?)",
+                            [(i, seq + n) for n, i in enumerate(ids)])
+            cur.execute("DELETE FROM inbox_evasi WHERE seq <= ?", (seq + len(ids) - 1 - INBOX_EVASI_MAX,))
+    elif kind in ("team_add", "team_set"):
+        name = op.get("name")
+        row = cur.execute("SELECT data FROM teams WHERE name=?", (name,)).fetchone()
+        if row is None and kind == "team_set":
+            return
+        d = json.loads(row[0]) if row else {}
+        d.update(op.get("fields") or {})
+        d.setdefault("tid", _team_tid(name))
+        cur.execute(
+            "INSERT INTO teams(name, stato, data) VALUES(?,?,?) "
+            "ON CONFLICT(name) DO UPDATE SET stato=excluded.stato, data=excluded.data",
+            (name, d.get("stato"), _jdump(d)),
+        )
+    elif kind == "team_rename":
+        old, new = op.get("old"), op.get("new")
+        if cur.execute("SELECT 1 FROM teams WHERE name=?", (new,)).fetchone():
+            return
+        row = cur.execute("SELECT data FROM teams WHERE name=?", (old,)).fetchone()
+        if not row:
+            return
+        d = json.loads(row[0])
+        d.setdefault("tid", _team_tid(old))
+        d["nomi"] = [n for n in (d.get("nomi") or []) if n != new] + [old]
+        # events non si aggiorna: gli eventi puntano al tid (vedi IDENTITÀ SQUADRA)
+        cur.execute("UPDATE teams SET name=?, data=? WHERE name=?", (new, _jdump(d), old))
+        cur.execute("UPDATE inbox SET sq=?, data=json_set(data, '$.sq', ?) WHERE sq=?", (new, new, old))
+        cur.execute("UPDATE reply_queue SET sq=?, data=json_set(data, '$.sq', ?) WHERE sq=?", (new, new, old))
+    elif kind == "team_del":
+        cur.execute("DELETE FROM teams WHERE name=?", (op.get("name"),))
+        cur.execute("DELETE FROM inbox WHERE sq=?", (op.get("name"),))
+    elif kind == "queue_add":
+        cur.execute(
+            "INSERT OR IGNORE INTO reply_queue(id, seq, sq, data) VALUES(?,?,?,?)",
+            (rec.get("id"), _sqlite_next_seq(cur, "reply_queue"), rec.get("sq"), _jdump(rec)),
+        )
+    elif kind == "queue_del":
+        cur.execute("DELETE FROM reply_queue WHERE id=?", (op.get("id"),))
+    elif kind == "meta_set":
+        for k, v in (op.get("fields") or {}).items():
+            cur.execute("INSERT INTO meta(key, value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                        (k, _jdump(v)))
+
+SQLITE_OPLOG_MAX = 5000  # op tenute per gli altri processi; chi è rimasto più indietro rilegge tutto
+
+def _sqlite_write(ops: List[dict]) -> None:
+    """Una transazione per batch di mutazioni (+ oplog e revisione per il sync tra sessioni/processi)."""
+    conn = _sqlite_conn(SQLITE_PATH)
+    with _storage_lock():
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for op in ops:
+                _sqlite_apply_op(cur, op)
+            cur.executemany("INSERT INTO oplog(op) VALUES(?)", [(_jdump(op),) for op in ops])
+            cur.execute("DELETE FROM oplog WHERE seq <= (SELECT MAX(seq) FROM oplog) - ?", (SQLITE_OPLOG_MAX,))
+            cur.execute("INSERT INTO meta(key, value) VALUES('_rev', '1') "
+                        "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER) + 1")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+def _sqlite_save_full(payload: dict) -> None:
+    """Sostituisce le collezioni presenti nel payload (ripristino backup / reset / migrazione).
+    Le tabelle delle collezioni assenti dal payload restano invariate.
+    """
+    conn = _sqlite_conn(SQLITE_PATH)
+    with _storage_lock():
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for key, t in (("brogliaccio", "events"), ("inbox", "inbox"), ("inbox_evasi", "inbox_evasi"),
+                           ("squadre", "teams"), ("reply_queue", "reply_queue")):
+                if key in payload:
+                    cur.execute(f"DELETE FROM {t}")
+            brog = payload.get("brogliaccio") or []
+            cur.executemany(
+                "INSERT OR REPLACE INTO events(id, seq, sq, st, ora, data) VALUES(?,?,?,?,?,?)",
+                [(e.get("id"), len(brog) - i, e.get("sq"), e.get("st"), e.get("ora"), _jdump(e)) for i, e in enumerate(brog)],
+            )
+            cur.executemany(
+                "INSERT OR REPLACE INTO inbox(id, seq, sq, ora, data) VALUES(?,?,?,?,?)",
+                [(m.get("id"), i + 1, m.get("sq"), m.get("ora"), _jdump(m)) for i, m in enumerate(payload.get("inbox") or [])],
+            )
+            cur.executemany(
+                "INSERT OR REPLACE INTO inbox_evasi(id, seq) VALUES(?,?)",
+                [(i, n + 1) for n, i in enumerate(list(payload.get("inbox_evasi") or [])[-INBOX_EVASI_MAX:])],
+            )
+            cur.executemany(
+                "INSERT OR REPLACE INTO teams(name, stato, data) VALUES(?,?,?)",
+                [(n, (d or {}).get("stato"), _jdump(d or {})) for n, d in (payload.get("squadre") or {}).items()],
+            )
+            queue = payload.get("reply_queue") or []
+            cur.executemany(
+                "INSERT OR REPLACE INTO reply_queue(id, seq, sq, data) VALUES(?,?,?,?)",
+                [(q.get("id"), len(queue) - i, q.get("sq"), _jdump(q)) for i, q in enumerate(queue)],
+            )
+            skip = ("brogliaccio", "inbox", "inbox_evasi", "squadre", "reply_queue", "journal_gen")
+            cur.executemany(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES(?,?)",
+                [(k, _jdump(v)) for k, v in payload.items() if k not in skip],
+            )
+            # nuova generazione: l'oplog precedente non descrive più il contenuto (gli altri rileggono tutto)
+            cur.execute("DELETE FROM oplog")
+            cur.execute("INSERT OR REPLACE INTO meta(key, value) VALUES('_gen', ?)", (_jdump(uuid.uuid4().hex),))
+            cur.execute("INSERT INTO meta(key, value) VALUES('_rev', '1') "
+                        "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER) + 1")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+def _sqlite_read_payload() -> Optional[dict]:
+    conn = _sqlite_conn(SQLITE_PATH)
+    with _storage_lock():
+        meta = {k: json.loads(v) for k, v in conn.execute("SELECT key, value FROM meta") if k not in ("_rev", "_gen")}
+        if not meta and not conn.execute("SELECT 1 FROM teams LIMIT 1").fetchone():
+            return None
+        payload = dict(meta)
+        payload["brogliaccio"] = [json.loads(r[0]) for r in conn.execute("SELECT data FROM events ORDER BY seq DESC")]
+        payload["inbox"] = [json.loads(r[0]) for r in conn.execute("SELECT data FROM inbox ORDER BY seq")]
+        payload["inbox_evasi"] = [r[0] for r in conn.execute("SELECT id FROM inbox_evasi ORDER BY seq")]
+        payload["squadre"] = {n: json.loads(d) for n, d in conn.execute("SELECT name, data FROM teams ORDER BY rowid")}
+        payload["reply_queue"] = [json.loads(r[0]) for r in conn.execute("SELECT data FROM reply_queue ORDER BY seq DESC")]
+    return payload
+
+def migrate_json_to_sqlite() -> bool:
+    """Migrazione una tantum: data.json (+ journal) -> data.sqlite. data.json resta come copia."""
+    payload = _read_disk_payload()
+    if payload is None:
+        return False
+    _sqlite_save_full(payload)
+    _sqlite_write([{"op": "meta_set", "fields": {"migrated_from": DATA_PATH, "migrated_at": datetime.now().isoformat(timespec="seconds")}}])
+    return True
+
+def _storage_read() -> Optional[dict]:
+    # prima si attendono le scritture in coda di questo processo: la lettura le deve includere
+    _storage_flush()
+    with _storage_lock():
+        return _storage_read_locked()
+
+def _storage_read_locked() -> Optional[dict]:
+    if STORAGE_BACKEND == "sqlite":
+        payload = _sqlite_read_payload()
+        if payload is None and migrate_json_to_sqlite():
+            payload = _sqlite_read_payload()
+        return payload
+    return _read_disk_payload()
+
+def _storage_append(ops: List[dict]) -> bool:
+    if STORAGE_BACKEND == "sqlite":
+        try:
+            _sqlite_write(ops)
+            return True
+        except Exception:
+            return False
+    return _journal_append(ops)
+
+def _storage_save_full(payload: dict) -> None:
+    if STORAGE_BACKEND == "sqlite":
+        _sqlite_save_full(payload)
+        return
+    with _storage_lock():
+        _write_checkpoint(payload)
+
+def _storage_stamp() -> tuple:
+    """Cambia a ogni scrittura (di qualunque sessione/processo)."""
+    if STORAGE_BACKEND == "sqlite":
+        try:
+            row = _sqlite_conn(SQLITE_PATH).execute("SELECT value FROM meta WHERE key='_rev'").fetchone()
+            return ("sqlite", row[0] if row else None)
+        except Exception:
+            return ()
+    return _disk_stamp()
+
+def storage_events(teams: Optional[set] = None, limit: Optional[int] = None, keep_unassigned: bool = False,
+                   t0: Optional[int] = None, t1: Optional[int] = None) -> List[dict]:
+    """Eventi (newest -> oldest) filtrati per squadra, con il nome attuale della squadra.
+    Si legge sempre lo store in memoria (dati canonici, json e sqlite): il database può non
+    avere ancora le ultime scritture in coda al writer, e subito dopo _commit_ops c'è un rerun.
+    keep_unassigned: include anche gli eventi senza squadra (come il filtro del report).
+    Una squadra rinominata trova anche gli eventi registrati coi nomi precedenti; un nome
+    che non è più di nessuna squadra trova gli eventi registrati con quel nome (storico).
+    t0/t1 (epoch ms, estremi inclusi): finestra sull'indice temporale dello store (bisect);
+    gli eventi sono ordinati per istante, il più recente per primo.
+    """
+    idx = _store().team_index()
+    squadre = st.session_state.get("squadre") or {}
+
+    def _keep(e) -> bool:
+        if teams is None or not isinstance(e, dict):
+            return True
+        sq = e.get("sq")
+        if not sq:
+            return keep_unassigned
+        return event_team(e, idx) in teams or (sq in teams and sq not in squadre)
+
+    log = st.session_state.get("brogliaccio", [])
+    if (t0 is not None or t1 is not None) and hasattr(log, "window"):
+        out = []
+        for e in log.window(t0, t1):
+            if _keep(e):
+                out.append(_event_view(e, idx))
+                if limit and len(out) >= limit:
+                    break
+        return out
+
+    if teams is not None and hasattr(log, "select") and all(t in squadre for t in teams):
+        # indice per squadra: costo proporzionale agli eventi delle squadre richieste
+        keys = [(squadre.get(t) or {}).get("tid") for t in teams]
+        if keep_unassigned:
+            keys.append(None)
+        return [_event_view(e, idx) for e in log.select(keys, limit) if _keep(e)]
+    out = []
+    for e in log:
+        if not _keep(e):
+            continue
+        out.append(_event_view(e, idx))
+        if limit and len(out) >= limit:
+            break
+    return out
+
+# =========================
+# WRITER (thread di scrittura del processo)
+# =========================
+# _commit_ops non scrive più dentro il rerun: consegna il batch al writer e torna subito.
+# Il writer raggruppa le raffiche (es. più approvazioni in WRITE_COALESCE_S) in UNA scrittura,
+# ritenta con backoff se il disco non risponde e pubblica latenza/backlog per la UI.
+WRITE_COALESCE_S = 0.2
+WRITE_RETRY_MAX_S = 10.0
+
+class StorageWriter:
+    def __init__(self, write_fn, idle_fn=None):
+        self._write = write_fn
+        self._idle = idle_fn  # lavoro differito (fsync): ritorna fra quanti secondi richiamarla, o None
+        self._cv = threading.Condition()
+        self._queue: List[dict] = []
+        self._batch: List[dict] = []
+        self._inflight = 0
+        self._urgent = False
+        self.last_latency_ms: Optional[float] = None
+        self.last_error = ""
+        self.last_ok_ts: Optional[float] = None
+        self.writes = 0
+        self._thread = threading.Thread(target=self._run, name="rm-storage-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, ops: List[dict]) -> None:
+        with self._cv:
+            self._queue.extend(ops)
+            self._cv.notify_all()
+
+    def wake(self) -> None:
+        """Sveglia il thread (es. c'è un fsync da fare anche senza nuove scritture)."""
+        with self._cv:
+            self._cv.notify_all()
+
+    def backlog(self) -> int:
+        with self._cv:
+            return len(self._queue) + self._inflight
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Attende che tutto ciò che è in coda sia su disco (salta la finestra di coalescenza)."""
+        deadline = time.monotonic() + timeout
+        with self._cv:
+            self._urgent = True
+            self._cv.notify_all()
+            while self._queue or self._inflight:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cv.wait(left)
+        return True
+
+    def pending(self) -> List[dict]:
+        """Mutazioni già nello store ma non ancora su disco (batch in scrittura + coda), in ordine."""
+        with self._cv:
+            return list(self._batch) + list(self._queue)
+
+    def stats(self) -> dict:
+        with self._cv:
+            return {
+                "backlog": len(self._queue) + self._inflight,
+                "latency_ms": self.last_latency_ms,
+                "error": self.last_error,
+                "last_ok": self.last_ok_ts,
+                "writes": self.writes,
+            }
+
+    def _run(self) -> None:
+        delay = 0.0
+        while True:
+            wait = None
+            if self._idle is not None:
+                try:
+                    wait = self._idle()
+                except Exception:
+                    wait = None
+            with self._cv:
+                if not self._queue:
+                    self._cv.wait(wait)
+                    continue
+                deadline = time.monotonic() + max(WRITE_COALESCE_S, delay)
+                while not self._urgent:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cv.wait(left)
+                batch, self._queue = self._queue, []
+                self._batch = batch
+                self._inflight = len(batch)
+                self._urgent = False
+            t0 = time.monotonic()
+            err = ""
+            try:
+                ok = bool(self._write(batch))
+            except Exception as e:
+                ok, err = False, str(e)
+            with self._cv:
+                self._inflight = 0
+                self._batch = []
+                if ok:
+                    self.writes += 1
+                    self.last_latency_ms = (time.monotonic() - t0) * 1000.0
+                    self.last_ok_ts = time.time()
+                    self.last_error = ""
+                    delay = 0.0
+                else:
+                    # il batch torna in testa: l'ordine delle mutazioni resta quello di invio
+                    self._queue = batch + self._queue
+                    self.last_error = err or "scrittura su disco non riuscita"
+                    delay = min(WRITE_RETRY_MAX_S, max(0.5, delay * 2))
+                self._cv.notify_all()
+
+@st.cache_resource(show_spinner=False)
+def _storage_writer(backend: str) -> StorageWriter:
+    return StorageWriter(_storage_append_stamped, _fsync_deferred)
+
+def _storage_append_stamped(ops: List[dict]) -> bool:
+    """Scrittura del writer: sotto il lock tra processi recupera prima le scritture altrui, poi accoda
+    le proprie e aggiorna la posizione nota (così le nostre scritture non causano ricariche).
+    """
+    s = _shared_store(STORAGE_BACKEND)
+    with _storage_lock():
+        _catch_up_foreign(s)
+        ok = _storage_append(ops)
+        if ok:
+            s.disk_stamp, s.journal_pos = _storage_stamp(), _journal_pos()
+    return ok
+
+def _journal_pos() -> Optional[tuple]:
+    """(stamp del checkpoint, dimensione del journal): fin dove il journal è già nello store.
+    sqlite: (generazione, ultima seq dell'oplog)."""
+    if STORAGE_BACKEND == "sqlite":
+        try:
+            conn = _sqlite_conn(SQLITE_PATH)
+            gen = conn.execute("SELECT value FROM meta WHERE key='_gen'").fetchone()
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM oplog").fetchone()[0]
+            return (gen[0] if gen else None, int(seq))
+        except Exception:
+            return None
+    stamp = _disk_stamp()
+    return (stamp[0], stamp[1][1] if stamp[1] else 0)
+
+def _sqlite_oplog_from(pos: tuple) -> Optional[tuple]:
+    """Op dell'oplog dopo pos -> (ops, nuova pos). None se è cambiata la generazione o le op
+    successive a pos sono già state potate: serve una rilettura completa."""
+    conn = _sqlite_conn(SQLITE_PATH)
+    gen = conn.execute("SELECT value FROM meta WHERE key='_gen'").fetchone()
+    if (gen[0] if gen else None) != pos[0]:
+        return None
+    rows = conn.execute("SELECT seq, op FROM oplog WHERE seq > ? ORDER BY seq", (pos[1],)).fetchall()
+    if rows and rows[0][0] != pos[1] + 1:
+        return None
+    ops = []
+    for _seq, line in rows:
+        try:
+            ops.append(json.loads(line))
+        except Exception:
+            continue
+    return ops, (pos[0], rows[-1][0] if rows else pos[1])
+
+def _journal_read_from(offset: int) -> Optional[tuple]:
+    """Righe complete del journal da offset in poi -> (ops, nuovo offset). None se il journal è stato riscritto."""
+    try:
+        size = os.path.getsize(JOURNAL_PATH)
+    except OSError:
+        return None
+    if size < offset:
+        return None
+    with open(JOURNAL_PATH, "rb") as f:
+        f.seek(offset)
+        tail = f.read(size - offset)
+    end = tail.rfind(b"\n") + 1
+    ops = []
+    for line in tail[:end].splitlines():
+        try:
+            op = json.loads(line)
+        except Exception:
+            continue
+        if op.get("op") != "hdr":
+            ops.append(op)
+    return ops, offset + end
+
+def _catch_up_foreign(s: "SharedStore") -> tuple:
+    """Sotto _storage_lock(): porta lo store al passo con le scritture di ALTRI processi.
+    json: si applicano solo le righe del journal dopo la nostra posizione (op idempotenti per id),
+    le liste restano le stesse e le sessioni non ricaricano nulla; sqlite: allo stesso modo le
+    righe dell'oplog dopo la nostra seq;
+    nuovo checkpoint / salvataggio completo altrui: rilettura completa, poi si riapplicano le nostre op non ancora scritte.
+    Ritorna le collezioni toccate.
+    """
+    if not s.loaded or not s.data:
+        return ()
+    stamp = _storage_stamp()
+    if stamp == s.disk_stamp:
+        return ()
+    cols = None
+    pos = s.journal_pos
+    if STORAGE_BACKEND == "sqlite" and pos is not None:
+        got = _sqlite_oplog_from(pos)
+        if got is not None:
+            ops, s.journal_pos = got
+            s.apply(ops)
+            cols = {c for op in ops for c in _op_collections(op)}
+    elif pos is not None and stamp[0] == pos[0]:
+        got = _journal_read_from(pos[1])
+        if got is not None:
+            ops, offset = got
+            s.apply(ops)
+            cols = {c for op in ops for c in _op_collections(op)}
+            s.journal_pos = (pos[0], offset)
+    if cols is None:
+        payload = _storage_read_locked()
+        if payload is None:
+            return ()
+        s.replace(payload)
+        s.apply(_storage_writer(STORAGE_BACKEND).pending())
+        cols = set(COLLECTIONS)
+        s.journal_pos = _journal_pos()
+    s.disk_stamp = stamp
+    if cols:
+        _change_watcher(STORAGE_BACKEND).bump(cols)
+        if any(c in PUSH_COLLECTIONS for c in cols):
+            _sala_push().notify()
+    return tuple(cols)
+
+def _ops_snapshot(ops: List[dict]) -> List[dict]:
+    """Copia serializzata delle mutazioni al momento dell'invio: i rec delle op sono gli stessi dict
+    dello store, che le sessioni continuano a modificare (ev.update) mentre il batch attende il writer."""
+    out = []
+    for op in ops:
+        rec = op.get("rec")
+        if isinstance(rec, dict) and "foto" in rec:
+            op = dict(op, rec=dict(rec, foto=_normalize_photo_obj(rec.get("foto"))))
+        out.append(json.loads(_jdump(op)))
+    return out
+
+def _storage_submit(ops: List[dict], writer: Optional["StorageWriter"] = None) -> bool:
+    """Consegna le mutazioni al writer; senza writer scrittura sincrona (il chiamante tiene già
+    _storage_lock(), preso prima di SharedStore.lock)."""
+    if not ops:
+        return True
+    ops = _ops_snapshot(ops)
+    if writer is not None:
+        writer.submit(ops)
+        return True
+    return _storage_append(ops)
+
+def _storage_flush(timeout: float = 5.0) -> bool:
+    try:
+        return _storage_writer(STORAGE_BACKEND).flush(timeout)
+    except Exception:
+        return True
+
+def storage_writer_stats() -> dict:
+    try:
+        return _storage_writer(STORAGE_BACKEND).stats()
+    except Exception:
+        return {"backlog": 0, "latency_ms": None, "error": "", "last_ok": None, "writes": 0}
+
+def save_data_to_disk(force: bool = False, merge: bool = True) -> bool:
+    """Salvataggio completo (checkpoint) veloce + atomico.
+    Le modifiche puntuali passano da _commit_ops (journal); questo serve per
+    ripristino backup, reset, salvataggio manuale.
+    Senza force si scrive solo se qualche collezione è cambiata, e si riserializzano solo quelle.
+    merge=False (ripristino/reset): il contenuto dello store sostituisce quello su disco.
+    """
+    dirty = _dirty_collections()
+    if not force and not dirty:
         return False
+    # le mutazioni ancora in coda vanno su disco prima del checkpoint (altrimenti verrebbero rigiocate dopo)
+    _storage_flush()
+    s = _store()
     try:
-        with open(DATA_PATH, "r", encoding="utf-8") as f:
-            payload = json.load(f)
+        with _storage_lock():
+            # merge con il disco: prima entrano nello store le scritture di altri processi
+            if merge:
+                _catch_up_foreign(s)
+            with s.lock:
+                ver = dict(s.ver)
+                if STORAGE_BACKEND == "sqlite":
+                    _sqlite_save_full(_state_payload(COLLECTIONS if force else dirty))
+                else:
+                    _write_checkpoint_parts([_collection_fragment(c) for c in COLLECTIONS])
+                s.disk_stamp, s.journal_pos = _storage_stamp(), _journal_pos()
+        _mark_saved(ver)
+        return True
     except Exception:
         return False
 
-    st.session_state.brogliaccio = payload.get("brogliaccio", [])
-    st.session_state.inbox = payload.get("inbox", [])
-    st.session_state.squadre = payload.get("squadre", default_state_payload()["squadre"])
-    st.session_state.pos_mappa = payload.get("pos_mappa", [45.7075, 11.4772])
-    st.session_state.op_name = payload.get("op_name", "")
-    st.session_state.ev_data = datetime.fromisoformat(payload.get("ev_data", datetime.now().date().isoformat())).date()
-    st.session_state.ev_tipo = payload.get("ev_tipo", "Emergenza")
-    st.session_state.ev_nome = payload.get("ev_nome", "")
-    st.session_state.ev_desc = payload.get("ev_desc", "")
-    st.session_state.BASE_URL = payload.get("BASE_URL", "") or ""
-    st.session_state.cnt_conclusi = int(payload.get("cnt_conclusi", 0) or 0)
+def _install_payload(payload: dict) -> None:
+    """Sostituisce i dati condivisi (tutte le sessioni) e ricollega questa sessione."""
+    payload.setdefault("squadre", default_state_payload()["squadre"])
+    _store().replace(payload)
+    _bind_session(force=True)
+
+def load_data_from_disk():
+    """Ricarica dal disco lo store condiviso (vale per tutte le sessioni del processo)."""
+    s = _store()
+    _storage_flush()
+    with _storage_lock():
+        payload = _storage_read_locked()
+        if payload is None:
+            return False
+        s.replace(payload)
+        s.disk_stamp, s.journal_pos = _storage_stamp(), _journal_pos()
+    _bind_session(force=True)
     ensure_inbox_ids()
     return True
 
+def _store_sync() -> tuple:
+    """Scritture di un ALTRO processo: di norma le ha già applicate il ChangeWatcher; se il rerun
+    arriva prima, si recupera qui la coda del journal dal cursore dello store (mai un reload completo).
+    """
+    s = _store()
+    if not s.loaded or _storage_stamp() == s.disk_stamp:
+        return ()
+    with _storage_lock():
+        return _catch_up_foreign(s)
+
+def _disk_stamp() -> tuple:
+    """(mtime, size) di checkpoint e journal: cambia a ogni scrittura su disco."""
+    out = []
+    for p in (DATA_PATH, JOURNAL_PATH):
+        try:
+            s = os.stat(p)
+            out.append((s.st_mtime, s.st_size))
+        except OSError:
+            out.append(None)
+    return tuple(out)
+
 # =========================
-# AUTO-REFRESH smart (solo nuovi eventi + pausa durante scrittura)
+# CHANGE WATCHER (contatori di modifica per collezione)
 # =========================
-def _disk_events_signature() -> str:
-    """Firma leggera degli eventi (inbox+brogliaccio) letta da disco.
-    Serve per capire se sono arrivati nuovi eventi senza rifare render pesanti.
-    """
+# Un solo thread per processo osserva checkpoint/journal (o il database SQLite): inotify via
+# watchdog se installato, altrimenti controllo periodico di mtime/size. Mantiene un contatore
+# crescente per collezione: l'auto-refresh confronta interi invece di rileggere data.json.
+try:
+    from watchdog.observers import Observer  # type: ignore
+    from watchdog.events import FileSystemEventHandler  # type: ignore
+except Exception:
+    Observer = None
+    FileSystemEventHandler = object
+
+WATCH_POLL_S = 1.0
+
+class _WatchHandler(FileSystemEventHandler):
+    def __init__(self, names: set, wake: threading.Event):
+        self._names = names
+        self._wake = wake
+
+    def on_any_event(self, event):
+        for p in (getattr(event, "src_path", ""), getattr(event, "dest_path", "")):
+            if p and os.path.basename(str(p)) in self._names:
+                self._wake.set()
+                return
+
+class ChangeWatcher:
+    def __init__(self, backend: str):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.counters = {c: 0 for c in COLLECTIONS}
+        self.foreign = 0  # scritture di un altro processo viste finora
+        self._wake = threading.Event()
+        self._stamp = _storage_stamp()
+        self.mode = "poll"
+        if Observer is not None:
+            try:
+                names = {os.path.basename(p) for p in (DATA_PATH, JOURNAL_PATH, SQLITE_PATH, SQLITE_PATH + "-wal")}
+                self._observer = Observer()
+                self._observer.daemon = True
+                self._observer.schedule(_WatchHandler(names, self._wake), os.path.dirname(os.path.abspath(DATA_PATH)), recursive=False)
+                self._observer.start()
+                self.mode = "inotify"
+            except Exception:
+                self.mode = "poll"
+        threading.Thread(target=self._run, name="rm-change-watcher", daemon=True).start()
+
+    def bump(self, cols) -> None:
+        with self._lock:
+            for c in cols:
+                self.counters[c] = self.counters.get(c, 0) + 1
+
+    def counter(self, cols=COLLECTIONS) -> int:
+        with self._lock:
+            return sum(self.counters.get(c, 0) for c in cols)
+
+    def _run(self) -> None:
+        while True:
+            # con inotify il timeout è solo una rete di sicurezza
+            if self._wake.wait(WATCH_POLL_S if self.mode == "poll" else 10 * WATCH_POLL_S):
+                time.sleep(0.05)  # l'evento arriva durante la scrittura: si lascia finire il commit
+            self._wake.clear()
+            try:
+                self._check()
+            except Exception:
+                pass
+
+    def _check(self) -> None:
+        """Scrittura altrui: lo store la integra subito (coda del journal), contatori e push inclusi."""
+        # confronto senza lock (stat del file / una riga di meta): il lock tra processi si prende
+        # solo quando il disco è davvero cambiato, non a ogni giro di polling
+        stamp = _storage_stamp()
+        if stamp == self._stamp:
+            return
+        s = _shared_store(self.backend)
+        if stamp == s.disk_stamp:
+            self._stamp = stamp  # scrittura nostra: già contata
+            return
+        with _storage_lock():
+            stamp = _storage_stamp()
+            if stamp == self._stamp:
+                return
+            self._stamp = stamp
+            # scrittura nostra (writer/checkpoint aggiornano disk_stamp sotto lo stesso lock): già contata
+            if stamp == s.disk_stamp:
+                return
+            _catch_up_foreign(s)
+        with self._lock:
+            self.foreign += 1
+
+@st.cache_resource(show_spinner=False)
+def _change_watcher(backend: str) -> ChangeWatcher:
+    return ChangeWatcher(backend)
+
+def change_counter(cols=("inbox", "events")) -> int:
+    """Contatore crescente delle modifiche (questo processo + altri processi) alle collezioni indicate."""
     try:
-        if not os.path.exists(DATA_PATH):
-            return "no-data"
-        with open(DATA_PATH, "r", encoding="utf-8") as f:
-            payload = json.load(f) or {}
-        inbox = payload.get("inbox", []) or []
-        brog = payload.get("brogliaccio", []) or []
-        last_in = (inbox[-1].get("id") if inbox else "") or ""
-        last_br = (brog[-1].get("id") if brog else "") or ""
-        # include anche le lunghezze per robustezza
-        return f"i{len(inbox)}:{last_in}|b{len(brog)}:{last_br}"
+        return _change_watcher(STORAGE_BACKEND).counter(cols)
     except Exception:
-        return "sig-err"
+        return -1
+
+# =========================
+# PUSH SALA (risveglio immediato delle console)
+# =========================
+# Le console iscritte vengono rieseguite appena cambia inbox/registro (nuovo rapporto dal campo,
+# approvazione da un'altra postazione): niente st_autorefresh, una console ferma non fa rerun.
+# Usa il runtime di Streamlit (API interne): se non disponibile resta l'auto-refresh classico.
+PUSH_COLLECTIONS = ("inbox", "events")
+
+def _current_session_id() -> Optional[str]:
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        return ctx.session_id if ctx else None
+    except Exception:
+        return None
+
+class SalaPush:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs: set = set()
+
+    @staticmethod
+    def _session_mgr():
+        try:
+            from streamlit.runtime import Runtime
+            if not Runtime.exists():
+                return None
+            return getattr(Runtime.instance(), "_session_mgr", None)
+        except Exception:
+            return None
+
+    def available(self) -> bool:
+        return self._session_mgr() is not None
+
+    def subscribe(self, session_id: Optional[str]) -> None:
+        if session_id:
+            with self._lock:
+                self._subs.add(session_id)
+
+    def unsubscribe(self, session_id: Optional[str]) -> None:
+        with self._lock:
+            self._subs.discard(session_id)
+
+    def notify(self, exclude: Optional[str] = None) -> int:
+        """Richiede un rerun alle sessioni iscritte (tranne quella che ha fatto la modifica)."""
+        mgr = self._session_mgr()
+        if mgr is None:
+            return 0
+        with self._lock:
+            subs = [s for s in self._subs if s != exclude]
+        woken = 0
+        for sid in subs:
+            try:
+                info = mgr.get_active_session_info(sid)
+                if info is None:
+                    self.unsubscribe(sid)  # tab chiusa
+                    continue
+                sess = info.session
+                loop = getattr(sess, "_event_loop", None)
+                if loop is not None:
+                    loop.call_soon_threadsafe(sess.request_rerun, None)
+                else:
+                    sess.request_rerun(None)
+                woken += 1
+            except Exception:
+                continue
+        return woken
+
+@st.cache_resource(show_spinner=False)
+def _sala_push() -> SalaPush:
+    return SalaPush()
+
+# =========================
+# TRACCE GPS (separate dal registro)
+# =========================
+# Il tracciamento dal telefono manda punti a blocchi (non messaggi): finiscono in tracks.jsonl
+# (una riga per punto) o nella tabella tracks di SQLite, mai in inbox/registro, e non
+# toccano il journal né i contatori dello store.
+# In memoria una serie temporale per squadra (TrackSeries): array compatti paralleli
+# (tempo ms, lat, lon, precisione) in ordine di tempo, solo in coda. Ultima posizione in O(1),
+# intervalli di tempo con bisect, senza scorrere il registro dei messaggi.
+TRACKS_PATH = "tracks.jsonl"
+TRACK_MAX_BATCH = 500          # punti massimi per invio
+TRACK_MIN_DIST_M = 25          # campionamento sul telefono: spostamento minimo...
+TRACK_MIN_INTERVAL_S = 10      # ...e intervallo minimo tra due punti
+TRACK_MAX_INTERVAL_S = 120     # da fermi: un punto ogni 2 minuti comunque
+TRACK_UPLOAD_S = 30            # invio dei punti accumulati
+TRACK_LIVE_MINUTES = 120       # tracce mostrate sulla mappa della Sala
+TRACK_REPORT_MAX_POINTS = 2000 # punti per squadra nel report (si dirada oltre)
+TRACK_RETENTION_DAYS = 7       # punti più vecchi scartati alla compattazione
+TRACK_COMPACT_BYTES = 16 * 1024 * 1024  # json: tracks.jsonl oltre questa dimensione si compatta
+TRACK_PRUNE_ROWS = 50000       # sqlite: potatura ogni tante righe nuove
+TRACK_TID_RE = re.compile(r"t-[0-9a-f]{10}")  # chiave delle serie (i nomi squadra sono maiuscoli)
+
+class TrackSeries:
+    """Serie temporale di una squadra: ~32 byte a punto invece di una tupla/dict Python."""
+    __slots__ = ("t", "lat", "lon", "acc")
+
+    def __init__(self):
+        self.t = array("q")
+        self.lat = array("d")
+        self.lon = array("d")
+        self.acc = array("f")  # NaN = precisione sconosciuta
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def add(self, t: int, lat: float, lon: float, acc: Optional[float]) -> bool:
+        a = float("nan") if acc is None else acc
+        if not self.t or t > self.t[-1]:  # caso normale: in coda
+            self.t.append(t); self.lat.append(lat); self.lon.append(lon); self.acc.append(a)
+            return True
+        i = bisect.bisect_left(self.t, t)
+        if i < len(self.t) and self.t[i] == t:
+            return False  # stesso fix rimandato (ritentativo del telefono)
+        self.t.insert(i, t); self.lat.insert(i, lat); self.lon.insert(i, lon); self.acc.insert(i, a)
+        return True
+
+    def drop_before(self, t0: int) -> int:
+        """Toglie i punti con t < t0 (retention); ritorna quanti ne restano."""
+        i = bisect.bisect_left(self.t, t0)
+        if i:
+            del self.t[:i]; del self.lat[:i]; del self.lon[:i]; del self.acc[:i]
+        return len(self.t)
+
+    def has(self, t: int) -> bool:
+        i = bisect.bisect_left(self.t, t)
+        return i < len(self.t) and self.t[i] == t
+
+    def latest(self) -> Optional[tuple]:
+        if not self.t:
+            return None
+        acc = self.acc[-1]
+        return self.t[-1], self.lat[-1], self.lon[-1], (None if acc != acc else float(acc))
+
+    def window(self, t0: Optional[int] = None, t1: Optional[int] = None) -> Tuple[int, int]:
+        """Indici [i, j) dei punti con t0 <= t <= t1."""
+        i = bisect.bisect_left(self.t, t0) if t0 is not None else 0
+        j = bisect.bisect_right(self.t, t1) if t1 is not None else len(self.t)
+        return i, j
+
+    def line(self, t0: Optional[int] = None, t1: Optional[int] = None, max_points: int = 0) -> List[List[float]]:
+        """Polilinea [[lat, lon], ...] nell'intervallo, diradata a max_points (0 = tutti)."""
+        i, j = self.window(t0, t1)
+        step = max(1, -(-(j - i) // max_points)) if max_points else 1
+        out = [[self.lat[k], self.lon[k]] for k in range(i, j, step)]
+        if step > 1 and j > i and (j - 1 - i) % step:
+            out.append([self.lat[j - 1], self.lon[j - 1]])  # l'ultimo punto resta sempre
+        return out
+
+class TrackStore:
+    def __init__(self, backend: str):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._series: Dict[str, TrackSeries] = {}  # tid -> serie: un rename non spezza la traccia
+        self._legacy: Dict[str, str] = {}  # nome (righe di prima dei tid) -> tid
+        self._stamp: Optional[tuple] = None  # file visto all'ultima lettura (_disk_stamp)
+        self._offset = 0   # json: byte di tracks.jsonl già letti
+        self._ino = None   # json: file riscritto dalla compattazione (anche di un altro processo)
+        self._compact_at = TRACK_COMPACT_BYTES
+        self._rowid = 0    # sqlite: ultima riga letta
+        self._minrow = 0   # sqlite: prima riga rimasta; se sale, qualcuno ha potato
+        self._pruned = 0   # sqlite: ultima riga alla potatura precedente
+
+    def _key(self, sq: str) -> str:
+        """tid della serie; le righe di prima dei tid hanno il nome della squadra di allora."""
+        if TRACK_TID_RE.fullmatch(sq):
+            return sq
+        tid = self._legacy.get(sq)
+        if tid is None:
+            s = _store()
+            with s.lock:
+                tid = _team_tids(s.data.get("squadre") or {}).get(sq) or _team_tid(sq)
+            self._legacy[sq] = tid
+        return tid
+
+    def _insert(self, sq: str, p: tuple) -> bool:
+        tid = self._key(sq)
+        s = self._series.get(tid)
+        if s is None:
+            s = self._series[tid] = TrackSeries()
+        return s.add(*p)
+
+    def _reset(self) -> None:
+        self._series = {}
+        self._offset = self._rowid = 0
+
+    def _disk_stamp(self) -> tuple:
+        """(inode, mtime, size) dei file delle tracce: cambia a ogni scrittura, nostra o di altri processi."""
+        out = []
+        for p in ((SQLITE_PATH, SQLITE_PATH + "-wal") if self.backend == "sqlite" else (TRACKS_PATH,)):
+            try:
+                s = os.stat(p)
+                out.append((s.st_ino, s.st_mtime_ns, s.st_size))
+            except OSError:
+                out.append(None)
+        return tuple(out)
+
+    def _refresh(self) -> None:
+        """Legge solo le righe nuove (nostre o di altri processi). Chiamare con _storage_lock() e self._lock."""
+        self._stamp = self._disk_stamp()
+        if self.backend == "sqlite":
+            conn = _sqlite_conn(SQLITE_PATH)
+            first, last = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM tracks").fetchone()
+            if (first or 0) > self._minrow or (last or 0) < self._rowid:
+                self._reset()  # righe vecchie potate (o tabella svuotata): si rilegge quel che resta
+            self._minrow = first or 0
+            rows = conn.execute(
+                "SELECT rowid, sq, t, lat, lon, acc FROM tracks WHERE rowid > ? ORDER BY rowid", (self._rowid,)).fetchall()
+            for rid, sq, t, lat, lon, acc in rows:
+                self._insert(sq, (int(t), float(lat), float(lon), acc))
+                self._rowid = rid
+            return
+        try:
+            st_ = os.stat(TRACKS_PATH)
+        except OSError:
+            return
+        if st_.st_ino != self._ino:
+            if self._ino is not None:
+                self._reset()  # compattato: il file nuovo si rilegge da capo
+            self._ino = st_.st_ino
+        if st_.st_size <= self._offset:
+            return
+        with open(TRACKS_PATH, "rb") as f:
+            f.seek(self._offset)
+            tail = f.read(st_.st_size - self._offset)
+        end = tail.rfind(b"\n") + 1
+        self._offset += end
+        for line in tail[:end].splitlines():
+            try:
+                r = json.loads(line)
+                self._insert(r["sq"], (int(r["t"]), float(r["lat"]), float(r["lon"]), r.get("acc")))
+            except Exception:
+                continue
+
+    def _sync(self) -> None:
+        """Letture della UI: il lock del file solo se i file sono cambiati dall'ultima lettura."""
+        if self._disk_stamp() != self._stamp:
+            with _storage_lock(), self._lock:
+                self._refresh()
+
+    def _retain(self) -> int:
+        """Scarta dalla memoria i punti più vecchi di TRACK_RETENTION_DAYS; ritorna il limite (ms)."""
+        cutoff = _now_ms() - TRACK_RETENTION_DAYS * 86400 * 1000
+        for tid in list(self._series):
+            if not self._series[tid].drop_before(cutoff):
+                del self._series[tid]
+        return cutoff
+
+    def _compact(self) -> None:
+        """Come il checkpoint del journal: tracks.jsonl riscritto (atomico) con i soli punti
+        conservati e le chiavi già per tid. Chiamare con _storage_lock() e self._lock, dopo _refresh()."""
+        self._retain()
+        tmp_path = TRACKS_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for tid, s in self._series.items():
+                f.write("".join(json.dumps({"sq": tid, "t": s.t[k], "lat": s.lat[k], "lon": s.lon[k],
+                                            "acc": None if s.acc[k] != s.acc[k] else round(float(s.acc[k]), 1)},
+                                           separators=(",", ":")) + "\n" for k in range(len(s))))
+            if STORAGE_DURABILITY != "off":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, TRACKS_PATH)
+        st_ = os.stat(TRACKS_PATH)
+        self._ino, self._offset = st_.st_ino, st_.st_size
+        self._compact_at = max(TRACK_COMPACT_BYTES, 2 * st_.st_size)  # costo ammortizzato anche se resta tutto
+        self._stamp = self._disk_stamp()
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        """SQLite: righe più vecchie di TRACK_RETENTION_DAYS eliminate, righe col nome portate al tid.
+        Chiamare con _storage_lock() e self._lock, dopo _refresh()."""
+        cutoff = self._retain()
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM tracks WHERE t < ?", (cutoff,))
+        conn.executemany("UPDATE tracks SET sq=? WHERE sq=?", [(tid, sq) for sq, tid in self._legacy.items()])
+        conn.execute("COMMIT")
+        self._minrow = conn.execute("SELECT MIN(rowid) FROM tracks").fetchone()[0] or 0
+        self._pruned = self._rowid
+        self._stamp = self._disk_stamp()
+
+    def add(self, tid: str, points: List[tuple]) -> int:
+        """Accoda i punti (t_ms, lat, lon, acc) della squadra tid con UNA scrittura; i doppioni vengono scartati."""
+        with _storage_lock(), self._lock:
+            self._refresh()
+            s = self._series.get(tid)
+            new = sorted({p[0]: p for p in points if not (s is not None and s.has(p[0]))}.values())
+            if not new:
+                return 0
+            if self.backend == "sqlite":
+                conn = _sqlite_conn(SQLITE_PATH)
+                conn.execute("BEGIN")
+                conn.executemany("INSERT INTO tracks(sq, t, lat, lon, acc) VALUES(?,?,?,?,?)", [(tid,) + p for p in new])
+                conn.execute("COMMIT")
+                self._refresh()
+                if self._rowid - self._pruned >= TRACK_PRUNE_ROWS:
+                    self._prune(conn)
+            else:
+                lines = [json.dumps({"sq": tid, "t": p[0], "lat": p[1], "lon": p[2], "acc": p[3]},
+                                    separators=(",", ":")) for p in new]
+                with open(TRACKS_PATH, "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+                    _fsync_if_due(f)
+                self._refresh()
+                if self._offset >= self._compact_at:
+                    self._compact()
+            return len(new)
+
+    def latest(self) -> Dict[str, tuple]:
+        """Ultima posizione di ogni squadra (per tid): O(1) per squadra."""
+        self._sync()
+        with self._lock:
+            return {sq: s.latest() for sq, s in self._series.items() if len(s)}
+
+    def lines(self, t0: Optional[int] = None, t1: Optional[int] = None, max_points: int = 0) -> Dict[str, List[List[float]]]:
+        """Polilinee per squadra (per tid) nell'intervallo di tempo (ms)."""
+        self._sync()
+        with self._lock:
+            return {sq: s.line(t0, t1, max_points) for sq, s in self._series.items()}
+
+@st.cache_resource(show_spinner=False)
+def _track_store(backend: str) -> TrackStore:
+    return TrackStore(backend)
+
+def track_add(team: str, raw: List[Any]) -> int:
+    """Punti dal telefono: [[t_ms, lat, lon, acc], ...] -> numero di punti nuovi salvati."""
+    pts = []
+    for r in raw[:TRACK_MAX_BATCH]:
+        try:
+            t, lat, lon = int(r[0]), float(r[1]), float(r[2])
+            acc = float(r[3]) if len(r) > 3 and r[3] is not None else None
+        except (TypeError, ValueError, IndexError, OverflowError):
+            continue
+        if acc is not None and not math.isfinite(acc):
+            acc = None
+        if _valid_latlon(lat, lon) and t > 0:
+            pts.append((t, lat, lon, acc))
+    if not pts:
+        return 0
+    s = _store()
+    with s.lock:
+        tid = (s.data.get("squadre", {}).get(team) or {}).get("tid") or _team_tid(team)
+    return _track_store(STORAGE_BACKEND).add(tid, pts)
+
+def _by_current_team(d: Dict[str, Any]) -> Dict[str, Any]:
+    """Chiavi tid -> nome attuale della squadra (risolto solo qui, in lettura);
+    le tracce di squadre eliminate non hanno più un nome e restano fuori."""
+    by_tid = _store().team_index()[0]
+    return {by_tid[tid]: v for tid, v in d.items() if tid in by_tid}
+
+def live_tracks(minutes: int = TRACK_LIVE_MINUTES) -> Dict[str, List[List[float]]]:
+    """Tracce recenti per squadra come polilinee [[lat, lon], ...] per la mappa."""
+    since = int((time.time() - minutes * 60) * 1000)
+    return _by_current_team({sq: ln for sq, ln in _track_store(STORAGE_BACKEND).lines(since).items() if len(ln) >= 2})
+
+def live_positions(minutes: int = TRACK_LIVE_MINUTES) -> Dict[str, List[float]]:
+    """Ultima posizione tracciata per squadra (solo se recente): [lat, lon]."""
+    since = int((time.time() - minutes * 60) * 1000)
+    return _by_current_team({sq: [p[1], p[2]] for sq, p in _track_store(STORAGE_BACKEND).latest().items() if p[0] >= since})
+
+def report_tracks(day_iso: Optional[str], t0: Optional[int] = None, t1: Optional[int] = None) -> Dict[str, List[List[float]]]:
+    """Percorsi per squadra nel giorno dell'evento (per il report), diradati.
+    Con una finestra temporale (t0/t1 epoch ms) si usa quella al posto del giorno."""
+    if t0 is not None or t1 is not None:
+        t0, t1 = t0 or 0, t1 or _now_ms()
+    else:
+        try:
+            d0 = datetime.fromisoformat(str(day_iso)[:10])
+        except (TypeError, ValueError):
+            return {}
+        t0 = int(d0.timestamp() * 1000)
+        t1 = int((d0 + timedelta(days=1)).timestamp() * 1000) - 1
+    lines = _track_store(STORAGE_BACKEND).lines(t0, t1, TRACK_REPORT_MAX_POINTS)
+    return _by_current_team({sq: ln for sq, ln in lines.items() if len(ln) >= 2})
+
+# =========================
+# ENDPOINT CAMPO (HTTP leggero, accanto a Streamlit)
+# =========================
+# I telefoni possono inviare rapporti senza una sessione Streamlit: un piccolo server HTTP
+# (stdlib, un thread per richiesta) scrive direttamente nell'inbox dello store condiviso.
+#   POST /api/campo/invio    {"team","token","msg","pos":[lat,lon],"foto":{"b64","name","type"},"id","t"}
+#                            oppure {"team","token","items":[{...}, ...]}: coda del telefono in UNA scrittura
+#   GET  /api/campo/novita?team=..&token=..&cursor=..   -> team_delta()
+#   POST /api/campo/traccia  {"team","token","points":[[t_ms, lat, lon, acc], ...]}  -> store tracce
+#   GET  /api/stato
+# Autenticazione: token della squadra (lo stesso del link QR), nel corpo o nell'header X-RM-Token.
+# Porta con RM_INGEST_PORT (default 8502); RM_INGEST_PORT = 0 lo disattiva.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INGEST_PORT = _int_setting("RM_INGEST_PORT", 8502)
+INGEST_MAX_BYTES = 12 * 1024 * 1024  # corpo JSON massimo (foto in base64 comprese)
+_log = logging.getLogger("radio_manager")
+FIELD_BATCH_MAX = 50                 # messaggi massimi per invio in blocco
+
+def _field_auth_error(team: str, token: str) -> str:
+    """"" se il token è valido per la squadra, altrimenti il motivo (stesse regole del link QR)."""
+    info = (_store().data.get("squadre") or {}).get(team)
+    expected = str((info or {}).get("token") or "")
+    # confronto a tempo costante: l'endpoint è raggiungibile dalla rete
+    if not expected or not token or not hmac.compare_digest(str(token).encode("utf-8"), expected.encode("utf-8")):
+        return "squadra o token non validi"
+    exp = (info.get("token_expires_at") or "").strip()
+    if exp:
+        try:
+            if datetime.now() > datetime.fromisoformat(exp):
+                return "token scaduto"
+        except Exception:
+            pass
+    return ""
+
+FIELD_T_MAX_SKEW_MS = 24 * 3600 * 1000  # orario del telefono oltre un giorno da quello del server: non attendibile
+
+def _field_item_t(item: dict) -> Optional[int]:
+    """Istante del messaggio sul telefono (epoch ms) da "t" (epoch ms o ISO); None se assente o
+    non plausibile (orologio del telefono sballato): in quel caso vale l'ora di arrivo."""
+    t = item.get("t")
+    out = None
+    try:
+        if isinstance(t, (int, float)) and not isinstance(t, bool) and math.isfinite(t):
+            out = int(t)
+        elif isinstance(t, str) and t.strip():
+            out = int(datetime.fromisoformat(t.strip().replace("Z", "+00:00")).timestamp() * 1000)
+    except (ValueError, OverflowError, OSError):
+        return None
+    if out is None or abs(out - _now_ms()) > FIELD_T_MAX_SKEW_MS:
+        return None
+    return out
+
+def _valid_latlon(lat: float, lon: float) -> bool:
+    """Coordinate serializzabili e nel range (NaN/inf renderebbero invalido il JSON su disco)."""
+    return math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180
+
+def _field_item_ora(item: dict) -> str:
+    """Ora del messaggio sul telefono: "t" (epoch ms o ISO) oppure "ora" HH:MM; altrimenti adesso."""
+    t = _field_item_t(item)
+    if t is not None:
+        return _ms_fmt(t, "%H:%M")
+    return str(item.get("ora") or "").strip()[:5] or datetime.now().strftime("%H:%M")
+
+def _field_inbox_rec(team: str, item: dict) -> dict:
+    """Record inbox da un invio del campo (HTTP). L'id del client rende idempotenti i ritentativi."""
+    pos = item.get("pos")
+    try:
+        pos = [float(pos[0]), float(pos[1])] if isinstance(pos, (list, tuple)) and len(pos) == 2 else None
+    except (TypeError, ValueError):
+        pos = None
+    if pos is not None and not _valid_latlon(*pos):
+        pos = None
+    foto = item.get("foto")
+    # dal campo solo byte (b64), sempre ricalcolati nello store: un "ref" del client non si accetta
+    foto = _normalize_photo_obj({k: foto.get(k) for k in ("b64", "name", "type")}) \
+        if isinstance(foto, dict) and foto.get("b64") else None
+    rid = str(item.get("id") or "").strip()
+    return {
+        "id": rid[:64] if re.fullmatch(r"[A-Za-z0-9_-]{8,64}", rid) else uuid.uuid4().hex,
+        "ora": _field_item_ora(item),
+        "t": _field_item_t(item) or _now_ms(),
+        "sq": team,
+        "msg": str(item.get("msg") or "").strip() or "Aggiornamento posizione",
+        "foto": foto,
+        "pos": pos,
+    }
+
+def field_submit(team: str, items: List[dict]) -> Tuple[List[str], bool]:
+    """Invio in blocco dal campo: tutti i messaggi (nell'ordine dato) in UNA mutazione dello store
+    e UNA scrittura su disco, invece di un salvataggio per messaggio. -> (ids, salvato)."""
+    recs = [_field_inbox_rec(team, it) for it in items]
+    saved = _store_commit([{"op": "inbox_add", "rec": r} for r in recs])
+    return [r["id"] for r in recs], bool(saved)
+
+class _IngestHandler(BaseHTTPRequestHandler):
+    server_version = "RadioManagerIngest/1"
+
+    def log_message(self, format, *args):  # niente log per richiesta su stderr
+        pass
+
+    def _send(self, code: int, body: dict) -> None:
+        raw = json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(raw)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_OPTIONS(self):
+        # preflight CORS: la pagina del campo sta sulla porta di Streamlit
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-RM-Token")
+        self.send_header("Access-Control-Max-Age", "86400")
+        self.end_headers()
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        q = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        if url.path == "/api/stato":
+            return self._send(200, {"ok": True, "backend": STORAGE_BACKEND})
+        if url.path == "/api/campo/novita":
+            team = (q.get("team") or "").strip().upper()
+            err = _field_auth_error(team, q.get("token") or self.headers.get("X-RM-Token") or "")
+            if err:
+                return self._send(401, {"ok": False, "error": err})
+            return self._send(200, dict(team_delta(team, q.get("cursor")), ok=True))
+        return self._send(404, {"ok": False, "error": "percorso sconosciuto"})
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path not in ("/api/campo/invio", "/api/campo/traccia"):
+            return self._send(404, {"ok": False, "error": "percorso sconosciuto"})
+        try:
+            n = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            n = 0
+        if n <= 0 or n > INGEST_MAX_BYTES:
+            return self._send(413 if n > INGEST_MAX_BYTES else 400, {"ok": False, "error": "corpo mancante o troppo grande"})
+        try:
+            body = json.loads(self.rfile.read(n).decode("utf-8"))
+            if not isinstance(body, dict):
+                raise ValueError("atteso un oggetto JSON")
+        except Exception as e:
+            return self._send(400, {"ok": False, "error": f"JSON non valido: {e}"})
+        team = str(body.get("team") or "").strip().upper()
+        err = _field_auth_error(team, str(body.get("token") or self.headers.get("X-RM-Token") or ""))
+        if err:
+            return self._send(401, {"ok": False, "error": err})
+        if path == "/api/campo/traccia":
+            pts = body.get("points")
+            if not isinstance(pts, list) or len(pts) > TRACK_MAX_BATCH:
+                return self._send(400, {"ok": False, "error": f"points: al massimo {TRACK_MAX_BATCH} punti"})
+            try:
+                return self._send(200, {"ok": True, "n": track_add(team, pts)})
+            except Exception:
+                _log.exception("ingest: traccia %s non salvata", team)
+                return self._send(500, {"ok": False, "error": "errore interno"})
+        items = body.get("items") if "items" in body else [body]
+        if not isinstance(items, list) or not items or len(items) > FIELD_BATCH_MAX \
+                or not all(isinstance(it, dict) for it in items):
+            return self._send(400, {"ok": False, "error": f"items: da 1 a {FIELD_BATCH_MAX} oggetti"})
+        try:
+            ids, saved = field_submit(team, items)
+        except Exception:
+            # il dettaglio (percorsi, eccezioni) resta nel log del server, non va al client
+            _log.exception("ingest: invio %s non registrato", team)
+            return self._send(500, {"ok": False, "error": "errore interno"})
+        if "items" in body:
+            return self._send(200, {"ok": True, "ids": ids, "saved": saved})
+        return self._send(200, {"ok": True, "id": ids[0], "saved": saved})
+
+@st.cache_resource(show_spinner=False)
+def _ingest_server(port: int) -> Optional[ThreadingHTTPServer]:
+    """Avvia (una volta per processo) il server HTTP del campo. None se la porta è occupata/disattivata."""
+    if not port:
+        return None
+    try:
+        srv = ThreadingHTTPServer(("0.0.0.0", port), _IngestHandler)
+    except OSError:
+        return None
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="rm-ingest-http", daemon=True).start()
+    return srv
+
+try:
+    _ingest_server(INGEST_PORT)
+except Exception:
+    pass
+
+# =========================
+# CODA OFFLINE DEL TELEFONO (browser)
+# =========================
+# Se il telefono perde la rete, la sessione Streamlit non riceve più nulla: i rapporti restano
+# nel localStorage del browser (testo, GPS, foto compressa) e partono in blocco verso
+# /api/campo/invio appena torna la connessione, con ritentativi a intervalli crescenti.
+# Dietro HTTPS/proxy impostare RM_INGEST_URL (es. https://host/rm-ingest), altrimenti si usa
+# lo stesso host della pagina sulla porta RM_INGEST_PORT.
+INGEST_PUBLIC_URL = str(_setting("RM_INGEST_URL", "") or "").strip().rstrip("/")
+# Compressione della foto SUL TELEFONO (canvas) prima dell'invio: sul 3G di valle il collo di
+# bottiglia è l'upload. Preset: (etichetta, lato lungo px, qualità JPEG).
+FIELD_PHOTO_PRESETS = {
+    "3g": ("📶 Rete lenta", 1024, 0.6),
+    "std": ("⚖️ Standard", 1280, 0.7),
+    "hq": ("🔍 Dettaglio", 1920, 0.85),
+}
+FIELD_PHOTO_PRESET_DEFAULT = "std"
+FIELD_UPLOAD_BUDGET_BYTES = 1_500_000  # un invio in blocco non supera ~1,5 MB (resta veloce anche in 3G)
+
+_FIELD_QUEUE_HTML = """
+<style>
+  body { margin:0; font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; }
+  .q-card { border:1px solid rgba(128,128,128,.35); border-radius:14px; padding:10px 12px; }
+  .q-hud { display:flex; justify-content:space-between; align-items:center; gap:8px; font-weight:800; margin-bottom:8px; }
+  .q-pill { padding:3px 10px; border-radius:999px; background:rgba(128,128,128,.15); font-size:.85rem; }
+  .q-err { color:#c92a2a; font-size:.8rem; min-height:1em; }
+  textarea { width:100%; box-sizing:border-box; border-radius:12px; padding:8px; font-size:1rem; min-height:64px; }
+  .q-row { display:flex; gap:8px; align-items:center; flex-wrap:wrap; margin:6px 0; font-size:.9rem; }
+  button { width:100%; padding:12px; border-radius:14px; border:0; font-weight:800; font-size:1rem; background:#e03131; color:#fff; }
+  button:disabled { opacity:.6; }
+</style>
+<div class="q-card">
+  <div class="q-hud"><span>📴 Coda invii del telefono</span><span class="q-pill" id="q_depth">…</span></div>
+  <textarea id="q_msg" placeholder="Messaggio (parte anche senza rete)"></textarea>
+  <div class="q-row">
+    <label><input type="checkbox" id="q_gps" checked> 📍 GPS</label>
+    <input type="file" id="q_foto" accept="image/*" capture="environment">
+  </div>
+  <div class="q-row">
+    <label>📷 Qualità <select id="q_preset"></select></label>
+    <span id="q_size"></span>
+  </div>
+  <button id="q_send">📥 ACCODA E INVIA</button>
+  <div class="q-err" id="q_err"></div>
+</div>
+<script>
+(function(){
+  const CFG = __CFG__;
+  const KEY = "rm_field_queue_" + CFG.team;
+  const BATCH = CFG.batch;
+  let sending = false, backoff = 0, timer = null;
+
+  function endpoint(){
+    if (CFG.url) return CFG.url + "/api/campo/invio";
+    let loc = window.location;
+    try { loc = window.parent.location; } catch (e) {}
+    return loc.protocol + "//" + loc.hostname + ":" + CFG.port + "/api/campo/invio";
+  }
+  function load(){ try { return JSON.parse(localStorage.getItem(KEY) || "[]"); } catch (e) { return []; } }
+  function save(q){
+    try { localStorage.setItem(KEY, JSON.stringify(q)); return true; }
+    catch (e) { return false; }  // quota piena
+  }
+  function setErr(t){ document.getElementById("q_err").textContent = t || ""; }
+  function render(extra){
+    const n = load().length;
+    const txt = n ? ("⏳ " + n + " in coda" + (extra ? " · " + extra : "")) : "✅ coda vuota";
+    document.getElementById("q_depth").textContent = txt;
+    // anche nell'HUD in alto della pagina, se raggiungibile
+    try {
+      const el = window.parent.document.getElementById("rm-field-queue-pill");
+      if (el) el.textContent = "📴 Coda: " + n;
+    } catch (e) {}
+  }
+  function uid(){ return Date.now().toString(36) + Math.random().toString(36).slice(2, 10); }
+
+  function gps(){
+    return new Promise((res) => {
+      if (!document.getElementById("q_gps").checked || !navigator.geolocation) return res(null);
+      navigator.geolocation.getCurrentPosition(
+        (p) => res([p.coords.latitude, p.coords.longitude]),
+        () => res(null),
+        { enableHighAccuracy: true, timeout: 8000, maximumAge: 60000 });
+    });
+  }
+  // --- compressione foto nel browser (canvas), con preset scelto e dimensione finale visibile ---
+  const K_PRESET = "rm_field_photo_preset";
+  const sel = document.getElementById("q_preset");
+  for (const [k, p] of Object.entries(CFG.presets)) {
+    const o = document.createElement("option"); o.value = k; o.textContent = p[0]; sel.appendChild(o);
+  }
+  sel.value = CFG.presets[localStorage.getItem(K_PRESET)] ? localStorage.getItem(K_PRESET) : CFG.preset;
+  let compressed = null;  // Promise della foto compressa con il preset corrente
+
+  function kb(n){ return n >= 1048576 ? (n / 1048576).toFixed(1) + " MB" : Math.round(n / 1024) + " KB"; }
+  function compress(f, preset){
+    const p = CFG.presets[preset] || CFG.presets[CFG.preset];
+    return new Promise((res) => {
+      const img = new Image();
+      img.onload = () => {
+        const k = Math.min(1, p[1] / Math.max(img.width, img.height));
+        const c = document.createElement("canvas");
+        c.width = Math.round(img.width * k); c.height = Math.round(img.height * k);
+        c.getContext("2d").drawImage(img, 0, 0, c.width, c.height);
+        const data = c.toDataURL("image/jpeg", p[2]);
+        URL.revokeObjectURL(img.src);
+        const b64 = data.split(",")[1];
+        res({ b64: b64, name: (f.name || "foto").replace(/\\.[^.]+$/, "") + ".jpg", type: "image/jpeg",
+              bytes: Math.floor(b64.length * 3 / 4) });
+      };
+      img.onerror = () => res(null);
+      img.src = URL.createObjectURL(f);
+    });
+  }
+  function prepare(){
+    const f = document.getElementById("q_foto").files[0];
+    const out = document.getElementById("q_size");
+    if (!f) { compressed = null; out.textContent = ""; return; }
+    out.textContent = "⏳ compressione…";
+    compressed = compress(f, sel.value);
+    compressed.then((r) => {
+      out.textContent = r ? ("📦 " + kb(f.size) + " → " + kb(r.bytes)) : "⚠️ formato non leggibile";
+    });
+  }
+  document.getElementById("q_foto").addEventListener("change", prepare);
+  sel.addEventListener("change", () => { localStorage.setItem(K_PRESET, sel.value); prepare(); });
+  async function photo(){
+    if (!compressed) return null;
+    const r = await compressed;
+    if (!r) return null;
+    return { b64: r.b64, name: r.name, type: r.type };
+  }
+
+  function schedule(){
+    clearTimeout(timer);
+    backoff = Math.min(60000, Math.max(2000, backoff * 2));
+    const wait = backoff * (0.8 + Math.random() * 0.4);
+    render("nuovo tentativo tra " + Math.round(wait / 1000) + "s");
+    timer = setTimeout(flush, wait);
+  }
+  async function flush(){
+    if (sending) return;
+    const q = load();
+    if (!q.length) { render(); return; }
+    sending = true;
+    render("invio…");
+    try {
+      // blocchi piccoli: al massimo BATCH messaggi e ~CFG.budget byte (sempre almeno uno)
+      const items = [];
+      let size = 0;
+      for (const it of q.slice(0, BATCH)) {
+        const n = JSON.stringify(it).length;
+        if (items.length && size + n > CFG.budget) break;
+        items.push(it); size += n;
+      }
+      const r = await fetch(endpoint(), {
+        method: "POST", headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ team: CFG.team, token: CFG.token, items: items }) });
+      const j = await r.json().catch(() => ({}));
+      if (r.status === 401) { setErr("Token non valido o scaduto: rigenera il QR in Sala."); render(); return; }
+      if (!r.ok || !j.ok) throw new Error(j.error || ("HTTP " + r.status));
+      const done = new Set(j.ids || []);
+      save(load().filter((it) => !done.has(it.id)));
+      backoff = 0; setErr("");
+      if (load().length) setTimeout(flush, 0); else render();
+    } catch (e) {
+      schedule();
+    } finally {
+      sending = false;
+    }
+  }
+
+  document.getElementById("q_send").addEventListener("click", async () => {
+    const btn = document.getElementById("q_send");
+    const msg = document.getElementById("q_msg").value.trim();
+    const foto = document.getElementById("q_foto").files[0];
+    if (!msg && !foto) { setErr("Scrivi un messaggio o allega una foto."); return; }
+    btn.disabled = true;
+    const item = { id: uid(), t: Date.now(), msg: msg, pos: await gps(), foto: await photo() };
+    const q = load(); q.push(item);
+    if (!save(q)) {
+      item.foto = null;  // senza spazio per la foto si tiene almeno il testo
+      if (!save(q)) { setErr("Memoria del telefono piena: messaggio non accodato."); btn.disabled = false; return; }
+      setErr("Memoria piena: foto non salvata, testo in coda.");
+    }
+    document.getElementById("q_msg").value = "";
+    document.getElementById("q_foto").value = "";
+    compressed = null;
+    document.getElementById("q_size").textContent = "";
+    btn.disabled = false;
+    backoff = 0;
+    flush();
+  });
+
+  window.addEventListener("online", () => { backoff = 0; flush(); });
+  setInterval(render, 2000);  // la pillola dell'HUD viene ridisegnata a ogni rerun
+  setInterval(() => { if (backoff === 0) flush(); }, 30000);
+  render();
+  flush();
+})();
+</script>
+"""
+
+def render_field_offline_queue(team: str, token: str, height: int = 340) -> None:
+    """Modulo di invio con coda nel browser (vedi sopra). Richiede l'endpoint HTTP attivo."""
+    cfg = {"team": team, "token": token, "url": INGEST_PUBLIC_URL, "port": INGEST_PORT,
+           "batch": FIELD_BATCH_MAX, "presets": FIELD_PHOTO_PRESETS, "preset": FIELD_PHOTO_PRESET_DEFAULT,
+           "budget": FIELD_UPLOAD_BUDGET_BYTES}
+    components.html(_FIELD_QUEUE_HTML.replace("__CFG__", json.dumps(cfg)), height=height, scrolling=False)
 
+# =========================
+# TRACCIAMENTO GPS DAL TELEFONO (browser)
+# =========================
+# watchPosition nel browser: i fix vengono campionati sul telefono (distanza/tempo minimi),
+# accumulati nel localStorage e inviati a blocchi a /api/campo/traccia. Nessun rerun dello
+# script per ogni fix, nessun messaggio in inbox. Con schermo spento il browser sospende il GPS.
+_FIELD_TRACK_HTML = """
+<style>
+  body { margin:0; font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; }
+  .t-card { border:1px solid rgba(128,128,128,.35); border-radius:14px; padding:10px 12px; }
+  .t-st { font-size:.85rem; margin-top:6px; opacity:.85; }
+  button { width:100%; padding:12px; border-radius:14px; border:0; font-weight:800; font-size:1rem; color:#fff; background:#1971c2; }
+  button.on { background:#2b8a3e; }
+</style>
+<div class="t-card">
+  <button id="t_btn">▶️ AVVIA TRACCIAMENTO</button>
+  <div class="t-st" id="t_st">Tracciamento spento.</div>
+</div>
+<script>
+(function(){
+  const CFG = __CFG__;
+  const K_ON = "rm_track_on_" + CFG.team, K_BUF = "rm_track_buf_" + CFG.team;
+  let watch = null, last = null, lastFix = null, sending = false, backoff = 0, nextTry = 0;
+
+  function endpoint(){
+    if (CFG.url) return CFG.url + "/api/campo/traccia";
+    let loc = window.location;
+    try { loc = window.parent.location; } catch (e) {}
+    return loc.protocol + "//" + loc.hostname + ":" + CFG.port + "/api/campo/traccia";
+  }
+  function buf(){ try { return JSON.parse(localStorage.getItem(K_BUF) || "[]"); } catch (e) { return []; } }
+  function setBuf(b){ try { localStorage.setItem(K_BUF, JSON.stringify(b.slice(-5000))); } catch (e) {} }
+  function dist(a, b){
+    const R = 6371000, r = Math.PI / 180;
+    const dl = (b[1] - a[1]) * r, dp = (b[0] - a[0]) * r;
+    const h = Math.sin(dp / 2) ** 2 + Math.cos(a[0] * r) * Math.cos(b[0] * r) * Math.sin(dl / 2) ** 2;
+    return 2 * R * Math.asin(Math.sqrt(h));
+  }
+  function status(){
+    const on = !!watch;
+    const btn = document.getElementById("t_btn");
+    btn.textContent = on ? "⏹️ FERMA TRACCIAMENTO" : "▶️ AVVIA TRACCIAMENTO";
+    btn.className = on ? "on" : "";
+    let s = on ? "🛰️ Attivo" : "Tracciamento spento.";
+    if (lastFix) s += " · ultimo fix ±" + Math.round(lastFix.acc || 0) + " m";
+    const n = buf().length;
+    if (n) s += " · " + n + " punti da inviare";
+    document.getElementById("t_st").textContent = s;
+  }
+  function onFix(p){
+    const pt = [Date.now(), p.coords.latitude, p.coords.longitude, p.coords.accuracy];
+    lastFix = { acc: p.coords.accuracy };
+    // campionamento: solo se ci si è spostati abbastanza (o da fermi ogni tanto)
+    const dt = last ? (pt[0] - last[0]) / 1000 : Infinity;
+    const dd = last ? dist([last[1], last[2]], [pt[1], pt[2]]) : Infinity;
+    if ((dt >= CFG.min_s && dd >= CFG.min_m) || dt >= CFG.max_s) {
+      last = pt;
+      const b = buf(); b.push(pt); setBuf(b);
+    }
+    status();
+  }
+  function start(){
+    if (watch || !navigator.geolocation) return;
+    watch = navigator.geolocation.watchPosition(onFix, () => status(),
+      { enableHighAccuracy: true, maximumAge: 5000, timeout: 30000 });
+    localStorage.setItem(K_ON, "1");
+    status();
+  }
+  function stop(){
+    if (watch !== null) navigator.geolocation.clearWatch(watch);
+    watch = null;
+    localStorage.setItem(K_ON, "0");
+    upload();
+    status();
+  }
+  async function upload(){
+    const b = buf();
+    if (sending || !b.length || Date.now() < nextTry) return;
+    sending = true;
+    const part = b.slice(0, CFG.batch);
+    try {
+      const r = await fetch(endpoint(), { method: "POST", headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ team: CFG.team, token: CFG.token, points: part }) });
+      if (!r.ok) throw new Error("HTTP " + r.status);
+      const sent = new Set(part.map((p) => p[0]));
+      setBuf(buf().filter((p) => !sent.has(p[0])));
+      backoff = 0; nextTry = 0;
+    } catch (e) {
+      backoff = Math.min(300000, Math.max(5000, backoff * 2));
+      nextTry = Date.now() + backoff;
+    } finally {
+      sending = false;
+      status();
+    }
+  }
+
+  document.getElementById("t_btn").addEventListener("click", () => { if (watch) stop(); else start(); });
+  window.addEventListener("online", () => { nextTry = 0; upload(); });
+  setInterval(upload, CFG.upload_s * 1000);
+  if (localStorage.getItem(K_ON) === "1") start();
+  status();
+  upload();
+})();
+</script>
+"""
+
+def render_field_tracking(team: str, token: str, height: int = 110) -> None:
+    """Pulsante di tracciamento continuo (vedi sopra)."""
+    cfg = {"team": team, "token": token, "url": INGEST_PUBLIC_URL, "port": INGEST_PORT, "batch": TRACK_MAX_BATCH,
+           "min_m": TRACK_MIN_DIST_M, "min_s": TRACK_MIN_INTERVAL_S, "max_s": TRACK_MAX_INTERVAL_S,
+           "upload_s": TRACK_UPLOAD_S}
+    components.html(_FIELD_TRACK_HTML.replace("__CFG__", json.dumps(cfg)), height=height, scrolling=False)
+
+# =========================
+# AUTO-REFRESH smart (solo nuovi eventi + pausa durante scrittura)
+# =========================
 def _mark_typing(ttl_seconds: int = 20) -> None:
     """Segna che l'utente sta scrivendo: sospende l'auto-refresh per un po'."""
     try:
@@ -2414,27 +5169,36 @@ def _fmt_last_update(ts: float | None) -> str:
     except Exception:
         return "—"
 
+def backup_bytes() -> bytes:
+    """Backup completo (JSON autosufficiente, foto incorporate in base64). Legge ogni foto dal
+    disco: si costruisce solo quando l'operatore lo chiede."""
+    payload_now = {
+        "brogliaccio": [dict(x, foto=_photo_inline(x.get("foto"))) if isinstance(x, dict) and x.get("foto") else x for x in st.session_state.brogliaccio],
+        "inbox": [dict(x, foto=_photo_inline(x.get("foto"))) if isinstance(x, dict) and x.get("foto") else x for x in st.session_state.inbox],
+        "squadre": st.session_state.squadre,
+        "pos_mappa": st.session_state.pos_mappa,
+        "op_name": st.session_state.op_name,
+        "ev_data": str(st.session_state.ev_data),
+        "ev_tipo": st.session_state.ev_tipo,
+        "ev_nome": st.session_state.ev_nome,
+        "ev_desc": st.session_state.ev_desc,
+        "BASE_URL": st.session_state.get("BASE_URL", ""),
+        "cnt_conclusi": st.session_state.get("cnt_conclusi", 0),
+    }
+    return json.dumps(payload_now, ensure_ascii=False, indent=2).encode("utf-8")
+
 def load_data_from_uploaded_json(file_bytes: bytes):
     payload = json.loads(file_bytes.decode("utf-8"))
-    st.session_state.brogliaccio = payload.get("brogliaccio", [])
-    st.session_state.inbox = payload.get("inbox", [])
-    st.session_state.squadre = payload.get("squadre", default_state_payload()["squadre"])
-    st.session_state.pos_mappa = payload.get("pos_mappa", [45.7075, 11.4772])
-    st.session_state.op_name = payload.get("op_name", "")
-    st.session_state.ev_data = datetime.fromisoformat(payload.get("ev_data", datetime.now().date().isoformat())).date()
-    st.session_state.ev_tipo = payload.get("ev_tipo", "Emergenza")
-    st.session_state.ev_nome = payload.get("ev_nome", "")
-    st.session_state.ev_desc = payload.get("ev_desc", "")
-    st.session_state.BASE_URL = payload.get("BASE_URL", "") or ""
-    st.session_state.cnt_conclusi = int(payload.get("cnt_conclusi", 0) or 0)
-    save_data_to_disk()
+    _externalize_photos(payload)
+    _install_payload(payload)
+    save_data_to_disk(force=True, merge=False)
     ensure_inbox_ids()
 
 def ensure_inbox_ids() -> None:
     """Assicura che ogni messaggio in inbox abbia un id stabile (evita bug widget/rerun)."""
     inbox = st.session_state.get("inbox", [])
     changed = False
-    if isinstance(inbox, list):
+    if isinstance(inbox, list) or hasattr(inbox, "has"):
         for m in inbox:
             if isinstance(m, dict):
                 if not m.get("id"):
@@ -2452,45 +5216,35 @@ if "initialized" not in st.session_state:
     st.session_state.team_edit_open = None
     st.session_state.team_qr_open = None
 
-    ok = load_data_from_disk()
+    ok = bool(_store().data)  # i dati dal disco li carica lo store, una volta per processo
+    _bind_session(force=True)
     ensure_inbox_ids()
     # inizializza contatore conclusi se mancante (deriva dal brogliaccio)
     if "cnt_conclusi" not in st.session_state or st.session_state.cnt_conclusi is None:
         st.session_state.cnt_conclusi = sum(1 for r in st.session_state.get("brogliaccio", []) if r.get("st") == "Intervento concluso")
     if not ok:
-        d = default_state_payload()
-        st.session_state.brogliaccio = d["brogliaccio"]
-        st.session_state.inbox = d["inbox"]
+        _install_payload(default_state_payload())
         ensure_inbox_ids()
-        st.session_state.squadre = d["squadre"]
-        st.session_state.pos_mappa = d["pos_mappa"]
-        st.session_state.op_name = d["op_name"]
-        st.session_state.ev_data = datetime.fromisoformat(d["ev_data"]).date()
-        st.session_state.ev_tipo = d["ev_tipo"]
-        st.session_state.ev_nome = d["ev_nome"]
-        st.session_state.ev_desc = d["ev_desc"]
-        st.session_state.cnt_conclusi = 0
-        st.session_state.BASE_URL = d["BASE_URL"]
-        save_data_to_disk()
-
-# assicura token a tutte le squadre
-for _, info in st.session_state.squadre.items():
-    if "token" not in info or not info["token"]:
-        info["token"] = uuid.uuid4().hex
+        _mark_dirty()
+        save_data_to_disk(merge=False)
 
 # =========================
 # SYNC MULTI-SESSION (Caposquadra -> Console)
 # =========================
-# Se un caposquadra invia dal proprio link QR, scrive su DATA_PATH.
-# La console vede i nuovi dati al prossimo rerun: qui forziamo un reload quando il file cambia.
-if not st.session_state.get("field_ok"):
-    try:
-        _mtime = os.path.getmtime(DATA_PATH) if os.path.exists(DATA_PATH) else None
-        if _mtime and st.session_state.get("_data_mtime") != _mtime:
-            load_data_from_disk()
-            st.session_state._data_mtime = _mtime
-    except Exception:
-        pass
+# Le sessioni dello stesso processo condividono lo store: un invio dal link QR è già visibile.
+# Si ricarica dal disco solo se ha scritto un altro processo (stamp diverso da quello noto).
+try:
+    _store_sync()
+except Exception:
+    pass
+_bind_session()
+
+# assicura token a tutte le squadre: team_set nel journal, così il link QR sopravvive al riavvio
+# (dopo il sync: un token già assegnato da un altro processo non viene rigenerato)
+_tok_ops = [{"op": "team_set", "name": _n, "fields": {"token": uuid.uuid4().hex}}
+            for _n, _inf in list(st.session_state.squadre.items()) if not _inf.get("token")]
+if _tok_ops:
+    _commit_ops(_tok_ops)
 
 # =========================
 # AUTO BASE URL (opzionale: streamlit-js-eval)
@@ -2564,41 +5318,32 @@ def update_team(old_name: str, new_name: str, capo: str, tel: str, tetra_id: str
     if new_name != old_name and new_name in st.session_state.squadre:
         return False, "Esiste già una squadra con questo nome."
 
+    ops = []
     if new_name != old_name:
-        st.session_state.squadre[new_name] = st.session_state.squadre.pop(old_name)
-
-        for msg in st.session_state.inbox:
-            if (msg.get("sq") or "").strip().upper() == old_name:
-                msg["sq"] = new_name
-
-        for b in st.session_state.brogliaccio:
-            if (b.get("sq") or "").strip().upper() == old_name:
-                b["sq"] = new_name
-            if (b.get("chi") or "").strip().upper() == old_name:
-                b["chi"] = new_name
+        ops.append({"op": "team_rename", "old": old_name, "new": new_name})
 
         if st.session_state.team_edit_open == old_name:
             st.session_state.team_edit_open = new_name
         if st.session_state.team_qr_open == old_name:
             st.session_state.team_qr_open = new_name
 
-    st.session_state.squadre[new_name]["capo"] = capo
-    st.session_state.squadre[new_name]["tel"] = tel
-    st.session_state.squadre[new_name]["tetra_id"] = tetra_id
-    if "token" not in st.session_state.squadre[new_name] or not st.session_state.squadre[new_name]["token"]:
-        st.session_state.squadre[new_name]["token"] = uuid.uuid4().hex
+    fields = {"capo": capo, "tel": tel, "tetra_id": tetra_id}
+    if not st.session_state.squadre[old_name].get("token"):
+        fields["token"] = uuid.uuid4().hex
+    ops.append({"op": "team_set", "name": new_name, "fields": fields})
 
-    save_data_to_disk()
+    _commit_ops(ops)
     return True, f"Aggiornata: {old_name} → {new_name}"
 
 def regenerate_team_token(team: str) -> None:
     team = (team or "").strip().upper()
     if team in st.session_state.squadre:
-        st.session_state.squadre[team]["token"] = uuid.uuid4().hex
-        st.session_state.squadre[team]["token_created_at"] = datetime.now().isoformat(timespec="seconds")
-        st.session_state.squadre[team]["token_expires_at"] = (datetime.now() + timedelta(hours=TOKEN_TTL_HOURS)).isoformat(timespec="seconds")
-        st.session_state.squadre[team]["token_last_access"] = ""
-        save_data_to_disk()
+        _commit_ops([{"op": "team_set", "name": team, "fields": {
+            "token": uuid.uuid4().hex,
+            "token_created_at": datetime.now().isoformat(timespec="seconds"),
+            "token_expires_at": (datetime.now() + timedelta(hours=TOKEN_TTL_HOURS)).isoformat(timespec="seconds"),
+            "token_last_access": "",
+        }}])
 
 def delete_team(team: str) -> Tuple[bool, str]:
     team = (team or "").strip().upper()
@@ -2606,13 +5351,11 @@ def delete_team(team: str) -> Tuple[bool, str]:
         return False, "Squadra non trovata."
     if len(st.session_state.squadre) <= 1:
         return False, "Deve rimanere almeno 1 squadra."
-    del st.session_state.squadre[team]
-    st.session_state.inbox = [m for m in st.session_state.inbox if (m.get("sq") or "").strip().upper() != team]
+    _commit_ops([{"op": "team_del", "name": team}])
     if st.session_state.team_edit_open == team:
         st.session_state.team_edit_open = None
     if st.session_state.team_qr_open == team:
         st.session_state.team_qr_open = None
-    save_data_to_disk()
     return True, f"Squadra eliminata: {team}"
 
 # =========================
@@ -2647,9 +5390,14 @@ def require_login():
             except Exception:
                 pass
 
-        # Log ultimo accesso
-        st.session_state.squadre[qp_team]["token_last_access"] = datetime.now().isoformat(timespec="seconds")
-        save_data_to_disk()
+        # Log ultimo accesso (non a ogni rerun del telefono: solo se il valore salvato è vecchio)
+        last = (st.session_state.squadre[qp_team].get("token_last_access") or "").strip()
+        try:
+            stale = not last or datetime.now() - datetime.fromisoformat(last) >= timedelta(minutes=TOKEN_ACCESS_LOG_MIN)
+        except ValueError:
+            stale = True
+        if stale:
+            _commit_ops([{"op": "team_set", "name": qp_team, "fields": {"token_last_access": datetime.now().isoformat(timespec="seconds")}}])
 
         st.session_state.auth_ok = False
         st.session_state.field_ok = True
@@ -2715,14 +5463,22 @@ if st.session_state.get("auth_ok") and (not st.session_state.get("field_ok")) an
     # 🧭 indicatore ultimo aggiornamento (ogni run)
     st.session_state["_last_update_ts"] = time.time()
 
+    _push = _sala_push()
+    _sid = _current_session_id()
     # 🔕 pausa automatica refresh quando scrivi (evita reset/scroll mentre compili messaggi)
-    if not _is_user_typing():
+    if _is_user_typing():
+        _push.unsubscribe(_sid)
+    elif _sid and _push.available():
+        # 📨 push: la console viene risvegliata solo quando arriva qualcosa
+        _push.subscribe(_sid)
+        st.session_state["_last_events_sig"] = change_counter(PUSH_COLLECTIONS)
+    else:
         sec = int(st.session_state.get("AUTO_REFRESH_SEC") or 20)
 
         # 📡 refresh solo su nuovi eventi:
         # - se firma eventi è cambiata → usa intervallo selezionato
         # - se non cambia → rallenta a 60s per ridurre reload inutili
-        cur_sig = _disk_events_signature()
+        cur_sig = change_counter(PUSH_COLLECTIONS)
         last_sig = st.session_state.get("_last_events_sig")
         new_events = (last_sig is None) or (cur_sig != last_sig)
         st.session_state["_last_events_sig"] = cur_sig
@@ -2735,6 +5491,8 @@ if st.session_state.get("auth_ok") and (not st.session_state.get("field_ok")) an
         except Exception:
             # Nessun auto refresh disponibile: usa il pulsante "Aggiorna" o disattiva Auto aggiorna.
             pass
+else:
+    _sala_push().unsubscribe(_current_session_id())
 
 # =========================
 # CSS (UI)
@@ -3485,7 +6243,8 @@ with st.sidebar:
                 used = {hx for hx in used if hx.startswith("#") and len(hx) == 7}
                 colore = _pick_next_team_color(set(used))
 
-                st.session_state.squadre[nome] = {
+                _commit_ops([{"op": "team_add", "name": nome, "fields": {
+                    "tid": "t-" + uuid.uuid4().hex[:10],  # immutabile: un nome riusato non eredita lo storico
                     "stato": "In attesa al COC",
                     "capo": (capo or "").strip(),
                     "tel": (tel or "").strip(),
@@ -3495,8 +6254,7 @@ with st.sidebar:
                     "token_expires_at": (datetime.now() + timedelta(hours=TOKEN_TTL_HOURS)).isoformat(timespec="seconds"),
                     "token_last_access": "",
                     "mhex": colore,
-                }
-                save_data_to_disk()
+                }}])
                 # apri subito la scheda e mostra QR
                 st.session_state.team_open = nome
                 st.session_state.team_qr_open = nome
@@ -3581,7 +6339,10 @@ with st.sidebar:
             "Intervallo (s)",
             options=_opts,
             value=_cur,
+            help="Usato solo se l'aggiornamento istantaneo (push) non è disponibile.",
         )
+        if _sala_push().available():
+            st.caption("📨 Aggiornamento istantaneo attivo: la console si aggiorna all'arrivo dei messaggi.")
         if st.button("🔄", help="Aggiorna ora"):
             st.rerun()
 
@@ -3666,29 +6427,25 @@ with st.sidebar:
 # BACKUP in fondo
     st.markdown("## 💾 Backup / Ripristino")
 
-    payload_now = {
-        "brogliaccio": st.session_state.brogliaccio,
-        "inbox": st.session_state.inbox,
-        "squadre": st.session_state.squadre,
-        "pos_mappa": st.session_state.pos_mappa,
-        "op_name": st.session_state.op_name,
-        "ev_data": str(st.session_state.ev_data),
-        "ev_tipo": st.session_state.ev_tipo,
-        "ev_nome": st.session_state.ev_nome,
-        "ev_desc": st.session_state.ev_desc,
-        "BASE_URL": st.session_state.get("BASE_URL", ""),
-        "cnt_conclusi": st.session_state.get("cnt_conclusi", 0),
-    }
-
-    # 📦⬇️ Scarica
-    st.download_button(
-        "📦⬇️",
-        data=json.dumps(payload_now, ensure_ascii=False, indent=2).encode("utf-8"),
-        file_name="backup_radio_manager.json",
-        mime="application/json",
-        help="Scarica un backup completo (JSON) di brogliaccio, inbox, squadre e impostazioni.",
-        use_container_width=True,
-    )
+    # 📦⬇️ Scarica: il backup (foto incorporate) si costruisce solo su richiesta, non a ogni rerun
+    _bk_ver = tuple(_store().ver[c] for c in COLLECTIONS)
+    _bk = st.session_state.get("_backup_ready")
+    if _bk is None or _bk[0] != _bk_ver:
+        if st.button("📦 Prepara backup" if _bk is None else "📦 Aggiorna backup", key="backup_prepare",
+                     use_container_width=True,
+                     help="Prepara un backup completo (JSON) di brogliaccio, inbox, squadre e impostazioni, foto comprese."):
+            st.session_state["_backup_ready"] = _bk = (_bk_ver, backup_bytes(), datetime.now().strftime("%H:%M:%S"))
+    if _bk is not None:
+        st.download_button(
+            "📦⬇️",
+            data=_bk[1],
+            file_name="backup_radio_manager.json",
+            mime="application/json",
+            help="Scarica il backup preparato.",
+            use_container_width=True,
+            on_click=lambda: st.session_state.pop("_backup_ready", None),
+        )
+        st.caption(f"Backup delle {_bk[2]}" + ("" if _bk[0] == _bk_ver else " · nel frattempo i dati sono cambiati"))
 
     # 📦⬆️ Ripristina (carica JSON: ripristino automatico)
     st.markdown("**📦⬆️ Carica backup**")
@@ -3815,6 +6572,7 @@ section.main .block-container {{padding-top: 1rem;}}
     <div style="display:flex; gap:.45rem; flex-wrap:wrap;">
       <span class="field-pill" style="background:{pill_bg}; color:{hud_fg};">📡 Rete: <span class="field-muted">{_net_label}</span></span>
       <span class="field-pill" style="background:{pill_bg}; color:{hud_fg};">📍 GPS: <span class="field-muted">{'🟢 OK' if _gps_ok else '🔴 NO'}</span></span>
+      <span class="field-pill" id="rm-field-queue-pill" style="background:{pill_bg}; color:{hud_fg};">📴 Coda: —</span>
     </div>
     <div style="display:flex; gap:.45rem; flex-wrap:wrap; align-items:center;">
       <span class="field-pill" style="background:{pill_bg}; color:{hud_fg};">🧑‍🚒 {st.session_state.get("field_team") or "Seleziona squadra"}</span>
@@ -3828,8 +6586,11 @@ section.main .block-container {{padding-top: 1rem;}}
 
     # --- Stato invii (persistenza su disco) ---
     _outbox_init()
-    if st.session_state.get("outbox_pending"):
-        st.warning(f"🛰️ Invii in attesa di salvataggio su disco: **{len(st.session_state.outbox_pending)}**")
+    _wstats = storage_writer_stats()
+    if st.session_state.get("outbox_pending") or _wstats["backlog"]:
+        _n_wait = len(st.session_state.get("outbox_pending") or []) + int(_wstats["backlog"])
+        st.warning(f"🛰️ Invii in attesa di salvataggio su disco: **{_n_wait}**"
+                   + (f" — {_wstats['error']}" if _wstats["error"] else ""))
         c_retry, c_info = st.columns([2, 3])
         with c_retry:
             if st.button("🔁 Riprova salvataggio", use_container_width=True, key="outbox_retry_btn", type="primary"):
@@ -3863,6 +6624,46 @@ section.main .block-container {{padding-top: 1rem;}}
     info_sq = get_squadra_info(sq_c)
     st.markdown(f"**👤 Caposquadra:** {info_sq['capo'] or '—'} &nbsp;&nbsp; | &nbsp;&nbsp; **📞 Tel:** {info_sq['tel'] or '—'}")
 
+    # --- Dalla Sala: solo le novità della propria squadra (cursore in sessione) ---
+    if st.session_state.get("field_feed_team") != sq_c:
+        st.session_state.field_feed_team = sq_c
+        st.session_state.field_feed_cursor = None
+    try:
+        _delta = team_delta(sq_c, st.session_state.get("field_feed_cursor"))
+    except Exception:
+        _delta = None
+    if _delta is not None:
+        if _delta["reset"]:
+            st.session_state.field_feed = list(_delta["items"])
+            st.session_state.field_feed_stato = _delta.get("stato")
+        else:
+            if any(it.get("k") in ("sala", "ris") for it in _delta["items"]):
+                st.toast("📨 Nuovo messaggio dalla Sala", icon="📨")
+            st.session_state.field_feed = (st.session_state.get("field_feed", []) + _delta["items"])[-FEED_MAX_ITEMS:]
+            for it in _delta["items"]:
+                if it.get("k") == "stato":
+                    st.session_state.field_feed_stato = it.get("st")
+        st.session_state.field_feed_cursor = _delta["cursor"]
+    _feed = [it for it in st.session_state.get("field_feed", []) if it.get("k") != "stato"]
+    _stato = st.session_state.get("field_feed_stato")
+    with st.expander(f"📨 Dalla Sala ({len(_feed)})", expanded=bool(_feed)):
+        if _stato:
+            st.markdown(chip_stato(_stato), unsafe_allow_html=True)
+        if not _feed:
+            st.caption("Nessun messaggio dalla Sala per questa squadra.")
+        _feed_lbl = {"sala": "📞 Sala", "ris": "💬 Risposta", "ok": "✅ Validato"}
+        for it in reversed(_feed[-10:]):
+            st.markdown(f"**{it.get('ora') or ''} · {_feed_lbl.get(it.get('k'), '')}** — {it.get('msg') or ''}")
+
+    # --- Invio con coda offline (browser -> endpoint HTTP, funziona anche senza sessione attiva) ---
+    if INGEST_PUBLIC_URL or _ingest_server(INGEST_PORT) is not None:
+        _tok = (st.session_state.squadre.get(sq_c) or {}).get("token") or ""
+        with st.expander("📴 Invio con coda offline (consigliato con rete instabile)", expanded=False):
+            render_field_offline_queue(sq_c, _tok)
+        with st.expander("🛰️ Tracciamento GPS continuo", expanded=False):
+            st.caption("La Sala vede il percorso della squadra. Tieni la pagina aperta: con schermo spento il telefono sospende il GPS.")
+            render_field_tracking(sq_c, _tok)
+
     share_gps = st.checkbox("📍 Includi posizione GPS (Privacy)", value=True)
 
     # Helper: posizione da inviare (GPS se disponibile, altrimenti manuale)
@@ -3961,19 +6762,17 @@ section.main .block-container {{padding-top: 1rem;}}
         pos_da_inviare = get_field_pos_to_send(share_gps)
         base = st.session_state.get("field_msg_rapido") or msg_rapido or ""
         msg_finale = _merge_template_text(base) or "Aggiornamento posizione"
-        st.session_state.inbox.append(
-            {
-                "id": uuid.uuid4().hex,
-                "ora": datetime.now().strftime("%H:%M"),
-                "sq": sq_c,
-                "msg": msg_finale,
-                "foto": None,
-                "pos": pos_da_inviare,
-            }
-        )
         try:
             try:
-                save_data_to_disk()
+                if not _commit_ops([{"op": "inbox_add", "rec": {
+                    "id": uuid.uuid4().hex,
+                    "ora": datetime.now().strftime("%H:%M"),
+                    "sq": sq_c,
+                    "msg": msg_finale,
+                    "foto": None,
+                    "pos": pos_da_inviare,
+                }}]):
+                    raise OSError("journal non scrivibile")
                 st.session_state.field_last_sent = {
                     "ora": datetime.now().strftime("%H:%M"),
                     "sq": sq_c,
@@ -4030,31 +6829,31 @@ section.main .block-container {{padding-top: 1rem;}}
 
         msg_c = st.text_area("DESCRIZIONE:", key="field_msg_completo")
 
-        foto = st.file_uploader("FOTO:", type=["jpg", "jpeg", "png"])
-        if foto is not None:
-            st.image(foto, caption="Anteprima foto", use_container_width=True)
+        # la foto passa dalla coda offline, che la comprime sul telefono: il file_uploader la
+        # caricherebbe a piena risoluzione. Resta solo se l'endpoint della coda non c'è.
+        foto = None
+        if INGEST_PUBLIC_URL or _ingest_server(INGEST_PORT) is not None:
+            st.caption("📸 Per allegare una foto usa «Invio con coda offline»: viene compressa sul telefono prima dell'invio.")
+        else:
+            foto = st.file_uploader("FOTO:", type=["jpg", "jpeg", "png"])
+            if foto is not None:
+                st.image(foto, caption=f"Anteprima foto · {foto.size / 1048576:.1f} MB", use_container_width=True)
 
         if st.form_submit_button("🚀 INVIA RAPPORTO COMPLETO", type="primary", use_container_width=True):
             pos_da_inviare = get_field_pos_to_send(share_gps)
-            st.session_state.inbox.append(
-                {
-                    "id": uuid.uuid4().hex,
-                    "ora": datetime.now().strftime("%H:%M"),
-                    "sq": sq_c,
-                    "msg": _merge_template_text(st.session_state.get("field_msg_completo") or ""),
-                    "foto": (
-                        {
-                            "name": getattr(foto, "name", "foto"),
-                            "type": getattr(foto, "type", "image/jpeg"),
-                            "b64": _b64_encode_bytes(foto.read()),
-                        }
-                        if foto
-                        else None
-                    ),
-                    "pos": pos_da_inviare,
-                }
-            )
-            save_data_to_disk()
+            msg_finale = _merge_template_text(st.session_state.get("field_msg_completo") or "")
+            _commit_ops([{"op": "inbox_add", "rec": {
+                "id": uuid.uuid4().hex,
+                "ora": datetime.now().strftime("%H:%M"),
+                "sq": sq_c,
+                "msg": msg_finale,
+                "foto": (
+                    _photo_ref(foto.getvalue(), getattr(foto, "name", "foto"), getattr(foto, "type", "image/jpeg"))
+                    if foto
+                    else None
+                ),
+                "pos": pos_da_inviare,
+            }}])
             st.session_state.field_last_sent = {
                 "ora": datetime.now().strftime("%H:%M"),
                 "sq": sq_c,
@@ -4091,8 +6890,7 @@ with c3:
     # Overlay: porta il bottone dentro al quadrato (bottom-right)
     st.markdown("<div class='pc-reset-over'>", unsafe_allow_html=True)
     if st.button("↺", help="Reset conclusi", key="reset_cnt_conclusi", type="secondary"):
-        st.session_state.cnt_conclusi = 0
-        save_data_to_disk()
+        _commit_ops([{"op": "meta_set", "fields": {"cnt_conclusi": 0}}])
         st.rerun()
     st.markdown("</div>", unsafe_allow_html=True)
 c4.markdown(metric_box(COLORI_STATI["Rientrata al Coc"]["hex"], "↩️", "Rientro", st_lista.count("Rientrata al Coc")), unsafe_allow_html=True)
@@ -4106,9 +6904,73 @@ if not is_field_ui:
 # INBOX APPROVAZIONE
 # (renderizzato sopra la MAPPA)
 # =========================
+def _approve_event_rec(data: dict, st_v: str) -> dict:
+    """Evento di registro per un messaggio inbox approvato."""
+    pref = "[AUTO]" if data.get("pos") else "[AUTO-PRIVACY]"
+    return {
+        "id": uuid.uuid4().hex, "ora": data.get("ora"), "t": data.get("t"), "chi": data.get("sq"), "sq": data.get("sq"), "st": st_v,
+        "mit": f"{pref} {data.get('msg', '')}", "ris": "VALIDATO", "op": st.session_state.op_name,
+        "pos": data.get("pos"), "foto": data.get("foto")}
+
+def _bulk_inbox_ops(msgs: List[dict], team_state: Dict[str, Optional[str]], approve: bool) -> List[dict]:
+    """Approvazione/scarto in blocco: eventi + UN cambio stato per squadra + UNA rimozione dall'inbox.
+    team_state[sq] = None -> la squadra mantiene lo stato attuale."""
+    ops: List[dict] = []
+    if approve:
+        for data in msgs:
+            sq = data.get("sq")
+            cur = (st.session_state.squadre.get(sq) or {}).get("stato") or ""
+            ops.append({"op": "ev_add", "rec": _approve_event_rec(data, team_state.get(sq) or cur)})
+        concluded = 0
+        for sq, new_st in team_state.items():
+            if not new_st or sq not in st.session_state.squadre:
+                continue
+            ops.append({"op": "team_set", "name": sq, "fields": {"stato": new_st}})
+            if new_st == "Intervento concluso" and st.session_state.squadre[sq].get("stato") != new_st:
+                concluded += 1
+        if concluded:
+            ops.append({"op": "meta_set", "fields": {"cnt_conclusi": int(st.session_state.get("cnt_conclusi", 0) or 0) + concluded}})
+    ops.append({"op": "inbox_del", "ids": [m.get("id") for m in msgs]})
+    return ops
+
+def render_inbox_bulk_actions() -> None:
+    """Azioni in blocco sull'inbox: una sola transazione, una scrittura, un rerun."""
+    inbox = [m for m in (st.session_state.get("inbox") or []) if m.get("id")]
+    if len(inbox) < 2:
+        return
+    with st.expander(f"⚡ Azioni in blocco ({len(inbox)} messaggi)", expanded=False):
+        labels = {m["id"]: f"{m.get('sq', '')} · {m.get('ora', '')} · {(m.get('msg') or '')[:40]}" + (" 📷" if m.get("foto") else "")
+                  for m in inbox}
+        c1, c2 = st.columns(2)
+        if c1.button("☑️ Tutti", key="bulk_sel_all", use_container_width=True):
+            st.session_state["bulk_inbox_sel"] = list(labels)
+        if c2.button("📍 Solo posizioni", key="bulk_sel_pos", use_container_width=True,
+                     help="Aggiornamenti senza foto con solo GPS / nota breve"):
+            st.session_state["bulk_inbox_sel"] = [m["id"] for m in inbox if m.get("pos") and not m.get("foto")]
+        # messaggi già gestiti da un'altra postazione escono dalla selezione
+        st.session_state["bulk_inbox_sel"] = [i for i in (st.session_state.get("bulk_inbox_sel") or []) if i in labels]
+        sel = st.multiselect("Messaggi", list(labels), format_func=lambda i: labels.get(i, i), key="bulk_inbox_sel")
+        msgs = [m for m in inbox if m["id"] in set(sel)]
+        teams = sorted({m.get("sq") for m in msgs if m.get("sq")})
+        keep = "— mantieni stato attuale —"
+        team_state: Dict[str, Optional[str]] = {}
+        for sq in teams:
+            v = st.selectbox(f"Stato {sq}", [keep] + list(COLORI_STATI.keys()), key=f"bulk_state_{sq}")
+            team_state[sq] = None if v == keep else v
+        b1, b2 = st.columns(2)
+        if b1.button(f"✅ APPROVA {len(msgs)}", key="bulk_approve", disabled=not msgs, use_container_width=True):
+            _commit_ops(_bulk_inbox_ops(msgs, team_state, approve=True))
+            st.session_state.pop("bulk_inbox_sel", None)
+            st.rerun()
+        if b2.button(f"🗑️ SCARTA {len(msgs)}", key="bulk_discard", disabled=not msgs, use_container_width=True):
+            _commit_ops(_bulk_inbox_ops(msgs, {}, approve=False))
+            st.session_state.pop("bulk_inbox_sel", None)
+            st.rerun()
+
 def render_inbox_approval():
     if not st.session_state.get('inbox'):
         return
+    render_inbox_bulk_actions()
     for data in list(st.session_state.inbox):
         msg_id = data.get("id") or uuid.uuid4().hex
         data["id"] = msg_id
@@ -4123,31 +6985,33 @@ def render_inbox_approval():
             if data["pos"]:
                 st.info(f"📍 GPS acquisito: {data['pos']}")
             if data["foto"]:
-                st.image(_photo_to_bytes(data["foto"]), width=220)
+                # miniatura sempre (pochi KB); la foto intera solo se l'operatore la apre
+                k_full = f"inbox_full_{msg_id}"
+                if st.session_state.get(k_full):
+                    st.image(_photo_to_bytes(data["foto"]), use_container_width=True)
+                    if st.button("🔽 Chiudi foto", key=f"inbox_full_close_{msg_id}"):
+                        st.session_state[k_full] = False
+                        st.rerun()
+                else:
+                    st.image(_photo_thumb_bytes(data["foto"]) or _photo_to_bytes(data["foto"]), width=220)
+                    if st.button("🔍 Foto intera", key=f"inbox_full_open_{msg_id}"):
+                        st.session_state[k_full] = True
+                        st.rerun()
 
             st_v = st.selectbox("Nuovo Stato:", list(COLORI_STATI.keys()), key=f"sv_inbox_{msg_id}")
             st.markdown(chip_stato(st_v), unsafe_allow_html=True)
 
             cb1, cb2 = st.columns(2)
             if cb1.button("✅ APPROVA", key=f"ap_{msg_id}"):
-                pref = "[AUTO]" if data["pos"] else "[AUTO-PRIVACY]"
-                st.session_state.brogliaccio.insert(
-                    0,
-                    {"ora": data["ora"], "chi": sq_in, "sq": sq_in, "st": st_v,
-                     "mit": f"{pref} {data['msg']}", "ris": "VALIDATO", "op": st.session_state.op_name,
-                     "pos": data["pos"], "foto": data["foto"]}
+                _commit_ops(
+                    [{"op": "ev_add", "rec": _approve_event_rec(data, st_v)}]
+                    + _status_ops(sq_in, st_v)
+                    + [{"op": "inbox_del", "ids": [msg_id]}]
                 )
-                prev_st = st.session_state.squadre.get(sq_in, {}).get("stato")
-                st.session_state.squadre[sq_in]["stato"] = st_v
-                if st_v == "Intervento concluso" and prev_st != "Intervento concluso":
-                    st.session_state.cnt_conclusi = int(st.session_state.get("cnt_conclusi", 0) or 0) + 1
-                st.session_state.inbox = [m for m in st.session_state.inbox if (m.get("id") != msg_id)]
-                save_data_to_disk()
                 st.rerun()
 
             if cb2.button("🗑️ SCARTA", key=f"sc_{msg_id}"):
-                st.session_state.inbox = [m for m in st.session_state.inbox if (m.get("id") != msg_id)]
-                save_data_to_disk()
+                _commit_ops([{"op": "inbox_del", "ids": [msg_id]}])
                 st.rerun()
 
 # =========================
@@ -4225,13 +7089,10 @@ with t_rad:
             # Metti in attesa: salva SOLO testo (senza cambiare stato)
             if b1.button("⏳ METTI IN ATTESA", use_container_width=True, key="btn_mettti_in_attesa"):
                 # Salva in coda + nel brogliaccio, ma SENZA cambiare lo stato della squadra
-                if "reply_queue" not in st.session_state:
-                    st.session_state.reply_queue = []
-
                 _eid = uuid.uuid4().hex
                 _pos = ([float(lat), float(lon)] if (save_coords and lat is not None and lon is not None) else None)
 
-                st.session_state.reply_queue.insert(0, {
+                _queue_rec = {
                     "id": _eid,
                     "ora": datetime.now().strftime("%H:%M"),
                     "chi": chi,
@@ -4246,47 +7107,36 @@ with t_rad:
                     "pos": _pos,
                     "reply": "",
                     "st": st_s,
-                })
+                }
 
                 # Brogliaccio: annota il messaggio (risposta verrà compilata quando chiudi la coda)
-                try:
-                    st.session_state.brogliaccio.insert(
-                        0,
-                        {"id": _eid,
-                         "ora": datetime.now().strftime("%H:%M"),
-                         "chi": chi,
-                         "sq": sq,
-                         "caller_label": ("SALA OPERATIVA" if str(chi).strip().upper().startswith("SALA") else f"SQUADRA {sq}"),
-                         "answerer_label": (f"SQUADRA {sq}" if str(chi).strip().upper().startswith("SALA") else "SALA OPERATIVA"),
-                         "attesa_da": ("SQUADRA" if str(chi).strip().upper().startswith("SALA") else "SALA"),
-                         "st": st_s,
-                         "mit": mit,
-                         "ris": "",
-                         "op": st.session_state.op_name,
-                         "pos": _pos,
-                         "foto": None,
-                         "pending": True}
-                    )
-                except Exception:
-                    pass
-                save_data_to_disk()
+                _commit_ops([{"op": "queue_add", "rec": _queue_rec}, {"op": "ev_add", "rec": {
+                    "id": _eid,
+                    "ora": datetime.now().strftime("%H:%M"),
+                    "chi": chi,
+                    "sq": sq,
+                    "caller_label": ("SALA OPERATIVA" if str(chi).strip().upper().startswith("SALA") else f"SQUADRA {sq}"),
+                    "answerer_label": (f"SQUADRA {sq}" if str(chi).strip().upper().startswith("SALA") else "SALA OPERATIVA"),
+                    "attesa_da": ("SQUADRA" if str(chi).strip().upper().startswith("SALA") else "SALA"),
+                    "st": st_s,
+                    "mit": mit,
+                    "ris": "",
+                    "op": st.session_state.op_name,
+                    "pos": _pos,
+                    "foto": None,
+                    "pending": True}}])
                 st.session_state["_clear_radio_form"] = True
                 st.rerun()
 
             if b2.button("✅ REGISTRA COMUNICAZIONE", use_container_width=True, key="btn_registra_comunicazione"):
                 pos = [float(lat), float(lon)] if (save_coords and lat is not None and lon is not None) else None
-                st.session_state.brogliaccio.insert(
-                    0,
-                    {"ora": datetime.now().strftime("%H:%M"), "chi": chi, "sq": sq, "st": st_s,
-                     "mit": mit, "ris": ris, "op": st.session_state.op_name, "pos": pos, "foto": None}
-                )
-                prev_st = st.session_state.squadre.get(sq, {}).get("stato")
-                st.session_state.squadre[sq]["stato"] = st_s
-                if st_s == "Intervento concluso" and prev_st != "Intervento concluso":
-                    st.session_state.cnt_conclusi = int(st.session_state.get("cnt_conclusi", 0) or 0) + 1
+                ops = [{"op": "ev_add", "rec": {
+                    "id": uuid.uuid4().hex, "ora": datetime.now().strftime("%H:%M"), "chi": chi, "sq": sq, "st": st_s,
+                    "mit": mit, "ris": ris, "op": st.session_state.op_name, "pos": pos, "foto": None}}]
+                ops += _status_ops(sq, st_s)
                 if pos:
-                    st.session_state.pos_mappa = pos
-                save_data_to_disk()
+                    ops.append({"op": "meta_set", "fields": {"pos_mappa": pos}})
+                _commit_ops(ops)
                 st.session_state["_clear_radio_form"] = True
                 st.rerun()
 
@@ -4355,39 +7205,31 @@ with t_rad:
                         except Exception:
                             pass
                         # aggiorna brogliaccio: salva la risposta SULLA STESSA comunicazione (senza cambiare stato squadra)
+                        ops = []
                         try:
                             _reply_txt = (it.get("reply","") or "").strip()
-                            for _ev in st.session_state.brogliaccio:
-                                if _ev.get("id") == _id:
-                                    _ev["ris"] = _reply_txt
-                                    _ev["pending"] = False
-                                    _ev["ris_ora"] = datetime.now().strftime("%H:%M")
-                                    _ev["ris_da"] = (it.get("answerer_label") or (it.get("attesa_da") or "SALA")).upper()
-                                    break
+                            ops.append({"op": "ev_set", "id": _id, "fields": {
+                                "ris": _reply_txt,
+                                "pending": False,
+                                "ris_ora": datetime.now().strftime("%H:%M"),
+                                "ris_da": (it.get("answerer_label") or (it.get("attesa_da") or "SALA")).upper(),
+                            }})
 
                             # Applica anche lo stato scelto durante la messa in attesa
-                            try:
-                                _new_st = (_ev.get("st") or it.get("st") or "").strip()
-                                _sq = it.get("sq")
-                                if _sq and _new_st:
-                                    prev_st = st.session_state.squadre.get(_sq, {}).get("stato")
-                                    st.session_state.squadre[_sq]["stato"] = _new_st
-                                    if _new_st == "Intervento concluso" and prev_st != "Intervento concluso":
-                                        st.session_state.cnt_conclusi = int(st.session_state.get("cnt_conclusi", 0) or 0) + 1
-                            except Exception:
-                                pass
-
+                            _ev = st.session_state.brogliaccio.get(_id) or {}
+                            _new_st = (_ev.get("st") or it.get("st") or "").strip()
+                            _sq = it.get("sq")
+                            if _sq and _new_st and _sq in st.session_state.squadre:
+                                ops += _status_ops(_sq, _new_st)
                         except Exception:
                             pass
 
         # rimuovi dalla coda
-                        st.session_state.reply_queue = [x for x in st.session_state.reply_queue if x.get("id") != _id]
-                        save_data_to_disk()
+                        _commit_ops(ops + [{"op": "queue_del", "id": _id}])
                         st.rerun()
 
                     if c2.button("🗑️ Rimuovi dalla coda", key=f"btn_reply_rm_{_id}", use_container_width=True):
-                        st.session_state.reply_queue = [x for x in st.session_state.reply_queue if x.get("id") != _id]
-                        save_data_to_disk()
+                        _commit_ops([{"op": "queue_del", "id": _id}])
                         st.rerun()
 
         # MAPPA (ottimizzata)
@@ -4396,7 +7238,7 @@ with t_rad:
 
         if show_map:
             # per la dedup basta una slice dei primi eventi (newest->oldest)
-            events_slice = st.session_state.brogliaccio[:2000]
+            events_slice = _event_views(st.session_state.brogliaccio[:2000])
             inbox_now = st.session_state.get('inbox') or []
             squad_names = sorted(list(st.session_state.squadre.keys()))
 
@@ -4425,10 +7267,22 @@ with t_rad:
                     index=["Topografica", "Stradale", "Satellite", "Leggera"].index(st.session_state.get("map_base_main", "Topografica")),
                     key="map_base_main",
                 )
+                _tracks = {}
+                if st.toggle("🛰️ Tracce GPS live", value=True, key="map_show_tracks",
+                             help=f"Percorsi delle squadre in tracciamento (ultimi {TRACK_LIVE_MINUTES} minuti)"):
+                    try:
+                        _tracks = live_tracks()
+                        # squadre in tracciamento: il marker va sull'ultimo fix (più recente dei messaggi)
+                        ultime_pos = dict(ultime_pos or {})
+                        for _sq, _p in live_positions().items():
+                            ultime_pos[_sq] = {"pos": _p, "st": (st.session_state.squadre.get(_sq) or {}).get("stato", "")}
+                    except Exception:
+                        _tracks = {}
                 m = build_folium_map_from_latest_positions(
                     ultime_pos,
                     center=st.session_state.pos_mappa,
                     zoom=14,
+                    tracks=_tracks,
                 )
                 st_folium(m, width=1100, height=450, returned_objects=[], key="map_main")
         # =========================
@@ -4554,8 +7408,9 @@ with t_rep:
     st.markdown("<div class=''>", unsafe_allow_html=True)
     st.subheader("📊 Report per Squadra")
 
-    df = pd.DataFrame(st.session_state.brogliaccio)
     filtro = st.selectbox("Seleziona squadra:", ["TUTTE"] + list(st.session_state.squadre.keys()), index=0)
+    # una squadra: solo i suoi eventi (indice per squadra), non l'intero registro
+    df = pd.DataFrame(storage_events({filtro}) if filtro != "TUTTE" else _event_views(st.session_state.brogliaccio))
 
     st.markdown("#### 📞 Rubrica Squadre (Caposquadra / Telefono)")
     rubrica = []
@@ -4573,7 +7428,7 @@ with t_rep:
         df_f = pd.DataFrame()
         df_view = pd.DataFrame()
     else:
-        df_f = df[df["sq"] == filtro].copy() if filtro != "TUTTE" else df.copy()
+        df_f = df.copy()
         df_view = df_for_report(df_f)
         st.dataframe(df_view, use_container_width=True, height=360)
 
@@ -4621,17 +7476,13 @@ with t_rep:
     _use_all = ("Tutte" in _rep_sq) or (len(_rep_sq) == 0)
     _rep_sq_set = set(_sq_opts) if _use_all else set([x for x in _rep_sq if x != "Tutte"])
 
+    _rep_t0, _rep_t1 = _time_window_ui("rep", "⏱️ Finestra temporale (report)")
+
     # Cache report per velocizzare (foto escluse)
     _rep_brog = []
-    for _e in (st.session_state.brogliaccio or []):
-        # applica filtro squadra
-        if isinstance(_e, dict):
-            _sqv = _e.get('sq')
-            if _sqv and _sqv not in _rep_sq_set:
-                continue
-        else:
-            # se non è dict, non filtriamo
-            pass
+    # filtro squadra: indice per squadra dello store (eventi senza squadra sempre inclusi);
+    # finestra temporale: bisect sull'indice temporale dello store
+    for _e in storage_events(None if _use_all else _rep_sq_set, keep_unassigned=True, t0=_rep_t0, t1=_rep_t1):
         if isinstance(_e, dict):
             _d = dict(_e)
             _d.pop('foto', None)
@@ -4639,6 +7490,10 @@ with t_rep:
         else:
             _rep_brog.append(_e)
     _payload = {'squadre': st.session_state.squadre, 'brogliaccio': _rep_brog, 'center': st.session_state.pos_mappa}
+    try:
+        _payload['tracks'] = report_tracks(st.session_state.get("ev_data"), _rep_t0, _rep_t1)
+    except Exception:
+        pass
     html_bytes = _cached_report_bytes(
         json.dumps(_payload, ensure_ascii=False, sort_keys=True, separators=(',', ':')),
         json.dumps(meta, ensure_ascii=False, sort_keys=True, separators=(',', ':')),
@@ -4652,10 +7507,11 @@ with t_rep:
     )
 
     st.markdown("#### ✏️ Modifica evento (correzione rapida)")
-    _maxi = max(len(st.session_state.brogliaccio) - 1, 0)
-    _idx_edit = st.number_input("Indice evento (#) da modificare", min_value=0, max_value=_maxi, value=0, step=1, key="rep_edit_idx")
-    if st.button("✏️ Apri modifica evento", key="rep_open_edit"):
-        st.session_state.edit_event_idx = int(_idx_edit)
+    # scelta per id: un nuovo evento in testa non sposta la selezione su un altro record
+    _lbl_edit = {e.get("id"): _event_label(e) for e in _event_views(st.session_state.brogliaccio[:REP_EDIT_MAX])}
+    _id_edit = st.selectbox("Evento da modificare", options=list(_lbl_edit), format_func=lambda eid: _lbl_edit.get(eid, "—"), key="rep_edit_id")
+    if st.button("✏️ Apri modifica evento", key="rep_open_edit", disabled=not _id_edit):
+        st.session_state.edit_event_id = _id_edit
         st.rerun()
 
     st.caption("Apri l'HTML → scegli squadra → scegli modalità mappa (Ultime/Tutti/Percorso) → STAMPA con/senza mappa.")
@@ -4666,19 +7522,20 @@ with t_rep:
 # =========================
 # MODIFICA EVENTO (correzione rapida)
 # =========================
-if "edit_event_idx" not in st.session_state:
-    st.session_state.edit_event_idx = None
-
-if st.session_state.edit_event_idx is not None:
-    _i = int(st.session_state.edit_event_idx)
-    if 0 <= _i < len(st.session_state.brogliaccio):
-        _ev = st.session_state.brogliaccio[_i]
+if "edit_event_id" not in st.session_state:
+    st.session_state.edit_event_id = None
+
+if st.session_state.edit_event_id is not None:
+    _i = st.session_state.edit_event_id
+    _ev = st.session_state.brogliaccio.get(_i)  # lookup per id: O(1), stabile con inserimenti concorrenti
+    if _ev is not None:
+        _ev = _event_view(_ev)
         _STATI = globals().get("STATI_EVENTO", ["uscita", "intervento", "concluso", "info"])
-        with st.expander(f"✏️ Modifica evento #{_i}", expanded=False):
+        with st.expander(f"✏️ Modifica evento {_event_label(_ev)}", expanded=False):
             c1, c2, c3 = st.columns([2, 2, 2])
             _sq = c1.selectbox("SQUADRA", options=sorted(list(st.session_state.squadre.keys())), index=(sorted(list(st.session_state.squadre.keys())).index(_ev.get("sq")) if _ev.get("sq") in st.session_state.squadre else 0), key=f"edit_sq_{_i}")
             _st = c2.selectbox("STATO", options=_STATI, index=(_STATI.index(_ev.get("st")) if _ev.get("st") in _STATI else 0), key=f"edit_st_{_i}")
-            _ts = c3.text_input("DATA/ORA", value=str(_ev.get("ts","")), key=f"edit_ts_{_i}", help="Lascia invariato se va bene (es. 2026-01-24 13:10)")
+            _ts = c3.text_input("DATA/ORA", value=_ms_fmt(_ev.get("t")) or str(_ev.get("ts", "")), key=f"edit_ts_{_i}", help="Lascia invariato se va bene (es. 2026-01-24 13:10)")
             _chi = st.text_input("CHIAMA", value=str(_ev.get("chi","")), key=f"edit_chi_{_i}")
             _mit = st.text_input("MITTENTE", value=str(_ev.get("mit","")), key=f"edit_mit_{_i}")
             _ris = st.text_input("RICEVE", value=str(_ev.get("ris","")), key=f"edit_ris_{_i}")
@@ -4696,8 +7553,10 @@ if st.session_state.edit_event_idx is not None:
 
             b1, b2 = st.columns(2)
             if b1.button("💾 Salva modifiche", use_container_width=True, key=f"edit_save_{_i}"):
-                st.session_state.brogliaccio[_i] = {
-                    "ts": _ts or datetime.now().strftime("%Y-%m-%d %H:%M"),
+                _commit_ops([{"op": "ev_put", "id": _i, "rec": {
+                    # istante in epoch ms (se il testo non è una data valida resta quello di prima)
+                    "t": _ms_from_dt_text(_ts) or _ev.get("t") or _now_ms(),
+                    "ora": _ms_fmt(_ms_from_dt_text(_ts), "%H:%M") or _ev.get("ora"),
                     "sq": _sq,
                     "st": _st,
                     "chi": _chi,
@@ -4705,17 +7564,16 @@ if st.session_state.edit_event_idx is not None:
                     "ris": _ris,
                     "op": _op,
                     "pos": {"lat": float(_lat), "lon": float(_lon)},
-                }
-                save_data_to_disk()
-                st.session_state.edit_event_idx = None
+                }}])
+                st.session_state.edit_event_id = None
                 st.success("Evento aggiornato.")
                 st.rerun()
 
             if b2.button("✖️ Annulla", use_container_width=True, key=f"edit_cancel_{_i}"):
-                st.session_state.edit_event_idx = None
+                st.session_state.edit_event_id = None
                 st.rerun()
     else:
-        st.session_state.edit_event_idx = None
+        st.session_state.edit_event_id = None
 
 st.markdown("### 📋 REGISTRO EVENTI")
 
@@ -4727,7 +7585,7 @@ mode_fast = (view_mode == "Veloce")
 _lim_opts = [25, 50, 100, 150, "Tutti"]
 _lim = st.selectbox("Mostra ultimi:", _lim_opts, index=1, key="log_limit")
 all_events = st.session_state.brogliaccio
-events_loaded = all_events if _lim == "Tutti" else all_events[:int(_lim)]
+events_loaded = _event_views(all_events if _lim == "Tutti" else all_events[:int(_lim)])
 
 # --- Filtro squadra (registro) ---
 _sq_opts_reg = sorted(list((st.session_state.squadre or {}).keys()))
@@ -4739,8 +7597,16 @@ _reg_sq = st.selectbox(
     help="Mostra solo gli interventi della squadra selezionata oppure tutti.",
 )
 if _reg_sq != "Tutte":
-    events_loaded = [e for e in events_loaded if isinstance(e, dict) and e.get("sq") == _reg_sq]
-    st.caption(f"Filtro attivo: **{_reg_sq}** — eventi mostrati: **{len(events_loaded)}**.")
+    events_loaded = storage_events({_reg_sq}, limit=None if _lim == "Tutti" else int(_lim))
+    _n_sq = all_events.count_by((st.session_state.squadre.get(_reg_sq) or {}).get("tid"))
+    st.caption(f"Filtro attivo: **{_reg_sq}** — eventi mostrati: **{len(events_loaded)}** su **{_n_sq}** della squadra.")
+
+# --- Filtro periodo (registro): finestra sull'indice temporale ---
+_t0, _t1 = _time_window_ui("log", "⏱️ Periodo (registro)")
+if _t0 is not None or _t1 is not None:
+    events_loaded = storage_events(None if _reg_sq == "Tutte" else {_reg_sq},
+                                   limit=None if _lim == "Tutti" else int(_lim), t0=_t0, t1=_t1)
+    st.caption(f"Periodo: **{_ms_fmt(_t0) or '…'}** → **{_ms_fmt(_t1) or 'adesso'}** — eventi: **{len(events_loaded)}**.")
 
 if _lim != "Tutti" and len(all_events) > int(_lim):
     st.caption(f"Mostrati gli ultimi **{int(_lim)}** eventi su **{len(all_events)}** totali (per velocità).")
@@ -4794,24 +7660,24 @@ if mode_fast:
         df_log = pd.DataFrame(rows)
         st.dataframe(df_log, use_container_width=True, height=420)
 
-        # Selezione evento (dettaglio singolo, non 200 expander)
-        pick = st.number_input(
-            "Apri dettaglio evento #",
-            min_value=int(df_log["#"].min()),
-            max_value=int(df_log["#"].max()),
-            value=int(df_log["#"].min()),
-            step=1,
-            key="log_pick_idx",
+        # Selezione evento (dettaglio singolo, non 200 expander): per id, non per posizione
+        _pick_lbl = {b.get("id"): f"#{j} · {_event_label(b)}" for j, b in enumerate(page_events, start=start_i)}
+        pick = st.selectbox(
+            "Apri dettaglio evento",
+            options=list(_pick_lbl),
+            format_func=lambda eid: _pick_lbl.get(eid, "—"),
+            key="log_pick_id",
         )
 
-        if 0 <= int(pick) < len(all_events):
-            b = all_events[int(pick)]
+        b = all_events.get(pick)
+        if b is not None:
+            b = _event_view(b)
             gps_ok = isinstance(b.get("pos"), list) and len(b["pos"]) == 2
             gps_t = f"GPS: {b['pos'][0]:.4f}, {b['pos'][1]:.4f}" if gps_ok else "GPS: OMISSIS"
             a, c = call_flow_from_row(b)
             titolo = f"{b.get('ora','')} | 📞 {a} ➜ 🎧 {c} | {b.get('sq','')} | {gps_t}"
 
-            with st.expander(f"🔎 Dettaglio evento  #{int(pick)}  —  {titolo}", expanded=False):
+            with st.expander(f"🔎 Dettaglio evento  {_pick_lbl.get(pick, '').split(' · ')[0]}  —  {titolo}", expanded=False):
                 st.markdown(chip_call_flow(b), unsafe_allow_html=True)
                 st.markdown(chip_stato(b.get("st", "")), unsafe_allow_html=True)
 
@@ -4827,12 +7693,12 @@ if mode_fast:
                 )
 
                 col_a, col_b, col_c = st.columns([1, 1, 2])
-                if col_a.button("✏️ MODIFICA", key=f"edit_ev_pick_{int(pick)}"):
-                    st.session_state.edit_event_idx = int(pick)
+                if col_a.button("✏️ MODIFICA", key=f"edit_ev_pick_{pick}"):
+                    st.session_state.edit_event_id = pick
                     st.rerun()
 
                 if gps_ok:
-                    show_map = col_b.toggle("🗺️ MAPPA", value=False, key=f"show_map_pick_{int(pick)}")
+                    show_map = col_b.toggle("🗺️ MAPPA", value=False, key=f"show_map_pick_{pick}")
                     col_c.caption("Mappa compatta dentro la scheda (non occupa spazio in alto).")
 
                     if show_map:
@@ -4843,7 +7709,7 @@ if mode_fast:
                                 pts = [(float(pos[0]), float(pos[1]), f"{b.get('sq','')} · {b.get('st','')}")]
                             except Exception:
                                 pts = []
-                            ck = _hash_obj({"ev": int(pick), "p": pts, "mode": "pick"})
+                            ck = _hash_obj({"ev": pick, "p": pts, "mode": "pick"})
                             png = _static_map_png_cached(ck, pts, zoom=15)
                             if png:
                                 st.image(png, use_container_width=True)
@@ -4855,17 +7721,18 @@ if mode_fast:
                                     tooltip=f"{b.get('sq','')} · {b.get('st','')}",
                                     icon=folium.Icon(color=COLORI_STATI.get(b.get('st',''), {}).get('color', 'blue')),
                                 ).add_to(m_ev)
-                                st_folium(m_ev, width="100%", height=260, returned_objects=[], key=f"map_event_pick_{int(pick)}")
+                                st_folium(m_ev, width="100%", height=260, returned_objects=[], key=f"map_event_pick_{pick}")
                         else:
                             st.info("Evento senza coordinate GPS (OMISSIS).")
                 else:
-                    col_b.toggle("🗺️ N/D", value=False, key=f"no_map_pick_{int(pick)}", disabled=True)
+                    col_b.toggle("🗺️ N/D", value=False, key=f"no_map_pick_{pick}", disabled=True)
                     col_c.caption("Coordinate non presenti (OMISSIS).")
 
 # -------- Modalità classica (expander per evento) --------
 else:
     _events = events_loaded
-    for i, b in enumerate(_events):
+    for b in _events:
+        i = b.get("id")  # chiavi dei widget per id: restano legate all'evento anche se ne arrivano di nuovi
         gps_ok = isinstance(b.get("pos"), list) and len(b["pos"]) == 2
         gps_t = f"GPS: {b['pos'][0]:.4f}, {b['pos'][1]:.4f}" if gps_ok else "GPS: OMISSIS"
         a, c = call_flow_from_row(b)
@@ -4888,7 +7755,7 @@ else:
 
             col_a, col_b, col_c = st.columns([1, 1, 2])
             if col_a.button("✏️ MODIFICA", key=f"edit_ev_{i}"):
-                st.session_state.edit_event_idx = int(i)
+                st.session_state.edit_event_id = i
                 st.rerun()
 
             if gps_ok:
@@ -4929,28 +7796,22 @@ st.subheader("💾 Gestione Memoria Dati")
 col_m1, col_m2 = st.columns(2)
 
 if col_m1.button("🧹 CANCELLA TUTTI I DATI"):
-    d = default_state_payload()
-    st.session_state.brogliaccio = d["brogliaccio"]
-    st.session_state.inbox = d["inbox"]
+    _install_payload(default_state_payload())
     ensure_inbox_ids()
-    st.session_state.squadre = d["squadre"]
-    st.session_state.pos_mappa = d["pos_mappa"]
-    st.session_state.op_name = d["op_name"]
-    st.session_state.ev_data = datetime.fromisoformat(d["ev_data"]).date()
-    st.session_state.ev_tipo = d["ev_tipo"]
-    st.session_state.ev_nome = d["ev_nome"]
-    st.session_state.ev_desc = d["ev_desc"]
-    st.session_state.BASE_URL = d["BASE_URL"]
     st.session_state.open_map_event = None
     st.session_state.team_edit_open = None
     st.session_state.team_qr_open = None
-    save_data_to_disk()
+    _mark_dirty()
+    save_data_to_disk(force=True, merge=False)
     st.success("Tutti i dati sono stati cancellati.")
     st.rerun()
 
 if col_m2.button("💾 SALVA ORA SU DISCO"):
-    save_data_to_disk()
+    save_data_to_disk(force=True)
     st.success("Salvato.")
+
+# dati evento / operatore cambiati dai widget -> una riga nel journal
+_journal_meta_if_changed()
 # =========================
 # REPORT CACHE (GLOBAL)
 # =========================
@@ -4963,6 +7824,7 @@ def _cached_report_bytes(payload_json: str, meta_json: str) -> bytes:
         brogliaccio=payload.get("brogliaccio", []),
         center=payload.get("center", []),
         meta=meta,
+        tracks=payload.get("tracks"),
     )
 
 # =========================